@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Memory and disk size of dialog histories: the old list of dicts against my_history.History.
+
+python3 benchmarks/bench_history.py [--chats 2000] [--turns 10]
+
+Resident bytes are counted with tracemalloc while the histories are built from fresh
+strings, the texts themselves are the same in both cases, so the difference is the
+overhead of the containers. Disk is the pickled size, plain and with zlib as in db/dialogs.db.
+"""
+
+
+import argparse
+import os
+import pickle
+import random
+import sys
+import timeit
+import tracemalloc
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import my_history
+
+
+WORDS = ('the answer is in the documentation so let us look at what the function returns when '
+         'the list is empty and then check how python handles it in other cases').split()
+
+
+def make_text(rnd: random.Random, size: int) -> str:
+    words = []
+    total = 0
+    while total < size:
+        word = rnd.choice(WORDS)
+        words.append(word)
+        total += len(word) + 1
+    return ' '.join(words)
+
+
+def make_dialogs(chats: int, turns: int, compact: bool, seed: int = 1) -> list:
+    """Dialogs like gpt_basic.chat keeps: short questions, answers up to cfg.max_hist_mem"""
+    rnd = random.Random(seed)
+    dialogs = []
+    for _ in range(chats):
+        messages = []
+        for _ in range(turns):
+            messages.append({'role': 'user', 'content': make_text(rnd, rnd.randint(20, 300))})
+            messages.append({'role': 'assistant', 'content': make_text(rnd, rnd.randint(200, 2500))})
+        dialogs.append(my_history.History.of(messages) if compact else messages)
+    return dialogs
+
+
+def resident(chats: int, turns: int, compact: bool) -> int:
+    tracemalloc.start()
+    try:
+        dialogs = make_dialogs(chats, turns, compact)
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del dialogs
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chats', type=int, default=2000)
+    parser.add_argument('--turns', type=int, default=10, help='question and answer pairs in a dialog')
+    args = parser.parse_args()
+
+    texts = resident(args.chats, args.turns, True) - \
+        sum(sys.getsizeof(x.roles) + sys.getsizeof(x.contents) for x in make_dialogs(args.chats, args.turns, True))
+    print(f'{args.chats} chats, {args.turns * 2} messages each, texts take about {texts / args.chats:.0f} bytes per chat\n')
+    print(f'{"format":<14} {"RAM/chat":>10} {"overhead/chat":>14} {"pickle/chat":>12} {"zlib/chat":>10} {"to openai, us":>14}')
+    for name, compact in (('list of dicts', False), ('History', True)):
+        ram = resident(args.chats, args.turns, compact)
+        dialogs = make_dialogs(args.chats, args.turns, compact)
+        blobs = [pickle.dumps(x, protocol=4) for x in dialogs]
+        pickled = sum(len(x) for x in blobs)
+        zipped = sum(len(zlib.compress(x)) for x in blobs)
+        sample = dialogs[0]
+        convert = (lambda: sample.to_messages()) if compact else (lambda: list(sample))
+        seconds = min(timeit.repeat(convert, number=1000, repeat=5)) / 1000
+        print(f'{name:<14} {ram / args.chats:>10.0f} {(ram - texts) / args.chats:>14.0f} '
+              f'{pickled / args.chats:>12.0f} {zipped / args.chats:>10.0f} {seconds * 1e6:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
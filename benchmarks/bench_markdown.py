@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Compares the old multi-pass utils.bot_markdown_to_html with the current one on big
+answers like LLMs write.
+
+python3 benchmarks/bench_markdown.py [--size 20000] [--repeat 20]
+
+The old version draws tables with prettytable, it has to be installed to run this.
+"""
+
+
+import argparse
+import html
+import os
+import random
+import re
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import prettytable
+from pylatexenc.latex2text import LatexNodes2Text
+
+import utils
+
+
+ANSWER_PARTS = [
+    '## Solution\n\nTo solve this, first compute the **discriminant** $D = b^2 - 4ac$, '
+    'then the roots are $$x = \\frac{-b \\pm \\sqrt{D}}{2a}$$ for every real $D \\geq 0$.\n',
+    '* first item with `inline code` inside\n* second item, see [docs](https://docs.python.org/3/)\n'
+    '- third item https://example.com/some/long/path?query=1&other=2\n',
+    '```python\ndef fib(n):\n    a, b = 0, 1\n    for _ in range(n):\n        a, b = b, a + b\n'
+    '    return a\n\nprint(fib(10) < 100 and "ok")\n```\n',
+    '| Language | Typing | Speed | Notes |\n|---|---|---|---|\n'
+    '| Python | dynamic | slow | **great** for scripts |\n| Rust | static | fast | borrow checker |\n'
+    '| Go | static | fast | simple & boring |\n',
+    'Plain paragraph of text that explains things in detail, with some <html> symbols & quotes "like this" '
+    'and a few **bold words** here and there, ending with a sentence.\n\n',
+]
+
+
+def make_answer(size: int) -> str:
+    rnd = random.Random(size)
+    parts = []
+    total = 0
+    while total < size:
+        part = rnd.choice(ANSWER_PARTS)
+        parts.append(part)
+        total += len(part)
+    return '\n'.join(parts)
+
+
+def legacy_replace_tables(text: str) -> str:
+    text += '\n'
+    state = 0
+    table = ''
+    results = []
+    for line in text.split('\n'):
+        if line.count('|') > 2 and len(line) > 4:
+            if state == 0:
+                state = 1
+            table += line + '\n'
+        else:
+            if state == 1:
+                results.append(table[:-1])
+                table = ''
+                state = 0
+
+    for table in results:
+        x = prettytable.PrettyTable(align = "l",
+                                    set_style = prettytable.MSWORD_FRIENDLY,
+                                    hrules = prettytable.HEADER,
+                                    junction_char = '|')
+
+        lines = table.split('\n')
+        header = [x.strip().replace('<b>', '').replace('</b>', '') for x in lines[0].split('|') if x]
+        header = [utils.split_long_string(x, header = True) for x in header]
+        try:
+            x.field_names = header
+        except Exception:
+            continue
+        for line in lines[2:]:
+            row = [x.strip().replace('<b>', '').replace('</b>', '') for x in line.split('|') if x]
+            row = [utils.split_long_string(x) for x in row]
+            try:
+                x.add_row(row)
+            except Exception:
+                continue
+        new_table = x.get_string()
+        text = text.replace(table, f'<code>{new_table}</code>')
+
+    return text
+
+
+def legacy_bot_markdown_to_html(text: str) -> str:
+    """utils.bot_markdown_to_html before the single pass renderer"""
+    text = html.escape(text)
+
+    matches = re.findall('```(.*?)```', text, flags=re.DOTALL)
+    list_of_code_blocks = []
+    for match in matches:
+        random_string = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(16))
+        list_of_code_blocks.append([match, random_string])
+        text = text.replace(f'```{match}```', random_string)
+    matches = re.findall('`(.*?)`', text, flags=re.DOTALL)
+    list_of_code_blocks2 = []
+    for match in matches:
+        random_string = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(16))
+        list_of_code_blocks2.append([match, random_string])
+        text = text.replace(f'`{match}`', random_string)
+
+    new_text = ''
+    for i in text.split('\n'):
+        ii = i.strip()
+        if ii.startswith('* '):
+            i = i.replace('* ', '• ', 1)
+        if ii.startswith('- '):
+            i = i.replace('- ', '• ', 1)
+        new_text += i + '\n'
+    text = new_text.strip()
+
+    text = re.sub(r'\*\*(.+?)\*\*', '<b>\\1</b>', text)
+
+    matches = re.findall(r"\$\$?(.*?)\$\$?", text, flags=re.DOTALL)
+    for match in matches:
+        new_match = LatexNodes2Text().latex_to_text(match.replace('\\\\', '\\'))
+        text = text.replace(f'$${match}$$', new_match)
+        text = text.replace(f'${match}$', new_match)
+
+    text = re.sub(r'\[([^\]]*)\]\(([^\)]*)\)', r'<a href="\2">\1</a>', text)
+    text = re.sub(r'(?<!<a href=")(https?://\S+)(?!">[^<]*</a>)', r'<a href="\1">\1</a>', text)
+
+    for match, random_string in list_of_code_blocks2:
+        text = text.replace(random_string, f'<code>{match}</code>')
+
+    for match, random_string in list_of_code_blocks:
+        text = text.replace(random_string, f'<code>{match}</code>')
+
+    text = legacy_replace_tables(text)
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, nargs='*', default=[2000, 20000, 100000],
+                        help='answer sizes in characters')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    print(f'{"size":>8} {"old, ms":>10} {"new, ms":>10} {"speedup":>8}')
+    for size in args.size:
+        text = make_answer(size)
+        old = min(timeit.repeat(lambda: legacy_bot_markdown_to_html(text), number=1, repeat=args.repeat))
+        new = min(timeit.repeat(lambda: utils.bot_markdown_to_html(text), number=1, repeat=args.repeat))
+        print(f'{len(text):>8} {old * 1000:>10.2f} {new * 1000:>10.2f} {old / new:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Latency of small answers while other chats get huge ones, with and without my_render's pool.
+
+python3 benchmarks/bench_render.py [--small-threads 8] [--big-threads 2] [--seconds 5]
+
+Small threads format short answers in a loop like the handlers of ordinary chats, big threads
+keep formatting 20 KB answers with tables and formulas. The numbers are the time from the moment
+a small answer is ready to be formatted until it is split: with everything in the handler threads
+it waits for the GIL held by the big ones. Needs cfg.py like the bot.
+"""
+
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_utils
+import my_render
+import utils
+
+
+def percentiles(values: list) -> str:
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(len(values) * p / 100))] * 1000
+    return f'p50 {pick(50):7.2f}  p95 {pick(95):7.2f}  p99 {pick(99):7.2f}  max {values[-1] * 1000:7.2f} ms'
+
+
+def run(small_text: str, big_text: str, args) -> tuple:
+    stop = threading.Event()
+    small_times = []
+    big_count = [0]
+
+    def small():
+        while not stop.is_set():
+            # like an answer coming from the network: the time starts when it is there,
+            # not when the thread gets the GIL back
+            due = time.perf_counter() + 0.002
+            time.sleep(0.002)
+            my_render.split_html(my_render.bot_markdown_to_html(small_text), 4000)
+            small_times.append(time.perf_counter() - due)
+
+    def big():
+        while not stop.is_set():
+            utils._latex_to_text.cache_clear()
+            my_render.split_html(my_render.bot_markdown_to_html(big_text), 4000)
+            big_count[0] += 1
+
+    threads = [threading.Thread(target=small) for _ in range(args.small_threads)]
+    threads += [threading.Thread(target=big) for _ in range(args.big_threads)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return small_times, big_count[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--small-threads', type=int, default=8)
+    parser.add_argument('--big-threads', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    texts = bench_utils.load_corpus()
+    small_text = texts['prose_ru']
+    big_text = texts['long_20k']
+    print(f'small answer {len(small_text)} chars, big answer {len(big_text)} chars, '
+          f'pool from {my_render.OFFLOAD_MIN} chars\n')
+    for name, workers in (('inline', 0), (f'pool of {my_render.WORKERS or 2}', my_render.WORKERS or 2)):
+        my_render.WORKERS = workers
+        my_render.start()
+        small_times, big_count = run(small_text, big_text, args)
+        print(f'{name:<10} small answers: {percentiles(small_times)}, big answers done: {big_count}')
+
+
+if __name__ == '__main__':
+    main()
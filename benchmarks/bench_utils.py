@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Time and memory of the formatting functions that run on every reply, on a corpus of
+LLM answers from benchmarks/corpus (code, LaTeX, tables, russian prose) plus a 20 KB
+answer made of all of them.
+
+python3 benchmarks/bench_utils.py                          # print the table
+python3 benchmarks/bench_utils.py --save baseline.json     # remember the numbers
+python3 benchmarks/bench_utils.py --check baseline.json    # exit 1 if something got slower
+
+--check compares with a baseline saved on the same machine, a function is a regression
+if its time (or peak memory) is more than --threshold (20% by default) worse.
+gpt_basic.zip_text needs the bot environment (cfg.py, openai), without it the case is skipped.
+"""
+
+
+import argparse
+import glob
+import html
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+LONG_SIZE = 20000
+
+
+def load_corpus(folder: str = CORPUS) -> dict:
+    """{name: text} of the corpus files and 'long_20k' made of them"""
+    texts = {}
+    for path in sorted(glob.glob(os.path.join(folder, '*.md'))):
+        with open(path, encoding='utf-8') as f:
+            texts[os.path.splitext(os.path.basename(path))[0]] = f.read()
+    long_text = ''
+    while texts and len(long_text) < LONG_SIZE:
+        for text in texts.values():
+            long_text += text + '\n'
+    texts['long_20k'] = long_text[:LONG_SIZE]
+    return texts
+
+
+def render_cold(text: str) -> str:
+    """bot_markdown_to_html without the formulas cached by the previous runs, answers rarely repeat"""
+    utils._latex_to_text.cache_clear()
+    return utils.bot_markdown_to_html(text)
+
+
+def cases(texts: dict) -> list:
+    """[(function name, text name, callable)], the input of every function is what it gets in the bot"""
+    try:
+        import gpt_basic
+        zip_text = gpt_basic.zip_text
+    except Exception as error:
+        print(f'gpt_basic.zip_text skipped: {error}', file=sys.stderr)
+        zip_text = None
+
+    result = []
+    for name, text in texts.items():
+        rendered = utils.bot_markdown_to_html(text)
+        escaped = html.escape(text)
+        lines = text.split('\n')
+        result += [
+            ('bot_markdown_to_html', name, lambda t=text: render_cold(t)),
+            ('split_html', name, lambda t=rendered: utils.split_html(t, 4000)),
+            ('split_text', name, lambda t=text: utils.split_text(t, 4000)),
+            ('replace_tables', name, lambda t=escaped: utils.replace_tables(t)),
+            ('split_long_string', name, lambda x=lines: [utils.split_long_string(i) for i in x]),
+        ]
+        if zip_text:
+            result.append(('zip_text', name, lambda t=text: zip_text(t)))
+    return result
+
+
+def measure(func, repeat: int) -> dict:
+    """Best time of a call in ms and the peak of allocated memory in KB"""
+    func()
+    number, _ = timeit.Timer(func).autorange()
+    number = max(1, number // 5)
+    best = min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'ms': best * 1000, 'peak_kb': peak / 1024}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Regressions [(case, metric, old, new)]"""
+    regressions = []
+    for key, new in results.items():
+        old = baseline.get(key)
+        if not old:
+            continue
+        for metric in ('ms', 'peak_kb'):
+            # tiny values are all noise
+            floor = 0.01 if metric == 'ms' else 1
+            if new[metric] > max(old[metric], floor) * (1 + threshold):
+                regressions.append((key, metric, old[metric], new[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default=CORPUS)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', help='run only the functions with this substring in the name')
+    parser.add_argument('--save', metavar='FILE', help='save the results as a baseline')
+    parser.add_argument('--check', metavar='FILE', help='compare with a baseline, exit 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+
+    texts = load_corpus(args.corpus)
+    baseline = {}
+    if args.check:
+        with open(args.check, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    results = {}
+    print(f'{"function":<22} {"text":<14} {"size":>7} {"ms":>9} {"peak KB":>9}')
+    for function, name, func in cases(texts):
+        if args.only and args.only not in function:
+            continue
+        key = f'{function}/{name}'
+        results[key] = measure(func, args.repeat)
+        old = baseline.get(key)
+        change = f'  {(results[key]["ms"] - old["ms"]) / old["ms"] * 100:+.0f}%' if old and old['ms'] else ''
+        print(f'{function:<22} {name:<14} {len(texts[name]):>7} {results[key]["ms"]:>9.3f} '
+              f'{results[key]["peak_kb"]:>9.1f}{change}')
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.check:
+        regressions = compare(results, baseline, args.threshold)
+        for key, metric, old, new in regressions:
+            print(f'REGRESSION {key} {metric}: {old:.3f} -> {new:.3f}')
+        if regressions:
+            sys.exit(1)
+        print(f'no regressions over {args.threshold:.0%}')
+
+
+if __name__ == '__main__':
+    main()
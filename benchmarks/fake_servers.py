@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+"""Local stand-ins for the Telegram Bot API and an OpenAI compatible API, for load tests
+without a real bot token or api key.
+
+FakeTelegram keeps a queue of updates for getUpdates and records everything the bot sends.
+FakeOpenAI answers chat completions (optionally streamed) and image generations after
+a configurable delay.
+
+Both can also be started by hand to poke the bot manually:
+
+python3 benchmarks/fake_servers.py --telegram-port 8081 --openai-port 8082
+"""
+
+
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# 1x1 transparent png for the fake generated images
+PNG = bytes.fromhex('89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+                    '1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082')
+
+BOT_USER = {'id': 100000, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+ANSWER_PARTS = [
+    'Here is a short explanation of the **main idea**, with a few details that matter.\n\n',
+    '* the first point, see [docs](https://docs.python.org/3/)\n* the second point with `code`\n\n',
+    '```python\nfor i in range(10):\n    print(i * i)\n```\n\n',
+    '| Name | Value |\n|---|---|\n| alpha | 1 |\n| beta | 2 |\n\n',
+    'The formula is $E = mc^2$, nothing unusual here.\n\n',
+]
+
+
+def make_answer(size: int, rnd: random.Random = random) -> str:
+    """Markdown text about size characters, like LLMs write"""
+    parts = []
+    total = 0
+    while total < size:
+        part = rnd.choice(ANSWER_PARTS)
+        parts.append(part)
+        total += len(part)
+    return ''.join(parts)
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # a load test opens many connections at once
+    request_queue_size = 256
+
+    def __init__(self, port: int, handler):
+        super().__init__(('127.0.0.1', port), handler)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def send_json(self, data, status: int = 200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_bytes(self, body: bytes, content_type: str = 'application/octet-stream'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Conflict(Exception):
+    """A newer getUpdates request ended this one, as telegram does"""
+
+
+class TelegramHandler(JsonHandler):
+    """/bot<token>/<method> and /file/bot<token>/<path>, telebot puts the parameters
+    into the query string, files go as multipart body"""
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        body = self.read_body()
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if not params and body and self.headers.get('Content-Type', '').startswith('application/x-www-form'):
+            params = dict(urllib.parse.parse_qsl(body.decode('utf-8')))
+        parts = url.path.strip('/').split('/')
+        fake = self.server.fake
+        if parts[0] == 'file':
+            data = fake.files.get('/'.join(parts[2:]))
+            if data is None:
+                self.send_error(404)
+            else:
+                self.send_bytes(data)
+            return
+        if len(parts) != 2 or not parts[0].startswith('bot'):
+            self.send_error(404)
+            return
+        try:
+            result = fake.call(parts[1], params)
+        except Conflict as error:
+            self.send_json({'ok': False, 'error_code': 409, 'description': str(error)}, 409)
+            return
+        self.send_json({'ok': True, 'result': result})
+
+
+class FakeTelegram:
+    """Telegram Bot API with a scripted stream of updates.
+
+    add_message(...) queues an update for getUpdates, every request of the bot is
+    recorded in requests [(time, method, params)], replies are matched to the updates
+    by (chat_id, reply_to_message_id) in replies {(chat_id, message_id): [times]}."""
+
+    def __init__(self, port: int = 0):
+        self.server = Server(port, TelegramHandler)
+        self.server.fake = self
+        self.cond = threading.Condition()
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        # every getUpdates gets a number, a waiting one is ended by a newer one
+        self.polls = itertools.count(1)
+        self.last_poll = 0
+        self.message_ids = itertools.count(1)
+        # the bot started real polling, updates sent before are skipped by skip_pending
+        self.ready = threading.Event()
+        self.requests = []
+        self.replies = {}
+        # {file_path: bytes} for getFile and downloads
+        self.files = {}
+
+    @property
+    def url(self) -> str:
+        return self.server.url
+
+    def start(self):
+        self.server.start()
+        return self
+
+    def stop(self):
+        with self.cond:
+            self.cond.notify_all()
+        self.server.stop()
+
+    def make_message(self, chat: dict, user: dict, text: str = None, **fields) -> dict:
+        message = {'message_id': next(self.message_ids), 'date': int(time.time()),
+                   'chat': chat, 'from': user}
+        if text is not None:
+            message['text'] = text
+        message.update(fields)
+        return message
+
+    def add_update(self, update: dict) -> dict:
+        """Queues the update, update_id is assigned here"""
+        update = dict(update, update_id=next(self.update_ids))
+        with self.cond:
+            self.updates.append(update)
+            self.cond.notify_all()
+        return update
+
+    def add_message(self, message: dict) -> dict:
+        return self.add_update({'message': message})
+
+    def _get_updates(self, params: dict) -> list:
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        if offset != -1:
+            self.ready.set()
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            poll = self.last_poll = next(self.polls)
+            self.cond.notify_all()
+            while True:
+                if poll != self.last_poll:
+                    raise Conflict('Conflict: terminated by other getUpdates request')
+                if offset > 0:
+                    # confirmed updates are not needed any more
+                    self.updates = [x for x in self.updates if x['update_id'] >= offset]
+                if offset == -1:
+                    return self.updates[-1:]
+                if self.updates:
+                    return self.updates[:limit]
+                left = deadline - time.monotonic()
+                if left <= 0 or not self.server.thread.is_alive():
+                    return []
+                self.cond.wait(min(left, 1))
+
+    def call(self, method: str, params: dict):
+        now = time.time()
+        if method == 'getUpdates':
+            return self._get_updates(params)
+        with self.cond:
+            self.requests.append((now, method, params))
+            chat_id = params.get('chat_id')
+            reply_to = params.get('reply_to_message_id')
+            if chat_id and reply_to:
+                self.replies.setdefault((int(chat_id), int(reply_to)), []).append(now)
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getFile':
+            file_id = params.get('file_id', '')
+            path = f'files/{file_id}'
+            data = self.files.get(path, b'')
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(data), 'file_path': path}
+        if method in ('sendMessage', 'sendVoice', 'sendPhoto', 'sendDocument', 'sendAudio'):
+            chat = {'id': int(params.get('chat_id', 0)), 'type': 'private'}
+            message = self.make_message(chat, BOT_USER, params.get('text'))
+            if method == 'sendVoice':
+                message['voice'] = {'file_id': f'voice{message["message_id"]}', 'file_unique_id': 'v',
+                                    'duration': 1}
+            if method == 'sendDocument':
+                message['document'] = {'file_id': f'doc{message["message_id"]}', 'file_unique_id': 'd'}
+            if method == 'sendPhoto':
+                message['photo'] = [{'file_id': f'photo{message["message_id"]}', 'file_unique_id': 'p',
+                                     'width': 1, 'height': 1}]
+            return message
+        if method == 'sendMediaGroup':
+            chat = {'id': int(params.get('chat_id', 0)), 'type': 'private'}
+            media = json.loads(params.get('media') or '[]')
+            return [self.make_message(chat, BOT_USER, photo=[{'file_id': f'photo{i}', 'file_unique_id': 'p',
+                                                              'width': 1, 'height': 1}])
+                    for i, _ in enumerate(media)]
+        # sendChatAction, setMyCommands, deleteWebhook and everything else
+        return True
+
+    def counts(self) -> dict:
+        """{method: number of requests}"""
+        result = {}
+        with self.cond:
+            for _, method, _ in self.requests:
+                result[method] = result.get(method, 0) + 1
+        return result
+
+
+class OpenAIHandler(JsonHandler):
+
+    def do_GET(self):
+        self.read_body()
+        fake = self.server.fake
+        path = urllib.parse.urlsplit(self.path).path
+        if path.endswith('/models'):
+            self.send_json({'object': 'list', 'data': [{'id': x, 'object': 'model'} for x in fake.models]})
+        elif path.startswith('/images/'):
+            self.send_bytes(PNG, 'image/png')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        fake = self.server.fake
+        try:
+            request = json.loads(self.read_body() or b'{}')
+        except ValueError:
+            self.send_error(400)
+            return
+        path = urllib.parse.urlsplit(self.path).path
+        if path.endswith('/chat/completions'):
+            fake.chat(self, request)
+        elif path.endswith('/images/generations'):
+            fake.images(self, request)
+        else:
+            self.send_error(404)
+
+
+class FakeOpenAI:
+    """OpenAI compatible API: /v1/chat/completions (with stream=true too), /v1/images/generations,
+    /v1/models.
+
+    latency - seconds before the answer (or before the first chunk of a stream), jitter - random
+    +-share of it, token_delay - seconds between stream chunks, answer_size - characters,
+    error_rate - share of requests answered with 500."""
+
+    def __init__(self, port: int = 0, latency: float = 1.0, jitter: float = 0.2, token_delay: float = 0.01,
+                 answer_size: int = 1500, image_latency: float = 3.0, error_rate: float = 0.0):
+        self.server = Server(port, OpenAIHandler)
+        self.server.fake = self
+        self.latency = latency
+        self.jitter = jitter
+        self.token_delay = token_delay
+        self.answer_size = answer_size
+        self.image_latency = image_latency
+        self.error_rate = error_rate
+        self.models = ['gpt-3.5-turbo', 'gpt-3.5-turbo-16k', 'gpt-4']
+        self.lock = threading.Lock()
+        self.counters = {'chat': 0, 'stream': 0, 'images': 0, 'errors': 0}
+        self.rnd = random.Random(1)
+
+    @property
+    def url(self) -> str:
+        return self.server.url + '/v1'
+
+    def start(self):
+        self.server.start()
+        return self
+
+    def stop(self):
+        self.server.stop()
+
+    def _count(self, name: str) -> None:
+        with self.lock:
+            self.counters[name] += 1
+
+    def _sleep(self, seconds: float) -> None:
+        with self.lock:
+            k = 1 + self.rnd.uniform(-self.jitter, self.jitter)
+        time.sleep(max(0.0, seconds * k))
+
+    def _failed(self, handler: OpenAIHandler) -> bool:
+        with self.lock:
+            failed = self.rnd.random() < self.error_rate
+        if failed:
+            self._count('errors')
+            handler.send_json({'error': {'message': 'The server had an error', 'type': 'server_error'}}, 500)
+        return failed
+
+    def chat(self, handler: OpenAIHandler, request: dict):
+        self._sleep(self.latency)
+        if self._failed(handler):
+            return
+        with self.lock:
+            text = make_answer(self.answer_size, self.rnd)
+        model = request.get('model', 'gpt-3.5-turbo')
+        prompt_tokens = sum(len(str(x.get('content', ''))) for x in request.get('messages', [])) // 4
+        if not request.get('stream'):
+            self._count('chat')
+            handler.send_json({
+                'id': 'chatcmpl-bench', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text},
+                             'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(text) // 4,
+                          'total_tokens': prompt_tokens + len(text) // 4}})
+            return
+
+        self._count('stream')
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.send_header('Transfer-Encoding', 'chunked')
+        handler.end_headers()
+
+        def chunk(data: str):
+            payload = f'data: {data}\n\n'.encode('utf-8')
+            handler.wfile.write(f'{len(payload):x}\r\n'.encode() + payload + b'\r\n')
+            handler.wfile.flush()
+
+        words = text.split(' ')
+        for i in range(0, len(words), 4):
+            piece = ' '.join(words[i:i + 4]) + ('' if i + 4 >= len(words) else ' ')
+            chunk(json.dumps({'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'model': model,
+                              'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}]}))
+            if self.token_delay:
+                time.sleep(self.token_delay)
+        chunk(json.dumps({'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'model': model,
+                          'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}))
+        chunk('[DONE]')
+        handler.wfile.write(b'0\r\n\r\n')
+
+    def images(self, handler: OpenAIHandler, request: dict):
+        self._sleep(self.image_latency)
+        if self._failed(handler):
+            return
+        self._count('images')
+        n = int(request.get('n') or 1)
+        handler.send_json({'created': int(time.time()),
+                           'data': [{'url': f'{self.server.url}/images/{random.random()}.png'} for _ in range(n)]})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--telegram-port', type=int, default=8081)
+    parser.add_argument('--openai-port', type=int, default=8082)
+    parser.add_argument('--latency', type=float, default=1.0)
+    parser.add_argument('--answer-size', type=int, default=1500)
+    args = parser.parse_args()
+
+    telegram = FakeTelegram(args.telegram_port).start()
+    openai = FakeOpenAI(args.openai_port, latency=args.latency, answer_size=args.answer_size).start()
+    print(f'telegram: {telegram.url}/bot{{0}}/{{1}}\nopenai:   {openai.url}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
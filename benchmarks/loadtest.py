@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+"""Load test of tb.py against the local fake Telegram and OpenAI servers.
+
+The bot runs in a subprocess from a temporary copy of the repository with a generated
+cfg.py and its own db/ and logs/, so nothing real is touched and no token is needed.
+The updates are generated (private chats, busy groups, voice, /image) or replayed from
+a file, the report has messages per second, reply latency percentiles, threads and memory
+of the bot process and the stage times from my_trace.
+
+python3 benchmarks/loadtest.py --scenario private --users 50 --count 500 --rate 20
+python3 benchmarks/loadtest.py --scenario mixed --latency 2 --json after.json --baseline before.json
+python3 benchmarks/loadtest.py --replay updates.jsonl --rate 10
+
+Replay file: one telegram update (or message) per line as json, update_id, message_id and
+date are replaced. Voice needs ffmpeg (the bot decodes audio with it), recognition itself is
+replaced with a fixed text after --stt-latency seconds, translation is off unless
+--real-translate, because both go to external services.
+"""
+
+
+import argparse
+import glob
+import json
+import os
+import pickle
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_servers
+
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TOKEN = '123456:BENCH'
+ADMIN_ID = 1
+CALL_WORD = 'bot,'
+
+# runs in the bot process: points telebot to the fake server and replaces external services
+BOOTSTRAP = r'''
+import sys, time
+import telebot
+telebot.apihelper.API_URL = sys.argv[1] + '/bot{0}/{1}'
+telebot.apihelper.FILE_URL = sys.argv[1] + '/file/bot{0}/{1}'
+if sys.argv[2] == '0':
+    import my_trans
+    my_trans.translate_text2 = lambda text, lang: text
+import my_stt
+class BenchEngine(my_stt.GoogleEngine):
+    name = 'bench'
+    def recognize(self, pcm, lang):
+        time.sleep(float(sys.argv[3]))
+        return 'what is the weather like today'
+my_stt._ENGINE = BenchEngine()
+import os
+if sys.argv[4] != '0' and not os.environ.get('BOT_SHARD'):
+    # the dispatcher of the sharded mode, it starts the workers with this script too
+    import my_shard
+    my_shard.WORKER_COMMAND = [sys.executable] + sys.argv
+    my_shard.main()
+else:
+    import tb
+    tb.main()
+'''
+
+QUESTIONS = ['how do I sort a list in python?', 'explain quantum entanglement simply',
+             'write a poem about the sea', 'what is the difference between tcp and udp?',
+             'give me a table of the planets', 'solve x^2 - 5x + 6 = 0']
+
+
+def make_cfg(folder: str, args) -> None:
+    with open(os.path.join(folder, 'cfg.py'), 'w', encoding='utf-8') as f:
+        f.write(f'''admins = [{ADMIN_ID},]
+token = {TOKEN!r}
+model = 'gpt-3.5-turbo-16k'
+max_hist_lines = 10
+max_hist_bytes = 8000
+max_hist_compressed = 1500
+max_hist_mem = 2500
+BOT_CALL_WORD = {CALL_WORD!r}
+bot_name = 'bench'
+bot_description = 'bench'
+bot_short_description = 'bench'
+''')
+        if args.metrics_port:
+            f.write(f'metrics_port = {args.metrics_port}\n')
+        if args.shards:
+            f.write(f'shards = {args.shards}\nshard_port = {free_port()}\n')
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def make_copy(args, openai_url: str, chat_ids: list) -> str:
+    """Temporary copy of the bot with cfg.py and keys for all the test chats"""
+    folder = tempfile.mkdtemp(prefix='bot-loadtest-')
+    for name in os.listdir(REPO):
+        if name.endswith('.py') and name != 'cfg.py':
+            shutil.copy(os.path.join(REPO, name), folder)
+    make_cfg(folder, args)
+    with open(os.path.join(folder, 'bench_bootstrap.py'), 'w', encoding='utf-8') as f:
+        f.write(BOOTSTRAP)
+    os.mkdir(os.path.join(folder, 'db'))
+    with open(os.path.join(folder, 'db', 'servers.pkl'), 'wb') as f:
+        pickle.dump({x: (openai_url, 'sk-bench', 'en') for x in chat_ids + [ADMIN_ID]}, f)
+    return folder
+
+
+def make_voice() -> bytes:
+    """3 seconds of ogg/opus or None without ffmpeg"""
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi',
+                                 '-i', 'sine=frequency=440:duration=3', '-c:a', 'libopus', '-f', 'ogg', 'pipe:1'],
+                                stdout=subprocess.PIPE, check=True)
+        return result.stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Workload:
+    """Generates updates of a scenario: private, group, voice, image or mixed.
+
+    Every generated message is (message, expects a reply)."""
+
+    def __init__(self, telegram: fake_servers.FakeTelegram, scenario: str, users: int, groups: int,
+                 voice: bytes = None, seed: int = 1):
+        self.telegram = telegram
+        self.scenario = scenario
+        self.rnd = random.Random(seed)
+        self.users = [{'id': 1000 + i, 'is_bot': False, 'first_name': f'user{i}', 'language_code': 'en'}
+                      for i in range(users)]
+        self.groups = [{'id': -1000 - i, 'type': 'supergroup', 'title': f'group{i}'} for i in range(groups)]
+        self.voice = voice
+        if voice:
+            telegram.files['files/voice'] = voice
+
+    @property
+    def chat_ids(self) -> list:
+        return [x['id'] for x in self.users] + [x['id'] for x in self.groups]
+
+    def private_chat(self, user: dict) -> dict:
+        return {'id': user['id'], 'type': 'private', 'first_name': user['first_name']}
+
+    def next(self) -> tuple:
+        scenario = self.scenario
+        if scenario == 'mixed':
+            kinds = ['private'] * 6 + ['group'] * 3 + ['image']
+            if self.voice:
+                kinds.append('voice')
+            scenario = self.rnd.choice(kinds)
+        user = self.rnd.choice(self.users)
+        question = self.rnd.choice(QUESTIONS)
+        if scenario == 'private':
+            return self.telegram.make_message(self.private_chat(user), user, question), True
+        if scenario == 'group':
+            # most of the chatter in a busy group is not for the bot
+            if self.rnd.random() < 0.5:
+                return self.telegram.make_message(self.rnd.choice(self.groups), user, question), False
+            return self.telegram.make_message(self.rnd.choice(self.groups), user, f'{CALL_WORD} {question}'), True
+        if scenario == 'image':
+            return self.telegram.make_message(self.private_chat(user), user, '/image a cat in space'), True
+        if scenario == 'voice':
+            return self.telegram.make_message(self.private_chat(user), user, None,
+                                              voice={'file_id': 'voice', 'file_unique_id': 'voice',
+                                                     'duration': 3, 'mime_type': 'audio/ogg',
+                                                     'file_size': len(self.voice)}), True
+        raise ValueError(f'Unknown scenario {scenario}')
+
+
+def read_replay(path: str, telegram: fake_servers.FakeTelegram) -> list:
+    """[(message, expects a reply)] from a file with recorded updates"""
+    result = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            message = record.get('message', record)
+            message = dict(message, message_id=next(telegram.message_ids), date=int(time.time()))
+            result.append((message, True))
+    return result
+
+
+class ProcessMonitor(threading.Thread):
+    """Samples threads and RSS of the process and its children (the workers of the sharded mode) from /proc"""
+
+    def __init__(self, pid: int, interval: float = 0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.running = True
+
+    def tree(self) -> list:
+        parents = {}
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                try:
+                    with open(f'/proc/{name}/stat') as f:
+                        # the name of the command is in brackets and can have spaces
+                        parents[int(name)] = int(f.read().rpartition(')')[2].split()[1])
+                except (OSError, ValueError, IndexError):
+                    pass
+        pids = [self.pid]
+        for pid in pids:
+            pids += [x for x, parent in parents.items() if parent == pid]
+        return pids
+
+    def sample(self):
+        values = {}
+        for pid in self.tree():
+            try:
+                with open(f'/proc/{pid}/status') as f:
+                    for line in f:
+                        name, _, value = line.partition(':')
+                        if name in ('Threads', 'VmRSS'):
+                            values[name] = values.get(name, 0) + int(value.split()[0])
+            except OSError:
+                if pid == self.pid:
+                    return None
+        return values
+
+    def run(self):
+        while self.running:
+            values = self.sample()
+            if values:
+                self.samples.append(values)
+            time.sleep(self.interval)
+
+    def summary(self) -> dict:
+        threads = [x.get('Threads', 0) for x in self.samples] or [0]
+        rss = [x.get('VmRSS', 0) for x in self.samples] or [0]
+        return {'threads_max': max(threads), 'threads_last': threads[-1],
+                'rss_max_mb': max(rss) / 1024, 'rss_last_mb': rss[-1] / 1024}
+
+
+def percentiles(values: list) -> dict:
+    values = sorted(values)
+    if not values:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    pick = lambda p: values[min(len(values) - 1, int(len(values) * p / 100))]
+    return {'p50': pick(50), 'p95': pick(95), 'p99': pick(99), 'max': values[-1]}
+
+
+def read_stages(folder: str) -> dict:
+    """Stage times from my_trace, in the sharded mode every worker has its own file and
+    the result is the worst of them for every percentile"""
+    stages = {}
+    for path in glob.glob(os.path.join(folder, 'logs', 'latency*.json')):
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)['stages']
+        except (OSError, ValueError, KeyError):
+            continue
+        for name, x in data.items():
+            if name not in stages:
+                stages[name] = dict(x)
+                continue
+            for key, value in x.items():
+                if key == 'count':
+                    stages[name][key] += value
+                elif key == 'min':
+                    stages[name][key] = min(stages[name][key], value)
+                else:
+                    stages[name][key] = max(stages[name][key], value)
+    return stages
+
+
+def run(args) -> dict:
+    telegram = fake_servers.FakeTelegram().start()
+    openai = fake_servers.FakeOpenAI(latency=args.latency, jitter=args.jitter, answer_size=args.answer_size,
+                                     image_latency=args.image_latency, error_rate=args.error_rate).start()
+
+    voice = None
+    if args.scenario in ('voice', 'mixed') and not args.replay:
+        voice = make_voice()
+        if voice is None:
+            if args.scenario == 'voice':
+                sys.exit('voice scenario needs ffmpeg')
+            print('no ffmpeg, mixed scenario runs without voice')
+    workload = Workload(telegram, args.scenario, args.users, args.groups, voice)
+    folder = make_copy(args, openai.url, workload.chat_ids)
+
+    launched = time.time()
+    process = subprocess.Popen([sys.executable, 'bench_bootstrap.py', telegram.url,
+                                '1' if args.real_translate else '0', str(args.stt_latency), str(args.shards)],
+                               cwd=folder, stdout=None if args.verbose else subprocess.DEVNULL,
+                               stderr=None if args.verbose else subprocess.DEVNULL)
+    monitor = ProcessMonitor(process.pid)
+    monitor.start()
+    try:
+        deadline = time.time() + 60
+        while not telegram.ready.wait(0.1):
+            if process.poll() is not None or time.time() > deadline:
+                raise RuntimeError('the bot did not start polling, see --verbose')
+        startup = time.time() - launched
+
+        if args.replay:
+            messages = read_replay(args.replay, telegram)
+        else:
+            messages = [workload.next() for _ in range(args.count)]
+        sent = []
+        start = time.time()
+        for i, (message, expects) in enumerate(messages):
+            # even pace, without drift
+            delay = start + i / args.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            telegram.add_message(message)
+            sent.append((time.time(), message, expects))
+        injected = time.time()
+
+        # wait until every message that expects an answer got one and the bot calmed down
+        expected = [(x['chat']['id'], x['message_id']) for _, x, e in sent if e]
+        deadline = time.time() + args.timeout
+        last_count = -1
+        while time.time() < deadline:
+            with telegram.cond:
+                answered = sum(1 for x in expected if x in telegram.replies)
+                count = len(telegram.requests)
+            if answered == len(expected) and count == last_count:
+                break
+            last_count = count
+            time.sleep(max(1.0, args.latency))
+        finish = time.time()
+    finally:
+        monitor.running = False
+        # /restart stops polling, the bot exits normally and saves its stats
+        telegram.add_message(telegram.make_message({'id': ADMIN_ID, 'type': 'private', 'first_name': 'admin'},
+                                                   {'id': ADMIN_ID, 'is_bot': False, 'first_name': 'admin'},
+                                                   '/restart'))
+        stopping = time.time()
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        shutdown = time.time() - stopping
+        telegram.stop()
+        openai.stop()
+
+    first = []
+    last = []
+    finished = []
+    for sent_at, message, expects in sent:
+        times = telegram.replies.get((message['chat']['id'], message['message_id']))
+        if expects and times:
+            first.append(times[0] - sent_at)
+            last.append(times[-1] - sent_at)
+            finished.append(times[-1])
+    stages = read_stages(folder)
+    if not args.keep:
+        shutil.rmtree(folder, ignore_errors=True)
+    else:
+        print(f'bot folder: {folder}')
+
+    duration = (max(finished) if finished else finish) - sent[0][0] if sent else 0
+    return {
+        'scenario': 'replay' if args.replay else args.scenario,
+        'updates': len(sent),
+        'expected': len(expected),
+        'answered': len(first),
+        'inject_seconds': injected - start,
+        'startup_seconds': startup,
+        'shutdown_seconds': shutdown,
+        'throughput': len(first) / duration if duration else 0.0,
+        'first_reply': percentiles(first),
+        'last_reply': percentiles(last),
+        'telegram': telegram.counts(),
+        'openai': dict(openai.counters),
+        'process': monitor.summary(),
+        'stages': stages,
+    }
+
+
+def print_report(result: dict, baseline: dict = None) -> None:
+    def delta(value, path):
+        if not baseline:
+            return ''
+        old = baseline
+        for key in path:
+            old = old.get(key, {}) if isinstance(old, dict) else {}
+        if not isinstance(old, (int, float)) or not old:
+            return ''
+        return f'  ({(value - old) / old * 100:+.0f}%)'
+
+    print(f'scenario      {result["scenario"]}')
+    print(f'updates       {result["updates"]} in {result["inject_seconds"]:.1f} s, '
+          f'{result["expected"]} expect a reply, {result["answered"]} answered')
+    print(f'startup       {result["startup_seconds"]:.2f} s until polling'
+          f'{delta(result["startup_seconds"], ["startup_seconds"])}')
+    print(f'shutdown      {result["shutdown_seconds"]:.2f} s after /restart'
+          f'{delta(result["shutdown_seconds"], ["shutdown_seconds"])}')
+    print(f'throughput    {result["throughput"]:.2f} msg/s{delta(result["throughput"], ["throughput"])}')
+    for name in ('first_reply', 'last_reply'):
+        x = result[name]
+        print(f'{name:<13} ' + '  '.join(f'{k} {v * 1000:.0f} ms{delta(v, [name, k])}' for k, v in x.items()))
+    process = result['process']
+    print(f'threads       max {process["threads_max"]}, at the end {process["threads_last"]}'
+          f'{delta(process["threads_max"], ["process", "threads_max"])}')
+    print(f'memory        max {process["rss_max_mb"]:.1f} MB, at the end {process["rss_last_mb"]:.1f} MB'
+          f'{delta(process["rss_max_mb"], ["process", "rss_max_mb"])}')
+    print('telegram      ' + ', '.join(f'{k} {v}' for k, v in sorted(result['telegram'].items())))
+    print('openai        ' + ', '.join(f'{k} {v}' for k, v in result['openai'].items()))
+    if result['stages']:
+        print(f'\n{"stage":<10} {"count":>7} {"p50, ms":>9} {"p95, ms":>9} {"p99, ms":>9}')
+        for name, x in result['stages'].items():
+            print(f'{name:<10} {x["count"]:>7} {x["p50"] * 1000:>9.1f} {x["p95"] * 1000:>9.1f} {x["p99"] * 1000:>9.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', default='private', choices=('private', 'group', 'voice', 'image', 'mixed'))
+    parser.add_argument('--replay', help='jsonl file with recorded updates instead of a scenario')
+    parser.add_argument('--count', type=int, default=200, help='updates to send')
+    parser.add_argument('--rate', type=float, default=10, help='updates per second')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--groups', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=1.0, help='upstream answer delay, seconds')
+    parser.add_argument('--jitter', type=float, default=0.2, help='random share of the delay')
+    parser.add_argument('--answer-size', type=int, default=1500, help='answer length, characters')
+    parser.add_argument('--image-latency', type=float, default=3.0)
+    parser.add_argument('--stt-latency', type=float, default=0.5)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of upstream requests that fail')
+    parser.add_argument('--timeout', type=float, default=120, help='how long to wait for the replies')
+    parser.add_argument('--real-translate', action='store_true')
+    parser.add_argument('--metrics-port', type=int, default=0, help='enable the metrics endpoint of the bot')
+    parser.add_argument('--shards', type=int, default=0, help='run the sharded mode (my_shard.py) with this many workers')
+    parser.add_argument('--json', help='save the result to this file')
+    parser.add_argument('--baseline', help='result of an earlier run to compare with')
+    parser.add_argument('--keep', action='store_true', help='keep the bot folder with logs and db')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the bot')
+    args = parser.parse_args()
+
+    result = run(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
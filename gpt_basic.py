@@ -1,67 +1,122 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import datetime
 import json
 import threading
-
-import openai
+import time
 
 import cfg
 import utils
 import my_dic
+import my_history
+import my_shard
 
 import my_log
+import my_metrics
+import my_trace
 import my_trans
 
 
-CUSTOM_MODELS = my_dic.PersistentDict('db/custom_models.pkl')
+# в шардированном режиме (my_shard.py) у каждого процесса свои файлы в db/shard-<n>/
+CUSTOM_MODELS = my_dic.PersistentDict(my_shard.path('db/custom_models.pkl'))
 
 # память диалогов {id:messages: list}
-CHATS = my_dic.PersistentDict('db/dialogs.pkl')
+# в памяти только недавние диалоги, в пределах cfg.chats_memory байт, остальные в sqlite
+# (длинные сжаты zlib), сами диалоги хранятся как my_history.History
+CHATS = my_dic.TieredDict(my_shard.path('db/dialogs.db'), getattr(cfg, 'chats_memory', 64 * 1024 * 1024),
+                          legacy_path=my_shard.path('db/dialogs.pkl'), compress_min=512)
 # системные промты для чатов, роли или инструкции что и как делать в этом чате
 # {id:prompt}
-PROMPTS = my_dic.PersistentDict('db/prompts.pkl')
+PROMPTS = my_dic.PersistentDict(my_shard.path('db/prompts.pkl'))
 # температура chatGPT {id:float(0-2)}
-TEMPERATURE = my_dic.PersistentDict('db/temperature.pkl')
+TEMPERATURE = my_dic.PersistentDict(my_shard.path('db/temperature.pkl'))
 # замки диалогов {id:lock}
 CHAT_LOCKS = {}
 
 # хранилище юзерских ключей и адресов
-# {id:(url, token, lang)}
-TOKENS = my_dic.PersistentDict('db/servers.pkl')
+# {id:(url, token, lang)}, общее для всех процессов шардированного режима,
+# там прочитанное помнится cfg.shared_cache_ttl секунд
+TOKENS = my_shard.shared('db/servers.pkl', ttl=getattr(cfg, 'shared_cache_ttl', 5))
+# если у юзера не указан свой адрес
+DEFAULT_URL = 'https://api.openai.com/v1'
+
+# картинки рисуются отдельными запросами по одной, параллельно, см. image_gen_iter
+IMAGE_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=getattr(cfg, 'image_workers', 32),
+                                                   thread_name_prefix='image')
+# сколько ждать картинки, секунд, не успевшие не показываются
+IMAGE_TIMEOUT = getattr(cfg, 'image_timeout', 60)
+# png, jpeg, webp, gif
+IMAGE_SIGNATURES = (b'\x89PNG', b'\xff\xd8\xff', b'RIFF', b'GIF8')
+# больше телеграм не примет как фото
+IMAGE_MAX_BYTES = 10 * 1024 * 1024
+
+
+def _server(chat_id, context = None) -> tuple:
+    """(адрес, ключ) openai для чата, из context если он есть, иначе из TOKENS,
+    ключ '' если его нет (чат без /key или запрос без chat_id)"""
+    if context:
+        return context.base_url, context.token
+    url, api_key = (TOKENS.get(chat_id) or (None, '', None))[:2]
+    return url or DEFAULT_URL, api_key or ''
+
+
+def _server_label(api_base: str) -> str:
+    """метка server для метрик, см. my_metrics.UPSTREAM_SECONDS"""
+    return 'default' if api_base == DEFAULT_URL else 'custom'
 
 
 def ai(prompt: str = '', temp: float = 0.1, max_tok: int = 2000, timeou: int = 120,
-       messages = None, chat_id = None, model_to_use: str = '') -> str:
+       messages = None, chat_id = None, model_to_use: str = '', context = None) -> str:
     """Сырой текстовый запрос к GPT чату, возвращает сырой ответ
+    context - my_context.RequestContext, адрес, ключ и модель берутся из него а не из хранилищ
     """
+    # openai грузится долго, импортируется при первом запросе а не при старте бота
+    import openai
 
     if messages == None:
         assert prompt != '', 'prompt не может быть пустым'
         messages = [{"role": "system", "content": "You are an artificial intelligence that responds to user requests in the Telegram messenger"},
                     {"role": "user", "content": prompt}]
+    elif isinstance(messages, my_history.History):
+        # история хранится компактно, словари для openai делаются только здесь
+        messages = messages.to_messages()
 
-    current_model = cfg.model
-    if chat_id and chat_id in CUSTOM_MODELS:
-        current_model = CUSTOM_MODELS[chat_id]
+    if context:
+        current_model = context.model
+    else:
+        current_model = CUSTOM_MODELS.get(chat_id, cfg.model) if chat_id else cfg.model
 
     # использовать указанную модель если есть
     current_model = current_model if not model_to_use else model_to_use
 
-    openai.api_base = TOKENS[chat_id][0] or 'https://api.openai.com/v1'
-    openai.api_key = TOKENS[chat_id][1]
+    api_base, api_key = _server(chat_id, context)
+    if not api_key:
+        # без ключа openai все равно откажет
+        return ''
 
     response = ''
+    usage = {}
+    error_text = None
+    start_time = time.perf_counter()
     try:
-        completion = openai.ChatCompletion.create(
-            model = current_model,
-            messages=messages,
-            max_tokens=max_tok,
-            temperature=temp,
-            timeout=timeou
-        )
+        with my_trace.span('upstream'):
+            completion = openai.ChatCompletion.create(
+                model = current_model,
+                messages=messages,
+                max_tokens=max_tok,
+                temperature=temp,
+                timeout=timeou,
+                # ключ и адрес передаются в запрос, глобальные openai.api_key/api_base
+                # общие для всех потоков и не трогаются
+                api_key=api_key,
+                api_base=api_base
+            )
         response = completion.choices[0].message.content
+        usage = completion.get('usage') or {}
     except Exception as unknown_error1:
+        error_text = str(unknown_error1)[:300]
+        my_metrics.UPSTREAM_ERRORS.inc(server=_server_label(api_base))
         if str(unknown_error1).startswith('HTTP code 200 from API'):
                 # ошибка парсера json?
                 text = str(unknown_error1)[24:]
@@ -75,7 +130,14 @@ def ai(prompt: str = '', temp: float = 0.1, max_tok: int = 2000, timeou: int = 1
         else:
             response = str(unknown_error1)
         print(unknown_error1)
-        my_log.log2(f'gpt_basic.ai: {unknown_error1}\n\nServer: {openai.api_base}')
+        my_log.log2(f'gpt_basic.ai: {unknown_error1}\n\nServer: {api_base}')
+
+    my_metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - start_time, server=_server_label(api_base))
+    my_log.log_event('upstream', chat_id=chat_id, model=current_model, base_url=api_base,
+                     latency=round(time.perf_counter() - start_time, 3),
+                     query_size=utils.count_tokens(messages), answer_size=len(response or ''),
+                     prompt_tokens=usage.get('prompt_tokens'), completion_tokens=usage.get('completion_tokens'),
+                     total_tokens=usage.get('total_tokens'), error=error_text)
 
     return response
 
@@ -88,26 +150,27 @@ def ai_compress(prompt: str, max_prompt: int  = 300, origin: str = 'user', force
     """
     assert origin in ('user', 'assistant', 'dialog')
     if len(prompt) > max_prompt or force:
-        try:
-            if origin == 'user':
-                compressed_prompt = ai(f'Сократи текст до {max_prompt} символов так что бы сохранить смысл и важные детали. \
+        with my_trace.span('compress'):
+            try:
+                if origin == 'user':
+                    compressed_prompt = ai(f'Сократи текст до {max_prompt} символов так что бы сохранить смысл и важные детали. \
 Этот текст является запросом юзера в переписке между юзером и ИИ. Используй короткие слова. Текст:\n{prompt}', max_tok = max_prompt)
-            elif origin == 'assistant':
-                compressed_prompt = ai(f'Сократи текст до {max_prompt} символов так что бы сохранить смысл и важные детали. \
+                elif origin == 'assistant':
+                    compressed_prompt = ai(f'Сократи текст до {max_prompt} символов так что бы сохранить смысл и важные детали. \
 Этот текст является ответом ИИ в переписке между юзером и ИИ. Используй короткие слова. Текст:\n{prompt}', max_tok = max_prompt)
-            elif origin == 'dialog':
-                compressed_prompt = ai(f'Резюмируй переписку между юзером и ассистентом до {max_prompt} символов, весь негативный контент исправь на нейтральный:\n{prompt}', max_tok = max_prompt)
-            if len(compressed_prompt) < len(prompt) or force:
-                return compressed_prompt
-        except Exception as error:
-            print(error)
-
-        if len(prompt) > max_prompt:
-            ziped = zip_text(prompt)
-            if len(ziped) <= max_prompt:
-                prompt = ziped
-            else:
-                prompt = prompt[:max_prompt]
+                elif origin == 'dialog':
+                    compressed_prompt = ai(f'Резюмируй переписку между юзером и ассистентом до {max_prompt} символов, весь негативный контент исправь на нейтральный:\n{prompt}', max_tok = max_prompt)
+                if compressed_prompt and (len(compressed_prompt) < len(prompt) or force):
+                    return compressed_prompt
+            except Exception as error:
+                print(error)
+
+            if len(prompt) > max_prompt:
+                ziped = zip_text(prompt)
+                if len(ziped) <= max_prompt:
+                    prompt = ziped
+                else:
+                    prompt = prompt[:max_prompt]
 
     return prompt
 
@@ -131,6 +194,74 @@ def zip_text(text: str) -> str:
     return new_text
 
 
+def _image_job(prompt: str, size: str, api_base: str, api_key: str, download: bool):
+    """одна картинка: (url, содержимое или None если не скачалась)"""
+    import openai
+
+    response = openai.Image.create(prompt=prompt, n=1, size=size, api_base=api_base, api_key=api_key)
+    url = response['data'][0]['url']
+    if not download:
+        return url, None
+    import requests
+    try:
+        response = requests.get(url, timeout=IMAGE_TIMEOUT)
+        response.raise_for_status()
+    except Exception as error:
+        # телеграм может скачать ее сам
+        my_log.log2(f'gpt_basic:image_gen: download {url}: {error}')
+        return url, None
+    data = response.content
+    if not data.startswith(IMAGE_SIGNATURES) or len(data) > IMAGE_MAX_BYTES:
+        raise ValueError(f'not an image or too big, {len(data)} bytes: {url}')
+    return url, data
+
+
+def image_gen_iter(prompt: str, chat_id: str, amount: int = 4, size: str = '1024x1024',
+                   download: bool = True, timeout: float = None, context = None):
+    """
+    Generates images by separate requests of one image each, all at the same time, and yields
+    them as they are ready, so the first ones can be shown before the slowest is done.
+
+    Parameters:
+        - prompt (str): The text prompt used to generate the images.
+        - amount (int, optional): The number of images to generate. Defaults to 4.
+        - size (str, optional): '1024x1024', '512x512' or '256x256'.
+        - download (bool, optional): Download and check the images too.
+        - timeout (float, optional): Seconds to wait, the images that are not ready by then are dropped.
+          Defaults to cfg.image_timeout or 60.
+        - context (my_context.RequestContext, optional): The url and the key are taken from it.
+
+    Yields:
+        - tuple: (url, bytes of the image or None, seconds since the start)
+    """
+    assert amount <= 10, 'Too many images to gen'
+    assert size in ('1024x1024','512x512','256x256'), 'Wrong image size'
+
+    api_base, api_key = _server(chat_id, context)
+    if not api_key:
+        return
+    start_time = time.perf_counter()
+    futures = [IMAGE_POOL.submit(_image_job, prompt, size, api_base, api_key, download) for _ in range(amount)]
+    try:
+        for future in concurrent.futures.as_completed(futures, timeout or IMAGE_TIMEOUT):
+            seconds = time.perf_counter() - start_time
+            my_metrics.IMAGE_SECONDS.observe(seconds, server=_server_label(api_base))
+            try:
+                url, data = future.result()
+            except Exception as error:
+                print(error)
+                my_log.log2(f'gpt_basic:image_gen: {error}\n\nServer: {api_base}')
+                my_metrics.UPSTREAM_ERRORS.inc(server=_server_label(api_base))
+                continue
+            yield url, data, seconds
+    except concurrent.futures.TimeoutError:
+        my_log.log2(f'gpt_basic:image_gen: {sum(not x.done() for x in futures)} of {amount} images '
+                    f'were not ready in time\n\nServer: {api_base}')
+    finally:
+        for future in futures:
+            future.cancel()
+
+
 def image_gen(prompt: str, chat_id: str, amount: int = 10, size: str ='1024x1024'):
     """
     Generates a specified number of images based on a given prompt.
@@ -143,53 +274,33 @@ def image_gen(prompt: str, chat_id: str, amount: int = 10, size: str ='1024x1024
     Returns:
         - list: A list of URLs pointing to the generated images.
     """
-
-    openai.api_base = TOKENS[chat_id][0] or 'https://api.openai.com/v1'
-    openai.api_key = TOKENS[chat_id][1]
-
-    assert amount <= 10, 'Too many images to gen'
-    assert size in ('1024x1024','512x512','256x256'), 'Wrong image size'
-
-    results = []
-
-    try:
-        response = openai.Image.create(
-            prompt = prompt,
-            n = amount,
-            size=size,
-        )
-        if response:
-            results += [x['url'] for x in response["data"]]
-    except AttributeError:
-        pass
-    except Exception as error:
-        print(error)
-        my_log.log2(f'gpt_basic:image_gen: {error}\n\nServer: {server[0]}')
-
-    return results
+    return [url for url, _, _ in image_gen_iter(prompt, chat_id, amount, size, download=False)]
 
 
-def get_list_of_models(chat_id: str):
+def get_list_of_models(chat_id: str, context = None):
     """
     Retrieves a list of models from the OpenAI servers.
 
+    Parameters:
+        - context (my_context.RequestContext, optional): The url and the key are taken from it.
+
     Returns:
         list: A list of model IDs.
     """
-    openai.api_base = TOKENS[chat_id][0] or 'https://api.openai.com/v1'
-    openai.api_key = TOKENS[chat_id][1]
+    import openai
+    api_base, api_key = _server(chat_id, context)
 
     result = []
+    if not api_key:
+        return result
 
-    openai.api_base = TOKENS[chat_id][0] or 'https://api.openai.com/v1'
-    openai.api_key = TOKENS[chat_id][1]
     try:
-        model_lst = openai.Model.list()
+        model_lst = openai.Model.list(api_key=api_key, api_base=api_base)
         for i in model_lst['data']:
             result += [i['id'],]
     except Exception as error:
         print(error)
-        my_log.log2(f'gpt_basic:get_list_of_models: {error}\n\nServer: {openai.api_base[0]}')
+        my_log.log2(f'gpt_basic:get_list_of_models: {error}\n\nServer: {api_base}')
 
     return sorted(list(set(result)))
 
@@ -198,11 +309,12 @@ def tr(text: str, lang: str = 'ru') -> str:
     """
     Translates text from one language to another.
     """
-    return my_trans.translate_text2(text, lang)
+    with my_trace.span('translate'):
+        return my_trans.translate_text2(text, lang)
 
 
 def chat(chat_id: str, query: str, user_name: str = 'noname', lang: str = 'ru',
-         is_private: bool = True, chat_name: str = 'noname chat') -> str:
+         is_private: bool = True, chat_name: str = 'noname chat', context = None) -> str:
     """
     The chat function is responsible for handling user queries and generating responses
     using the ChatGPT model.
@@ -214,31 +326,35 @@ def chat(chat_id: str, query: str, user_name: str = 'noname', lang: str = 'ru',
     - lang: str, the language of the chat (default: 'ru')
     - is_private: bool, indicates whether the chat is private or not (default: True)
     - chat_name: str, the name of the chat (default: 'noname chat')
+    - context: my_context.RequestContext, settings of the chat already read for this update,
+      without it they are read from the stores
 
     Returns:
     - str, the response generated by the ChatGPT model
     """
+    import openai
     if chat_id in CHAT_LOCKS:
         lock = CHAT_LOCKS[chat_id]
     else:
         lock = threading.Lock()
         CHAT_LOCKS[chat_id] = lock
 
-    with lock:
+    with my_trace.locked(lock):
         # в каждом чате своя история диалога бота с юзером
         if chat_id in CHATS:
-            messages = CHATS[chat_id]
+            messages = my_history.History.of(CHATS[chat_id])
         else:
-            messages = []
+            messages = my_history.History()
         # теперь ее надо почистить что бы влезла в запрос к GPT
         # просто удаляем все кроме max_hist_lines последних
-        if len(messages) > cfg.max_hist_lines:
-            messages = messages[cfg.max_hist_lines:]
-        # удаляем первую запись в истории до тех пор пока общее количество токенов не
-        # станет меньше cfg.max_hist_bytes
-        # удаляем по 2 сразу так как первая - промпт для бота
-        while utils.count_tokens(messages) > cfg.max_hist_bytes:
-            messages = messages[2:]
+        with my_trace.span('history'):
+            if len(messages) > cfg.max_hist_lines:
+                messages = messages[cfg.max_hist_lines:]
+            # удаляем первую запись в истории до тех пор пока общее количество токенов не
+            # станет меньше cfg.max_hist_bytes
+            # удаляем по 2 сразу так как первая - промпт для бота
+            while utils.count_tokens(messages) > cfg.max_hist_bytes:
+                messages = messages[2:]
         # добавляем в историю новый запрос и отправляем
         messages = messages + [{"role":    "user",
                                 "content": query}]
@@ -246,10 +362,10 @@ def chat(chat_id: str, query: str, user_name: str = 'noname', lang: str = 'ru',
         formatted_date = datetime.datetime.now().strftime("%d %B %Y %H:%M")
 
         # в каждом чате своя температура
-        if chat_id in TEMPERATURE:
-            temp = TEMPERATURE[chat_id]
+        if context:
+            temp = context.temperature
         else:
-            temp = 1
+            temp = TEMPERATURE.get(chat_id, 1)
 
         # в каждом чате свой собственный промт
         curr_place = tr('приватный телеграм чат', lang) if is_private else \
@@ -260,9 +376,8 @@ tr('публичный телеграм чат', lang)
 {tr("ты находишься в ", lang)} {curr_place} \
 {tr("и отвечаешь пользователю с ником", lang)} "{user_name}", \
 {tr("локаль пользователя: ", lang)} "{lang}"'
-        if chat_id in PROMPTS:
-            current_prompt = PROMPTS[chat_id]
-        else:
+        current_prompt = context.prompt if context else PROMPTS.get(chat_id)
+        if current_prompt is None:
             # по умолчанию формальный стиль
             PROMPTS[chat_id] = [{"role": "system",
                                  "content": tr(utils.gpt_start_message1, lang)}]
@@ -274,7 +389,7 @@ tr('публичный телеграм чат', lang)
         resp = ''
         try:
             resp = ai(prompt = '', temp = temp, messages = current_prompt + messages,
-                      chat_id=chat_id)
+                      chat_id=chat_id, context=context)
             if resp:
                 messages = messages + [{"role":    "assistant",
                                         "content": resp}]
@@ -283,7 +398,7 @@ tr('публичный телеграм чат', lang)
                 # если в последнем сообщении нет текста (глюк) то убираем его
                 if messages[-1]['content'].strip() == '':
                     messages = messages[:-1]
-                CHATS[chat_id] = messages or []
+                CHATS[chat_id] = messages
                 return tr('ChatGPT не ответил.', lang)
         # бот не ответил или обиделся
         except AttributeError:
@@ -305,7 +420,7 @@ tr('публичный телеграм чат', lang)
                 try:
                     resp = ai(prompt = '', temp=temp,
                               messages = current_prompt + messages,
-                              chat_id=chat_id)
+                              chat_id=chat_id, context=context)
                 except Exception as error3:
                     print(error3)
                     return tr('ChatGPT не ответил.', lang)
@@ -341,7 +456,7 @@ tr('публичный телеграм чат', lang)
         else:
             messages += [{"role":    "assistant",
                           "content": resp}]
-        CHATS[chat_id] = messages or []
+        CHATS[chat_id] = messages
 
         return resp or tr('ChatGPT не ответил.', lang)
 
@@ -357,7 +472,7 @@ def chat_reset(chat_id: str):
         None
     """
     if chat_id in CHATS:
-        CHATS[chat_id] = []
+        CHATS[chat_id] = my_history.History()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Who sent an update and the settings of their chat, read once per update.
+
+The handlers used to work out the ids and look up DB[user_id] on their own, often twice,
+and gpt_basic read TOKENS, CUSTOM_MODELS, TEMPERATURE and PROMPTS again for the request.
+In the sharded mode every such read is a sqlite query and a pickle. A handler makes
+of(message) at the start and passes the context down: to gpt_basic.chat, ai, image_gen_iter.
+
+The settings are those of the dialog: of the user in a private chat, of the chat in a group
+(there they are copied with /key copy). The context is a snapshot, the commands that change
+the settings write to the stores as before.
+"""
+
+
+import cfg
+import gpt_basic
+
+
+class RequestContext:
+    """Resolved sender and settings of an update, see of()"""
+
+    __slots__ = ('id', 'from_id', 'chat_id', 'is_private', 'registered', 'lang', 'url', 'token',
+                 'model', 'temperature', 'prompt')
+
+    def __init__(self, id: int, from_id: int, chat_id: int, is_private: bool, registered: bool,
+                 lang: str, url: str, token: str, model: str, temperature: float, prompt: list):
+        # id of the dialog and its settings: the user in a private chat, the chat in a group
+        self.id = id
+        # the user who sent the message
+        self.from_id = from_id
+        self.chat_id = chat_id
+        self.is_private = is_private
+        # there is a record in TOKENS, maybe without a key
+        self.registered = registered
+        self.lang = lang
+        # openai url of the user, None - the default one
+        self.url = url
+        # '' if there is no key
+        self.token = token
+        self.model = model
+        self.temperature = temperature
+        # system prompt of the chat, None - not set yet (gpt_basic.chat sets the default one)
+        self.prompt = prompt
+
+    @property
+    def base_url(self) -> str:
+        return self.url or gpt_basic.DEFAULT_URL
+
+    @property
+    def has_key(self) -> bool:
+        return bool(self.token)
+
+    def __repr__(self) -> str:
+        return f'RequestContext(id={self.id}, from_id={self.from_id}, lang={self.lang!r}, model={self.model!r})'
+
+
+def of(message) -> RequestContext:
+    """Context of a telegram message, TOKENS and the stores of the chat are read once here"""
+    from_id = message.from_user.id
+    chat_id = message.chat.id
+    is_private = message.chat.type == 'private'
+    id = from_id if is_private else chat_id
+
+    settings = gpt_basic.TOKENS.get(id)
+    if settings:
+        url, token, lang = settings
+    else:
+        url, token, lang = None, '', None
+
+    return RequestContext(id, from_id, chat_id, is_private, settings is not None,
+                          lang or message.from_user.language_code or 'en', url, token or '',
+                          gpt_basic.CUSTOM_MODELS.get(id, cfg.model),
+                          gpt_basic.TEMPERATURE.get(id, 1),
+                          gpt_basic.PROMPTS.get(id))
+
+
+if __name__ == '__main__':
+    pass
@@ -1,76 +1,436 @@
 #!/usr/bin/env python3
 
 
+import collections
+import collections.abc
+import os
 import pickle
+import sqlite3
 import threading
+import time
+import zlib
 from pprint import pprint
 
 import my_log
+import my_metrics
 
 
 class PersistentDict(dict):
     """Словарь который хранит состояние в файле на диске, данные сохраняются между
-    перезапусками программы"""
+    перезапусками программы.
+
+    Файл читается при первом обращении к словарю а не при создании, так бот
+    стартует быстрее и не грузит словари которые не понадобятся."""
     def __init__(self, file_path):
         self.lock = threading.Lock()
         self.file_path = file_path
-        try:
-            with open(self.file_path, 'rb') as f:
-                try:
-                    data = pickle.load(f)
-                except Exception as error:
-                    print(error, 'Empty message history')
-                    my_log.log2(f'my_dic:init:{str(error)}')
-                    data = []
-            self.update(data)
-        except FileNotFoundError:
-            pass
+        self.loaded = False
 
-    def __setitem__(self, key, value):
-        super().__setitem__(key, value)
+    def _load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            try:
+                with open(self.file_path, 'rb') as f:
+                    try:
+                        data = pickle.load(f)
+                    except Exception as error:
+                        print(error, 'Empty message history')
+                        my_log.log2(f'my_dic:init:{str(error)}')
+                        data = []
+                dict.update(self, data)
+            except FileNotFoundError:
+                pass
+            self.loaded = True
+
+    def _save(self):
+        """пишет весь словарь в файл, время и размер попадают в метрики"""
+        start_time = time.perf_counter()
         with self.lock:
             with open(self.file_path, 'wb') as f:
                 pickle.dump(dict(self), f)
+                size = f.tell()
+        my_metrics.DICT_FLUSH_SECONDS.observe(time.perf_counter() - start_time, file=self.file_path)
+        my_metrics.DICT_BYTES.set(size, file=self.file_path)
+
+    def __getitem__(self, key):
+        if not self.loaded:
+            self._load()
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        if not self.loaded:
+            self._load()
+        return super().__contains__(key)
+
+    def __iter__(self):
+        if not self.loaded:
+            self._load()
+        return super().__iter__()
+
+    def __len__(self):
+        if not self.loaded:
+            self._load()
+        return super().__len__()
+
+    def __repr__(self):
+        if not self.loaded:
+            self._load()
+        return super().__repr__()
+
+    def get(self, key, default=None):
+        if not self.loaded:
+            self._load()
+        return super().get(key, default)
+
+    def keys(self):
+        if not self.loaded:
+            self._load()
+        return super().keys()
+
+    def values(self):
+        if not self.loaded:
+            self._load()
+        return super().values()
+
+    def items(self):
+        if not self.loaded:
+            self._load()
+        return super().items()
+
+    def copy(self):
+        if not self.loaded:
+            self._load()
+        return super().copy()
+
+    def __setitem__(self, key, value):
+        if not self.loaded:
+            self._load()
+        super().__setitem__(key, value)
+        self._save()
 
     def __delitem__(self, key):
+        if not self.loaded:
+            self._load()
         super().__delitem__(key)
-        with self.lock:
-            with open(self.file_path, 'wb') as f:
-                pickle.dump(dict(self), f)
+        self._save()
 
     def clear(self):
+        if not self.loaded:
+            self._load()
         super().clear()
-        with self.lock:
-            with open(self.file_path, 'wb') as f:
-                pickle.dump(dict(self), f)
+        self._save()
 
     def pop(self, key, default=None):
+        if not self.loaded:
+            self._load()
         value = super().pop(key, default)
-        with self.lock:
-            with open(self.file_path, 'wb') as f:
-                pickle.dump(dict(self), f)
+        self._save()
         return value
 
     def popitem(self):
+        if not self.loaded:
+            self._load()
         item = super().popitem()
-        with self.lock:
-            with open(self.file_path, 'rb') as f:
-                pickle.dump(dict(self), f)
+        self._save()
         return item
 
     def setdefault(self, key, default=None):
+        if not self.loaded:
+            self._load()
         value = super().setdefault(key, default)
-        with self.lock:
-            with open(self.file_path, 'wb') as f:
-                pickle.dump(dict(self), f)
+        self._save()
         return value
 
     def update(self, E=None, **F):
-        super().update(E, **F)
+        if not self.loaded:
+            self._load()
+        super().update(E or {}, **F)
+        self._save()
+
+
+class SqliteDict(collections.abc.MutableMapping):
+    """Словарь в sqlite файле, значения хранятся в pickle по одному на строку, так что
+    запись одного ключа не переписывает весь файл как в PersistentDict.
+    Ключи - то что можно положить в pickle и сравнить: числа, строки, кортежи.
+    compress_min - значения длиннее стольких байт сжимаются zlib. legacy_path - старый
+    PersistentDict, его данные переносятся в sqlite при создании файла.
+    Файл можно открыть из нескольких процессов сразу (см. my_shard.py).
+
+    Файл открывается при первом обращении а не при создании, как в PersistentDict: словари
+    создаются при импорте, до того как бот перешел в свою папку (tb.py делает os.chdir)."""
+
+    def __init__(self, file_path: str, compress_min: int = None, legacy_path: str = None):
+        self.file_path = file_path
+        self.compress_min = compress_min
+        self.legacy_path = legacy_path
+        # RLock потому что перенос старых данных при открытии пишет под уже взятым замком
+        self.lock = threading.RLock()
+        self._db = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.connect()
+        return self._db
+
+    def connect(self) -> None:
+        """Открывает файл сейчас, создает папку и таблицу если их нет и переносит legacy_path"""
         with self.lock:
-            with open(self.file_path, 'wb') as f:
-                pickle.dump(dict(self), f)
+            if self._db is not None:
+                return
+            os.makedirs(os.path.dirname(self.file_path) or '.', exist_ok=True)
+            new = not os.path.exists(self.file_path)
+            db = sqlite3.connect(self.file_path, check_same_thread=False, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS items (key BLOB PRIMARY KEY, value BLOB NOT NULL)')
+            self._db = db
+            if new and self.legacy_path and os.path.exists(self.legacy_path):
+                self._migrate(self.legacy_path)
+
+    def _migrate(self, legacy_path: str) -> None:
+        try:
+            with open(legacy_path, 'rb') as f:
+                data = pickle.load(f)
+            count = self.import_items(data.items())
+            os.replace(legacy_path, legacy_path + '.migrated')
+            my_log.log2(f'my_dic:migrate: {legacy_path} -> {self.file_path}, {count} items')
+        except Exception as error:
+            print(error)
+            my_log.log2(f'my_dic:migrate: {legacy_path}: {error}')
+
+    @staticmethod
+    def _key(key) -> bytes:
+        return pickle.dumps(key, protocol=4)
+
+    def get_blob(self, key):
+        """pickle значения или None если ключа нет"""
+        with self.lock:
+            row = self.db.execute('SELECT value FROM items WHERE key = ?', (self._key(key),)).fetchone()
+        if row is None:
+            return None
+        # pickle начинается с 0x80, zlib с 0x78
+        return zlib.decompress(row[0]) if row[0][:1] == b'\x78' else row[0]
+
+    def set_blob(self, key, blob: bytes) -> None:
+        start_time = time.perf_counter()
+        if self.compress_min is not None and len(blob) > self.compress_min:
+            blob = zlib.compress(blob)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO items (key, value) VALUES (?, ?)', (self._key(key), blob))
+        my_metrics.DICT_FLUSH_SECONDS.observe(time.perf_counter() - start_time, file=self.file_path)
+
+    def __getitem__(self, key):
+        blob = self.get_blob(key)
+        if blob is None:
+            raise KeyError(key)
+        return pickle.loads(blob)
+
+    def __setitem__(self, key, value):
+        self.set_blob(key, pickle.dumps(value, protocol=4))
+
+    def __delitem__(self, key):
+        with self.lock:
+            deleted = self.db.execute('DELETE FROM items WHERE key = ?', (self._key(key),)).rowcount
+        if not deleted:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM items WHERE key = ?', (self._key(key),)).fetchone() is not None
+
+    def __iter__(self):
+        with self.lock:
+            keys = [x[0] for x in self.db.execute('SELECT key FROM items')]
+        return (pickle.loads(x) for x in keys)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+
+    def import_items(self, items) -> int:
+        """Записывает много пар (key, value) одной транзакцией, возвращает их количество"""
+        rows = []
+        for k, v in items:
+            blob = pickle.dumps(v, protocol=4)
+            if self.compress_min is not None and len(blob) > self.compress_min:
+                blob = zlib.compress(blob)
+            rows.append((self._key(k), blob))
+        return self.import_rows(rows)
+
+    def rows(self) -> list:
+        """[(pickle ключа, значение как оно лежит в файле)] для копирования в другой SqliteDict"""
+        with self.lock:
+            return self.db.execute('SELECT key, value FROM items').fetchall()
+
+    def import_rows(self, rows) -> int:
+        """Записывает строки из rows() одной транзакцией, возвращает их количество"""
+        rows = list(rows)
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR REPLACE INTO items (key, value) VALUES (?, ?)', rows)
+            self.db.execute('COMMIT')
+        return len(rows)
+
+    def close(self) -> None:
+        with self.lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class TieredDict(collections.abc.MutableMapping):
+    """Словарь для больших данных вроде истории диалогов: недавно использованные значения
+    лежат в памяти (LRU), все остальные только на диске в SqliteDict и загружаются при
+    обращении. Запись сразу идет на диск, так что вытеснение из памяти ничего не стоит.
+
+    memory_budget - сколько байт (в pickle) держать в памяти, реальная память процесса
+    больше в несколько раз. legacy_path - старый PersistentDict, его данные переносятся
+    в sqlite при первом запуске. compress_min - см. SqliteDict, в памяти значения не сжаты.
+
+    Значения надо сохранять присваиванием, d[key] = value, изменения списка на месте
+    на диск не попадут."""
+
+    def __init__(self, file_path: str, memory_budget: int, legacy_path: str = None,
+                 compress_min: int = None):
+        self.store = SqliteDict(file_path, compress_min, legacy_path)
+        self.name = os.path.basename(file_path)
+        self.memory_budget = memory_budget
+        self.lock = threading.Lock()
+        # {key: (value, size)}, последние использованные в конце
+        self.hot = collections.OrderedDict()
+        self.hot_bytes = 0
+
+    def _remember(self, key, value, size: int) -> None:
+        """Кладет значение в память и вытесняет самые старые если бюджет превышен, под self.lock"""
+        if key in self.hot:
+            self.hot_bytes -= self.hot.pop(key)[1]
+        self.hot[key] = (value, size)
+        self.hot_bytes += size
+        evicted = 0
+        while self.hot_bytes > self.memory_budget and len(self.hot) > 1:
+            _, (_, old_size) = self.hot.popitem(last=False)
+            self.hot_bytes -= old_size
+            evicted += 1
+        if evicted:
+            my_metrics.STORE_EVICTIONS.inc(evicted, store=self.name)
+        my_metrics.STORE_HOT_BYTES.set(self.hot_bytes, store=self.name)
+        my_metrics.STORE_HOT_ITEMS.set(len(self.hot), store=self.name)
+
+    def _lookup(self, key):
+        """(value, True) или (None, False) если ключа нет"""
+        with self.lock:
+            item = self.hot.get(key)
+            if item is not None:
+                self.hot.move_to_end(key)
+        if item is not None:
+            my_metrics.STORE_LOOKUPS.inc(store=self.name, result='hit')
+            return item[0], True
+        my_metrics.STORE_LOOKUPS.inc(store=self.name, result='miss')
+        blob = self.store.get_blob(key)
+        if blob is None:
+            return None, False
+        value = pickle.loads(blob)
+        with self.lock:
+            self._remember(key, value, len(blob))
+        return value, True
+
+    def __getitem__(self, key):
+        value, found = self._lookup(key)
+        if not found:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        # обычно за проверкой сразу идет чтение, так что значение загружается в память
+        return self._lookup(key)[1]
+
+    def __setitem__(self, key, value):
+        blob = pickle.dumps(value, protocol=4)
+        self.store.set_blob(key, blob)
+        with self.lock:
+            self._remember(key, value, len(blob))
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key in self.hot:
+                self.hot_bytes -= self.hot.pop(key)[1]
+        del self.store[key]
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
+
+
+class CachedDict(collections.abc.MutableMapping):
+    """Read-through кэш в памяти над словарем который пишут и другие процессы (SqliteDict
+    в шардированном режиме), для мелких часто читаемых данных вроде ключей юзеров.
+
+    Значение (и отсутствие ключа) запоминается на ttl секунд, потом читается из store
+    заново, так изменения сделанные другими процессами видны не позже чем через ttl.
+    Свои изменения пишутся сразу в store и в кэш. max_items - больше стольких ключей
+    кэш очищается целиком."""
+
+    _MISSING = object()
+
+    def __init__(self, store, ttl: float, name: str = 'cache', max_items: int = 100000):
+        self.store = store
+        self.ttl = ttl
+        self.name = name
+        self.max_items = max_items
+        self.lock = threading.Lock()
+        # {key: (value или _MISSING, time.monotonic() когда прочитано)}
+        self.cache = {}
+
+    def _lookup(self, key):
+        """значение или _MISSING"""
+        item = self.cache.get(key)
+        if item is not None and time.monotonic() - item[1] < self.ttl:
+            my_metrics.STORE_LOOKUPS.inc(store=self.name, result='hit')
+            return item[0]
+        my_metrics.STORE_LOOKUPS.inc(store=self.name, result='miss')
+        # под замком что бы прочитанное старое значение не затерло записанное в это время новое
+        with self.lock:
+            try:
+                value = self.store[key]
+            except KeyError:
+                value = self._MISSING
+            self._remember(key, value)
+        return value
+
+    def _remember(self, key, value) -> None:
+        """под self.lock"""
+        if len(self.cache) >= self.max_items:
+            self.cache.clear()
+        self.cache[key] = (value, time.monotonic())
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is self._MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self._lookup(key) is not self._MISSING
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.store[key] = value
+            self._remember(key, value)
+
+    def __delitem__(self, key):
+        with self.lock:
+            self.cache.pop(key, None)
+            del self.store[key]
+
+    def __iter__(self):
+        return iter(self.store)
 
+    def __len__(self):
+        return len(self.store)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""Queries the structured event log written by my_log.log_event.
+
+./my_events.py --chat 123 --since 2026-10-01
+./my_events.py --event message --since "2026-10-18 12:00" --top chat_id
+./my_events.py --event upstream --top user_id --sort tokens
+"""
+
+
+import argparse
+import datetime
+import glob
+import gzip
+import json
+import os
+
+import my_log
+
+
+def parse_time(text: str) -> float:
+    """'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM[:SS]' in local time to a timestamp"""
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(text, fmt).timestamp()
+        except ValueError:
+            pass
+    raise ValueError(f'Wrong time: {text}')
+
+
+def event_files(folder: str = my_log.EVENTS_DIR, since: float = None, until: float = None) -> list:
+    """Daily files for the time range, plain and compressed, the oldest first"""
+    result = []
+    for path in glob.glob(os.path.join(folder, 'events-*.jsonl*')):
+        day = os.path.basename(path)[7:17]
+        try:
+            start = datetime.datetime.strptime(day, '%Y-%m-%d').timestamp()
+        except ValueError:
+            continue
+        if since is not None and start + 86400 <= since:
+            continue
+        if until is not None and start > until:
+            continue
+        result.append((day, path))
+    return [path for _, path in sorted(result)]
+
+
+def read_events(folder: str = my_log.EVENTS_DIR, chat_id=None, user_id=None, event: str = None,
+                since: float = None, until: float = None):
+    """
+    Iterates over the events matching all the given conditions.
+
+    Args:
+        folder (str): The folder with the daily files.
+        chat_id, user_id: Only events of this chat or user.
+        event (str): Only events of this type.
+        since, until (float): Time range, timestamps.
+
+    Yields:
+        dict: The events in the order they were written.
+    """
+    for path in event_files(folder, since, until):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line may be not written to the end yet
+                    continue
+                if since is not None and record['ts'] < since:
+                    continue
+                if until is not None and record['ts'] > until:
+                    continue
+                if event is not None and record.get('event') != event:
+                    continue
+                if chat_id is not None and str(record.get('chat_id')) != str(chat_id):
+                    continue
+                if user_id is not None and str(record.get('user_id')) != str(user_id):
+                    continue
+                yield record
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summary(records, key: str) -> list:
+    """Groups events by key (chat_id, user_id, model...): count, latency percentiles, tokens, bytes"""
+    groups = {}
+    for record in records:
+        group = groups.setdefault(record.get(key), {'count': 0, 'latency': [], 'tokens': 0, 'size': 0})
+        group['count'] += 1
+        if isinstance(record.get('latency'), (int, float)):
+            group['latency'].append(record['latency'])
+        group['tokens'] += record.get('total_tokens') or 0
+        group['size'] += (record.get('query_size') or 0) + (record.get('answer_size') or 0) + \
+                         (record.get('size') or 0)
+    result = []
+    for name, group in groups.items():
+        latency = group['latency']
+        result.append({key: name, 'count': group['count'],
+                       'latency_avg': sum(latency) / len(latency) if latency else 0.0,
+                       'latency_p95': percentile(latency, 95),
+                       'tokens': group['tokens'], 'size': group['size']})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--folder', default=my_log.EVENTS_DIR)
+    parser.add_argument('--chat', help='chat_id')
+    parser.add_argument('--user', help='user_id')
+    parser.add_argument('--event', help='event type: message, upstream, voice, tts, image')
+    parser.add_argument('--since', help='YYYY-MM-DD [HH:MM[:SS]]')
+    parser.add_argument('--until', help='YYYY-MM-DD [HH:MM[:SS]]')
+    parser.add_argument('--top', metavar='FIELD', help='group by the field, like chat_id or user_id')
+    parser.add_argument('--sort', default='latency_p95',
+                        choices=('count', 'latency_avg', 'latency_p95', 'tokens', 'size'))
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    records = read_events(args.folder, args.chat, args.user, args.event,
+                          parse_time(args.since) if args.since else None,
+                          parse_time(args.until) if args.until else None)
+
+    if not args.top:
+        for record in records:
+            print(json.dumps(record, ensure_ascii=False))
+        return
+
+    rows = sorted(summary(records, args.top), key=lambda x: x[args.sort], reverse=True)[:args.limit]
+    print(f'{args.top:>16} {"count":>8} {"avg, s":>8} {"p95, s":>8} {"tokens":>10} {"bytes":>12}')
+    for row in rows:
+        print(f'{str(row[args.top]):>16} {row["count"]:>8} {row["latency_avg"]:>8.2f} '
+              f'{row["latency_p95"]:>8.2f} {row["tokens"]:>10} {row["size"]:>12}')
+
+
+if __name__ == '__main__':
+    main()
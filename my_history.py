@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+
+class History:
+    """Диалог в компактном виде: роли одной строкой байт (код на сообщение) и тексты
+    кортежем строк, вместо списка словарей {"role": ..., "content": ...}, в которых
+    ключи и роли повторяются в каждом сообщении.
+
+    Ведет себя как неизменяемый список сообщений: len, срезы, + со списком словарей,
+    history[i] и перебор дают словари. В формат openai превращается через to_messages()
+    только перед запросом."""
+
+    __slots__ = ('roles', 'contents')
+
+    ROLES = ('system', 'user', 'assistant', 'function', 'tool')
+    _CODES = {x: i for i, x in enumerate(ROLES)}
+
+    def __init__(self, roles: bytes = b'', contents: tuple = ()):
+        self.roles = roles
+        self.contents = contents
+
+    @classmethod
+    def of(cls, messages) -> 'History':
+        """History из списка словарей (старый формат CHATS), History возвращается как есть"""
+        if isinstance(messages, History):
+            return messages
+        messages = messages or ()
+        return cls(bytes(cls._CODES[x['role']] for x in messages), tuple(x['content'] for x in messages))
+
+    def to_messages(self) -> list:
+        """Список словарей для openai"""
+        roles = self.ROLES
+        return [{'role': roles[r], 'content': c} for r, c in zip(self.roles, self.contents)]
+
+    def __len__(self):
+        return len(self.roles)
+
+    def __iter__(self):
+        return iter(self.to_messages())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return History(self.roles[index], self.contents[index])
+        return {'role': self.ROLES[self.roles[index]], 'content': self.contents[index]}
+
+    def __add__(self, other):
+        other = History.of(other)
+        return History(self.roles + other.roles, self.contents + other.contents)
+
+    def __radd__(self, other):
+        return History.of(other) + self
+
+    def __eq__(self, other):
+        if isinstance(other, (History, list, tuple)):
+            other = History.of(other)
+            return self.roles == other.roles and self.contents == other.contents
+        return NotImplemented
+
+    def __repr__(self):
+        # как у списка словарей, utils.count_tokens считает по этой строке
+        return repr(self.to_messages())
+
+    def __reduce__(self):
+        return (History, (self.roles, self.contents))
+
+
+if __name__ == '__main__':
+    pass
@@ -1,29 +1,210 @@
 #!/usr/bin/env python3
 
 
+import atexit
+import collections
+import glob
+import gzip
+import json
 import os
 import datetime
+import functools
+import queue
+import shutil
 import telebot
 import threading
-
-
-lock = threading.Lock()
+import time
 
 
 if not os.path.exists('logs'):
     os.mkdir('logs')
 
 
+# lines are written by a background thread, the handlers only put them into the queue
+# [(file path, text)]
+QUEUE = queue.Queue()
+# the writer thread, started by the first write()
+_WRITER = None
+_WRITER_LOCK = threading.Lock()
+# files are kept open, no more than this number, the least recently used are closed
+MAX_OPEN_FILES = 64
+# written lines go to disk at least this often, seconds
+FLUSH_INTERVAL = 1.0
+# a log bigger than this is renamed to <name>.<date time> and a new one is started
+LOG_MAX_BYTES = 10 * 1024 * 1024
+# if not 0, logs are also rotated every LOG_MAX_AGE seconds (86400 - daily)
+LOG_MAX_AGE = 0
+
+# structured events, one json per line, a file per day: logs/events/events-YYYY-MM-DD.jsonl
+EVENTS_DIR = 'logs/events'
+# the workers of the sharded mode (my_shard.py) write their own events and debug log,
+# events-YYYY-MM-DD-shard-<n>.jsonl
+SHARD_SUFFIX = f'-shard-{os.environ["BOT_SHARD"]}' if os.environ.get('BOT_SHARD') else ''
+# gzip the files of the previous days
+EVENTS_COMPRESS = True
+
+if not os.path.exists(EVENTS_DIR):
+    os.mkdir(EVENTS_DIR)
+
+# the day of the last event, when it changes the old file is compressed
+_events_day = None
+
+
+def _rotate(log_file_path: str) -> None:
+    stamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    new_path = f'{log_file_path}.{stamp}'
+    n = 1
+    while os.path.exists(new_path):
+        new_path = f'{log_file_path}.{stamp}.{n}'
+        n += 1
+    try:
+        os.replace(log_file_path, new_path)
+    except OSError as error:
+        print(f'my_log:rotate: {log_file_path}: {error}')
+
+
+def _period(timestamp: float) -> int:
+    return int(timestamp // LOG_MAX_AGE) if LOG_MAX_AGE else 0
+
+
+def _open(files: collections.OrderedDict, log_file_path: str):
+    """Returns the open file for the path, rotates it if it is too big or too old"""
+    now = time.time()
+    if log_file_path in files:
+        files.move_to_end(log_file_path)
+        log_file, period = files[log_file_path]
+        if log_file.tell() < LOG_MAX_BYTES and period == _period(now):
+            return log_file
+        log_file.close()
+        del files[log_file_path]
+        _rotate(log_file_path)
+    elif os.path.exists(log_file_path):
+        if os.path.getsize(log_file_path) >= LOG_MAX_BYTES or \
+           _period(os.path.getmtime(log_file_path)) != _period(now):
+            _rotate(log_file_path)
+
+    log_file = open(log_file_path, 'a', encoding="utf-8")
+    files[log_file_path] = (log_file, _period(now))
+    while len(files) > MAX_OPEN_FILES:
+        _, (old_file, _) = files.popitem(last=False)
+        old_file.close()
+    return log_file
+
+
+def _writer() -> None:
+    """Background thread, writes the queue into files and flushes them in batches"""
+    files = collections.OrderedDict()
+    dirty = set()
+    last_flush = time.monotonic()
+    while True:
+        try:
+            log_file_path, text = QUEUE.get(timeout=FLUSH_INTERVAL)
+            got = True
+        except queue.Empty:
+            log_file_path, text = None, None
+            got = False
+
+        if log_file_path is not None and callable(text):
+            # a job for the closed file, like compression
+            if log_file_path in files:
+                files.pop(log_file_path)[0].close()
+                dirty.discard(log_file_path)
+            try:
+                text()
+            except Exception as error:
+                print(f'my_log:writer: {log_file_path}: {error}')
+        elif log_file_path is not None:
+            try:
+                _open(files, log_file_path).write(text)
+                dirty.add(log_file_path)
+            except Exception as error:
+                print(f'my_log:writer: {log_file_path}: {error}')
+
+        if dirty and (log_file_path is None or time.monotonic() - last_flush >= FLUSH_INTERVAL):
+            for path in dirty:
+                if path in files:
+                    try:
+                        files[path][0].flush()
+                    except Exception as error:
+                        print(f'my_log:writer: {path}: {error}')
+            dirty.clear()
+            last_flush = time.monotonic()
+
+        if log_file_path is None and text is not None:
+            # flush() is waiting for this
+            text.set()
+        if got:
+            QUEUE.task_done()
+
+
+def _start_writer() -> None:
+    """The writer thread is started by the first record, not on import, so the bot can still
+    fork safely after importing my_log (see my_render.start)"""
+    global _WRITER
+    with _WRITER_LOCK:
+        if _WRITER is None:
+            _WRITER = threading.Thread(target=_writer, name='my_log', daemon=True)
+            _WRITER.start()
+
+
+def write(log_file_path: str, text: str) -> None:
+    """Appends the text to the file in background"""
+    if _WRITER is None:
+        _start_writer()
+    QUEUE.put((log_file_path, text))
+
+
+def flush(timeout: float = 5) -> None:
+    """Waits until everything logged before this call is on disk"""
+    if _WRITER is None:
+        return
+    done = threading.Event()
+    QUEUE.put((None, done))
+    done.wait(timeout)
+
+
+def _gzip(log_file_path: str) -> None:
+    with open(log_file_path, 'rb') as f_in, gzip.open(log_file_path + '.gz', 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(log_file_path)
+
+
+def log_event(event: str, **fields) -> None:
+    """
+    Writes a structured event to the daily jsonl file, for my_events.py queries.
+
+    Args:
+        event (str): The type of the event: 'message', 'upstream', 'voice', 'tts', 'image', ...
+        **fields: chat_id, user_id, latency (seconds), model, tokens, sizes, anything json can store.
+    """
+    global _events_day
+    now = time.time()
+    day = datetime.date.fromtimestamp(now).isoformat()
+    if day != _events_day:
+        if EVENTS_COMPRESS:
+            # the files of the previous days are finished
+            for old in glob.glob(os.path.join(EVENTS_DIR, f'events-*{SHARD_SUFFIX}.jsonl')):
+                if not old.endswith(f'events-{day}{SHARD_SUFFIX}.jsonl'):
+                    write(old, functools.partial(_gzip, old))
+        _events_day = day
+    record = {'ts': round(now, 3), 'event': event}
+    record.update(fields)
+    write(os.path.join(EVENTS_DIR, f'events-{day}{SHARD_SUFFIX}.jsonl'),
+          json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+
+atexit.register(flush)
+
+
 def log2(text: str) -> None:
     """для дебага"""
     time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
-    log_file_path = 'logs/debug.log'
-    open(log_file_path, 'a', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"=" * 80}\n')
+    log_file_path = f'logs/debug{SHARD_SUFFIX}.log'
+    write(log_file_path, f'{time_now}\n\n{text}\n{"=" * 80}\n')
 
 
 def log_echo(message: telebot.types.Message, reply_from_bot: str = '', debug: bool = False) -> None:
     """writes to the log a message received by the regular message handler or a bot response"""
-    global lock
     time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
     private_or_chat = 'private' if message.chat.type == 'private' else 'chat'
     chat_name = message.chat.username or message.chat.first_name or message.chat.title or ''
@@ -48,17 +229,14 @@ def log_echo(message: telebot.types.Message, reply_from_bot: str = '', debug: bo
     if topic_id:
         log_file_path = log_file_path[:-4] + f' [{topic_id}].log'
 
-    with lock:
-        with open(log_file_path, 'a', encoding="utf-8") as log_file:
-            if reply_from_bot:
-                log_file.write(f"[{time_now}] [BOT]: {reply_from_bot}\n")
-            else:
-                log_file.write(f"[{time_now}] [{user_name}]: {message.text or message.caption or ''}\n")
+    if reply_from_bot:
+        write(log_file_path, f"[{time_now}] [BOT]: {reply_from_bot}\n")
+    else:
+        write(log_file_path, f"[{time_now}] [{user_name}]: {message.text or message.caption or ''}\n")
 
 
 def log_media(message: telebot.types.Message) -> None:
     """log media files"""
-    global lock
     time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
     private_or_chat = 'private' if message.chat.type == 'private' else 'chat'
     chat_name = message.chat.username or message.chat.first_name or message.chat.title or ''
@@ -88,32 +266,24 @@ def log_media(message: telebot.types.Message) -> None:
         file_duration = message.audio.duration
         file_title = message.audio.title
         file_mime_type = message.audio.mime_type
-        with lock:
-            with open(log_file_path, 'a', encoding="utf-8") as log_file:
-                log_file.write(f"[{time_now}] [{user_name}]: [Отправил аудио файл] [caption: {caption}] [title: {file_title}] \
+        write(log_file_path, f"[{time_now}] [{user_name}]: [Отправил аудио файл] [caption: {caption}] [title: {file_title}] \
 [filename: {file_name}] [filesize: {file_size}] [duration: {file_duration}] [mime type: {file_mime_type}]\n")
 
     if message.voice:
         file_size = message.voice.file_size
         file_duration = message.voice.duration
-        with lock:
-            with open(log_file_path, 'a', encoding="utf-8") as log_file:
-                log_file.write(f"[{time_now}] [{user_name}]: [Отправил голосовое сообщение] [filesize: \
+        write(log_file_path, f"[{time_now}] [{user_name}]: [Отправил голосовое сообщение] [filesize: \
 {file_size}] [duration: {file_duration}]\n")
 
     if message.document:
         file_name = message.document.file_name
         file_size = message.document.file_size
         file_mime_type = message.document.mime_type
-        with lock:
-            with open(log_file_path, 'a', encoding="utf-8") as log_file:
-                log_file.write(f"[{time_now}] [{user_name}]: [Отправил документ] [caption: {caption}] \
+        write(log_file_path, f"[{time_now}] [{user_name}]: [Отправил документ] [caption: {caption}] \
 [filename: {file_name}] [filesize: {file_size}] [mime type: {file_mime_type}]\n")
 
     if message.photo or message.video:
-        with lock:
-            with open(log_file_path, 'a', encoding="utf-8") as log_file:
-                log_file.write(f"[{time_now}] [{user_name}]: [Отправил фото] [caption]: {caption}\n")
+        write(log_file_path, f"[{time_now}] [{user_name}]: [Отправил фото] [caption]: {caption}\n")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""Metrics of the bot process for Prometheus (or just curl).
+
+The endpoint is off by default, with cfg.metrics_port set the bot serves
+http://127.0.0.1:<port>/metrics in the text exposition format.
+
+UPSTREAM_SECONDS.observe(1.5, server='default')
+TRANSLATION_CACHE.inc(result='hit')
+"""
+
+
+import http.server
+import threading
+
+import my_log
+import my_trace
+
+
+# all the metrics in the order of creation
+REGISTRY = []
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{x}="{_escape(y)}"' for x, y in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A named family of values, one value per set of labels"""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        # {label values: value}
+        self.values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(x, '') for x in self.labels)
+
+    def samples(self):
+        """[(name suffix, label values, extra label, value)]"""
+        with self.lock:
+            return [('', key, '', value) for key, value in self.values.items()]
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, key, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_labels(self.labels, key, extra)} {_number(value)}')
+        return lines
+
+
+class Counter(Metric):
+    """Only grows: requests, errors, retries"""
+
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Current value: queue depth, sizes. With function the value is taken from it on every scrape"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), function=None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def set(self, value: float, **labels) -> None:
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                return [('', (), '', self.function())]
+            except Exception as error:
+                my_log.log2(f'my_metrics:gauge:{self.name}: {error}')
+                return []
+        return super().samples()
+
+
+class Histogram(Metric):
+    """Durations, my_trace.Histogram per set of labels"""
+
+    kind = 'histogram'
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        histogram = self.values.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.values.setdefault(key, my_trace.Histogram())
+        histogram.record(value)
+
+    def samples(self):
+        result = []
+        with self.lock:
+            items = list(self.values.items())
+        for key, histogram in items:
+            buckets, count, total = histogram.cumulative()
+            for bound, n in buckets:
+                result.append(('_bucket', key, f'le="{bound:.6g}"', n))
+            result.append(('_bucket', key, 'le="+Inf"', count))
+            result.append(('_count', key, '', count))
+            result.append(('_sum', key, '', total))
+        return result
+
+
+UPDATES = Counter('bot_updates_total', 'Updates received from telegram', ('type',))
+# server - 'default' (openai) or 'custom' (/url of a user), not the url itself: users set any
+# urls, every one would be new series forever, and a url can have a key in it
+UPSTREAM_SECONDS = Histogram('bot_upstream_seconds', 'Duration of chat completion requests', ('server',))
+IMAGE_SECONDS = Histogram('bot_image_seconds', 'Time until a generated image is ready, per image', ('server',))
+UPSTREAM_ERRORS = Counter('bot_upstream_errors_total', 'Failed chat completion requests', ('server',))
+TRANSLATION_CACHE = Counter('bot_translation_cache_total', 'Lookups in the translation caches', ('result',))
+DICT_FLUSH_SECONDS = Histogram('bot_dict_flush_seconds', 'Time to save a PersistentDict to disk', ('file',))
+DICT_BYTES = Gauge('bot_dict_bytes', 'Size of a PersistentDict on disk after the last save', ('file',))
+STORE_LOOKUPS = Counter('bot_store_lookups_total', 'Lookups in the memory tier of a TieredDict', ('store', 'result'))
+STORE_EVICTIONS = Counter('bot_store_evictions_total', 'Values dropped from the memory tier of a TieredDict', ('store',))
+STORE_HOT_BYTES = Gauge('bot_store_hot_bytes', 'Pickled size of the values in the memory tier', ('store',))
+STORE_HOT_ITEMS = Gauge('bot_store_hot_items', 'Values in the memory tier', ('store',))
+SEND_RETRIES = Counter('bot_send_retries_total', 'Telegram requests repeated after 429 Too Many Requests')
+RENDER_SECONDS = Histogram('bot_render_seconds', 'Formatting of answers: in the process pool, inline or inline after the pool failed',
+                           ('function', 'where'))
+SHARD_UPDATES = Counter('bot_shard_updates_total', 'Updates the dispatcher routed to a worker', ('shard',))
+SHARD_RESTARTS = Counter('bot_shard_restarts_total', 'Workers started again after they exited', ('shard',))
+
+
+def render() -> str:
+    """All the metrics in the text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(port: int, host: str = '127.0.0.1') -> http.server.ThreadingHTTPServer:
+    """Serves /metrics in a background thread, returns the server or None if it could not start"""
+    try:
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+    except OSError as error:
+        my_log.log2(f'my_metrics:start: {host}:{port}: {error}')
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Formatting of big answers in other processes.
+
+Markdown to html (tables, formulas) and splitting are pure python and hold the GIL, while
+one chat renders its 20 KB table dump the handlers of all the other chats wait. Answers of
+cfg.render_offload_min characters and more are formatted in a pool of processes, smaller
+ones in place as before, for them the round trip to a process costs more than the work.
+
+The processes are forked by start() right after the imports of tb.py, while the bot has
+no threads yet: a thread holding a lock (the log queue, the send queue) at the moment of
+fork would leave it locked in the child forever. spawn would import tb.py again in every
+process. Without fork (windows), or if start() came too late, everything is in place.
+"""
+
+
+import concurrent.futures
+import concurrent.futures.process
+import multiprocessing
+import threading
+import time
+
+import cfg
+import my_log
+import my_metrics
+import utils
+
+
+# answers shorter than this are formatted in place, characters
+OFFLOAD_MIN = getattr(cfg, 'render_offload_min', 8000)
+# processes in the pool, 0 - always in place
+WORKERS = getattr(cfg, 'render_workers', 2)
+# how long to wait for the pool before formatting in place, seconds
+TIMEOUT = 30
+
+_POOL = None
+_LOCK = threading.Lock()
+
+
+def enabled() -> bool:
+    return _POOL is not None
+
+
+def start() -> None:
+    """Forks the processes of the pool, call it before anything starts a thread"""
+    global _POOL
+    if not WORKERS or 'fork' not in multiprocessing.get_all_start_methods():
+        return
+    if threading.active_count() > 1:
+        my_log.log2(f'my_render:start: {threading.active_count()} threads are running, not forking, '
+                    'big answers are formatted in place')
+        return
+    pool = concurrent.futures.ProcessPoolExecutor(WORKERS, mp_context=multiprocessing.get_context('fork'))
+    # with fork all the processes are started by the first task, before the pool starts its own threads
+    pool.submit(len, '').result()
+    with _LOCK:
+        _POOL = pool
+
+
+def _run(function, text: str, *args):
+    """function(text, *args) in the pool for big texts, in place for small ones or if the pool failed"""
+    global _POOL
+    start_time = time.perf_counter()
+    where = 'inline'
+    pool = _POOL
+    if len(text) >= OFFLOAD_MIN and pool is not None:
+        try:
+            result = pool.submit(function, text, *args).result(TIMEOUT)
+            where = 'pool'
+        except Exception as error:
+            my_log.log2(f'my_render:{function.__name__}: {error}')
+            where = 'fallback'
+            if isinstance(error, concurrent.futures.process.BrokenProcessPool):
+                # a process died, a new pool would be forked from the bot with its threads,
+                # so big answers are formatted in place from now on
+                with _LOCK:
+                    if _POOL is pool:
+                        _POOL = None
+    if where != 'pool':
+        result = function(text, *args)
+    my_metrics.RENDER_SECONDS.observe(time.perf_counter() - start_time, function=function.__name__, where=where)
+    return result
+
+
+def bot_markdown_to_html(text: str) -> str:
+    """utils.bot_markdown_to_html, in the pool for big answers"""
+    return _run(utils.bot_markdown_to_html, text)
+
+
+def split_html(text: str, max_length: int = 1500) -> list:
+    """utils.split_html, in the pool for big answers"""
+    return _run(utils.split_html, text, max_length)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+
+import bisect
+import concurrent.futures
+import itertools
+import threading
+import time
+
+import telebot
+
+import my_log
+import my_metrics
+
+
+# Telegram limits: about 1 message per second in one chat (short bursts are allowed)
+# and about 30 messages per second for the whole bot
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+CHAT_BURST = 3
+
+# lower value - sent first
+PRIORITY_REPLY = 0
+PRIORITY_ACTION = 10
+
+# chat action lives 5 seconds in the telegram client, no sense to send it later
+ACTION_TTL = 5
+
+# how many times to repeat a request after "429 Too Many Requests"
+MAX_RETRIES = 5
+
+# 429 in so many different chats in FLOOD_WINDOW seconds means the limit of the whole bot,
+# then nothing is sent to any chat until retry_after
+FLOOD_CHATS = 2
+FLOOD_WINDOW = 5
+
+# kinds of updates, for the metrics
+UPDATE_TYPES = ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'inline_query',
+                'chosen_inline_result', 'callback_query', 'shipping_query', 'pre_checkout_query',
+                'poll', 'poll_answer', 'my_chat_member', 'chat_member', 'chat_join_request')
+
+
+class TokenBucket:
+    """Classic token bucket, `rate` tokens per second, no more than `capacity` stored"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        # retry_after from telegram, nothing can be sent before this moment
+        self.blocked_until = 0.0
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self, now: float) -> float:
+        """How many seconds to wait before a token is available, 0 if it is available now"""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+    def is_idle(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class Job:
+    __slots__ = ('priority', 'seq', 'chat_id', 'func', 'args', 'kwargs', 'future', 'expire', 'retries')
+
+    def __init__(self, priority, seq, chat_id, func, args, kwargs, expire):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = concurrent.futures.Future()
+        self.expire = expire
+        self.retries = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class SendScheduler:
+    """Central outgoing queue for the telegram api.
+
+    Every job waits for a token in its chat bucket and in the global bucket, jobs with a
+    lower priority value go first, jobs of one chat are sent strictly one by one in the order
+    they were queued. "429 Too Many Requests" answers are repeated after retry_after seconds,
+    the chat waits for them, or all chats if 429 came in several chats at once.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 chat_burst: float = CHAT_BURST, workers: int = 8):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        # {chat_id: time.monotonic() of the last 429 in the chat}
+        self.flood = {}
+        # chats with a job in progress, the next job of the chat waits for it
+        self.busy = set()
+        # sorted by (priority, seq)
+        self.queue = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                              thread_name_prefix='sender')
+        self.dispatcher = threading.Thread(target=self._dispatch, name='sender-dispatcher', daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, chat_id, func, *args, priority: int = PRIORITY_REPLY, ttl: float = None,
+               **kwargs) -> concurrent.futures.Future:
+        """Queue func(*args, **kwargs) for sending to chat_id, returns a Future with the result.
+        If ttl is set and the job could not be started in ttl seconds it is dropped (result None)."""
+        expire = time.monotonic() + ttl if ttl else None
+        job = Job(priority, next(self.counter), chat_id, func, args, kwargs, expire)
+        with self.cond:
+            bisect.insort(self.queue, job)
+            self.cond.notify()
+        return job.future
+
+    def call(self, chat_id, func, *args, priority: int = PRIORITY_REPLY, **kwargs):
+        """Same as submit but waits for the result and raises the api errors like a direct call"""
+        return self.submit(chat_id, func, *args, priority=priority, **kwargs).result()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                now = time.monotonic()
+                self.chat_buckets = {k: v for k, v in self.chat_buckets.items()
+                                     if k in self.busy or not v.is_idle(now)}
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _next_job(self):
+        """Returns (job, None) if some job can be started now or (None, seconds to wait)"""
+        now = time.monotonic()
+        wait = None
+        seen = set()
+        global_delay = self.global_bucket.delay(now)
+        for job in list(self.queue):
+            if job.expire and job.expire < now:
+                self.queue.remove(job)
+                job.future.set_result(None)
+                continue
+            if job.chat_id in seen:
+                continue
+            seen.add(job.chat_id)
+            if job.chat_id in self.busy:
+                continue
+            delay = max(global_delay, self._chat_bucket(job.chat_id).delay(now))
+            if delay == 0:
+                self.queue.remove(job)
+                return job, None
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _block(self, chat_id, retry_after: float) -> None:
+        """Nothing goes to the chat for retry_after seconds, to any chat if the bot is flooded, under self.cond"""
+        now = time.monotonic()
+        until = now + retry_after
+        bucket = self._chat_bucket(chat_id)
+        bucket.blocked_until = max(bucket.blocked_until, until)
+        self.flood = {k: v for k, v in self.flood.items() if now - v < FLOOD_WINDOW}
+        self.flood[chat_id] = now
+        if len(self.flood) >= FLOOD_CHATS:
+            my_log.log2(f'my_sender:block: 429 in {len(self.flood)} chats, all chats wait {retry_after}s')
+            self.global_bucket.blocked_until = max(self.global_bucket.blocked_until, until)
+
+    def _dispatch(self):
+        with self.cond:
+            while True:
+                job, wait = self._next_job()
+                if job is None:
+                    self.cond.wait(wait)
+                    continue
+                self.global_bucket.consume()
+                self._chat_bucket(job.chat_id).consume()
+                self.busy.add(job.chat_id)
+                self.executor.submit(self._run, job)
+
+    def _run(self, job: Job):
+        try:
+            result = job.func(*job.args, **job.kwargs)
+        except telebot.apihelper.ApiTelegramException as error:
+            retry_after = 0
+            if error.error_code == 429:
+                retry_after = (error.result_json.get('parameters') or {}).get('retry_after', 1)
+            if retry_after and job.retries < MAX_RETRIES:
+                job.retries += 1
+                my_metrics.SEND_RETRIES.inc()
+                my_log.log2(f'my_sender:run: retry after {retry_after}s, chat {job.chat_id}')
+                with self.cond:
+                    self._block(job.chat_id, retry_after)
+                    bisect.insort(self.queue, job)
+            else:
+                job.future.set_exception(error)
+        except Exception as error:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+        finally:
+            with self.cond:
+                self.busy.discard(job.chat_id)
+                self.cond.notify()
+
+
+class TeleBot(telebot.TeleBot):
+    """telebot.TeleBot which sends everything through the SendScheduler.
+    reply_to and other helpers call send_message so they are scheduled too."""
+
+    def __init__(self, *args, scheduler: SendScheduler = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler or SendScheduler()
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            for name in UPDATE_TYPES:
+                if getattr(update, name, None) is not None:
+                    my_metrics.UPDATES.inc(type=name)
+                    break
+            else:
+                my_metrics.UPDATES.inc(type='other')
+        return super().process_new_updates(updates)
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self.scheduler.call(chat_id, super().send_message, chat_id, *args, **kwargs)
+
+    def send_message_async(self, chat_id, *args, **kwargs) -> concurrent.futures.Future:
+        """send_message without waiting, it still goes to the chat before the replies queued after it"""
+        future = self.scheduler.submit(chat_id, super().send_message, chat_id, *args, **kwargs)
+        future.add_done_callback(_log_send_error)
+        return future
+
+    def send_voice(self, chat_id, *args, **kwargs):
+        return self.scheduler.call(chat_id, super().send_voice, chat_id, *args, **kwargs)
+
+    def send_photo(self, chat_id, *args, **kwargs):
+        return self.scheduler.call(chat_id, super().send_photo, chat_id, *args, **kwargs)
+
+    def send_document(self, chat_id, *args, **kwargs):
+        return self.scheduler.call(chat_id, super().send_document, chat_id, *args, **kwargs)
+
+    def send_media_group(self, chat_id, *args, **kwargs):
+        return self.scheduler.call(chat_id, super().send_media_group, chat_id, *args, **kwargs)
+
+    def send_chat_action(self, chat_id, *args, **kwargs):
+        """Chat actions don't wait for the queue, they are sent after all replies of the chat
+        or dropped if they became useless"""
+        future = self.scheduler.submit(chat_id, super().send_chat_action, chat_id, *args,
+                                       priority=PRIORITY_ACTION, ttl=ACTION_TTL, **kwargs)
+        future.add_done_callback(_log_action_error)
+        return True
+
+
+def _log_action_error(future: concurrent.futures.Future):
+    error = future.exception()
+    if error:
+        my_log.log2(f'my_sender:send_chat_action: {error}')
+
+
+def _log_send_error(future: concurrent.futures.Future):
+    error = future.exception()
+    if error:
+        my_log.log2(f'my_sender:send_message_async: {error}')
+
+
+if __name__ == '__main__':
+    pass
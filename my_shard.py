@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""Sharded mode: the bot as several processes to use more than one core.
+
+python3 my_shard.py
+
+The dispatcher (this script) polls telegram and sends every update to one of cfg.shards
+worker processes (tb.py) by the hash of its chat id. All the updates of a chat go to the
+same worker in the order they came, so the worker owns the chat's dialog, prompt,
+temperature and model, they are kept in db/shard-<n>/. The users' keys and languages
+(gpt_basic.TOKENS) and the translations of the interface are shared by the workers,
+in sqlite files in db/ instead of the usual pickles.
+
+On the first start the data of the usual mode is split between the shards. The number
+of shards can't be changed after that (db/shards.txt), going back to the usual mode
+is not supported either.
+
+The dispatcher starts the workers and restarts the ones that die. Workers on other hosts:
+cfg.shard_spawn = False, cfg.shard_host = an address they can reach, and on every host
+BOT_SHARD=<n> BOT_SHARDS=<count> BOT_DISPATCHER=<host>:<port> python3 tb.py
+The shared files are local, so every host then has its own copy of keys and translations.
+"""
+
+
+import collections
+import hashlib
+import multiprocessing.connection
+import os
+import pickle
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+import telebot
+
+import cfg
+import my_dic
+import my_log
+import my_metrics
+
+
+# number of this worker and of all the workers, None in the usual mode
+SHARD = int(os.environ['BOT_SHARD']) if os.environ.get('BOT_SHARD') else None
+SHARDS = int(os.environ.get('BOT_SHARDS', '1'))
+
+# stores of a worker, split between the shards on the first start of the sharded mode
+PER_SHARD = ('db/dialogs.db', 'db/dialogs.pkl', 'db/prompts.pkl', 'db/temperature.pkl',
+             'db/custom_models.pkl')
+# stores of all the workers, see shared()
+SHARED = ('db/servers.pkl', 'db/auto_translations.pkl')
+# the number of shards the data was split for
+SHARDS_FILE = 'db/shards.txt'
+
+# how the dispatcher starts a worker
+WORKER_COMMAND = [sys.executable, 'tb.py']
+
+# updates kept for a worker that is not connected, the oldest are dropped after that
+MAX_PENDING = 10000
+
+# connection of a worker to the dispatcher
+_connection = None
+
+
+def path(file_path: str, shard: int = None) -> str:
+    """db/x.pkl -> db/shard-<n>/x.pkl in a worker, the same path in the usual mode"""
+    shard = SHARD if shard is None else shard
+    if shard is None:
+        return file_path
+    folder = os.path.join(os.path.dirname(file_path), f'shard-{shard}')
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, os.path.basename(file_path))
+
+
+def _shared_path(file_path: str) -> str:
+    return os.path.splitext(file_path)[0] + '.db'
+
+
+def shared(file_path: str, ttl: float = None):
+    """Store of all the workers: SqliteDict next to the old pickle (db/x.pkl -> db/x.db)
+    in the sharded mode, PersistentDict(file_path) in the usual mode.
+    ttl - keep what was read in memory for so many seconds (my_dic.CachedDict), the changes
+    made by the other workers are seen that much later"""
+    if SHARD is None:
+        return my_dic.PersistentDict(file_path)
+    store = my_dic.SqliteDict(_shared_path(file_path), legacy_path=file_path)
+    if ttl:
+        store = my_dic.CachedDict(store, ttl, name=os.path.basename(_shared_path(file_path)))
+    return store
+
+
+def shard_of(chat_id, shards: int) -> int:
+    """Shard of a chat, the same in every process and after restarts (hash() of str is not)"""
+    return zlib.crc32(str(chat_id).encode('utf-8')) % shards
+
+
+def chat_id_of(update: dict) -> int:
+    """Chat of a raw update from getUpdates, updates without a chat go by the user"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        if 'chat' in value:
+            return value['chat']['id']
+        # callback_query
+        if isinstance(value.get('message'), dict):
+            return value['message']['chat']['id']
+        # inline_query, poll_answer... the user's private chat has the same id
+        user = value.get('from') or value.get('user')
+        if user:
+            return user['id']
+    return 0
+
+
+def authkey() -> bytes:
+    return getattr(cfg, 'shard_key', None) or hashlib.sha256(cfg.token.encode('utf-8')).digest()
+
+
+def split(shards: int) -> None:
+    """Spreads the data of the usual mode over the shard folders, once"""
+    if os.path.exists(SHARDS_FILE):
+        with open(SHARDS_FILE, encoding='utf-8') as f:
+            old = int(f.read().strip())
+        if old != shards:
+            raise SystemExit(f'The data is split for {old} shards, cfg.shards = {shards}')
+        return
+    for file_path in PER_SHARD:
+        if not os.path.exists(file_path):
+            continue
+        if file_path.endswith('.db'):
+            source = my_dic.SqliteDict(file_path)
+            parts = [[] for _ in range(shards)]
+            for key, value in source.rows():
+                parts[shard_of(pickle.loads(key), shards)].append((key, value))
+            source.close()
+            for i, rows in enumerate(parts):
+                target = my_dic.SqliteDict(path(file_path, i))
+                target.import_rows(rows)
+                target.close()
+        else:
+            with open(file_path, 'rb') as f:
+                data = pickle.load(f)
+            parts = [{} for _ in range(shards)]
+            for key, value in data.items():
+                parts[shard_of(key, shards)][key] = value
+            for i, part in enumerate(parts):
+                with open(path(file_path, i), 'wb') as f:
+                    pickle.dump(part, f)
+        os.replace(file_path, file_path + '.sharded')
+        my_log.log2(f'my_shard:split: {file_path} -> {shards} shards')
+    # the workers would race to move the old pickles of the shared stores
+    for file_path in SHARED:
+        store = my_dic.SqliteDict(_shared_path(file_path), legacy_path=file_path)
+        store.connect()
+        store.close()
+    with open(SHARDS_FILE, 'w', encoding='utf-8') as f:
+        f.write(str(shards))
+
+
+class Shard:
+    """A worker as the dispatcher sees it: the process, the connection and the updates
+    waiting to be sent to it, in order"""
+
+    def __init__(self, number: int, dispatcher: 'Dispatcher'):
+        self.number = number
+        self.dispatcher = dispatcher
+        self.process = None
+        self.connection = None
+        self.updates = collections.deque()
+        self.condition = threading.Condition()
+        self.connected = threading.Event()
+        threading.Thread(target=self._send_loop, name=f'shard-{number}', daemon=True).start()
+
+    def put(self, updates: list) -> None:
+        with self.condition:
+            self.updates.extend(updates)
+            dropped = 0
+            while len(self.updates) > MAX_PENDING:
+                self.updates.popleft()
+                dropped += 1
+            self.condition.notify()
+        my_metrics.SHARD_UPDATES.inc(len(updates), shard=self.number)
+        if dropped:
+            my_log.log2(f'my_shard:put: shard {self.number} is not connected, {dropped} updates dropped')
+
+    def attach(self, connection) -> None:
+        with self.condition:
+            if self.connection is not None:
+                self.connection.close()
+            self.connection = connection
+            self.condition.notify()
+        self.connected.set()
+        threading.Thread(target=self._receive_loop, args=(connection,), daemon=True).start()
+
+    def _detach(self, connection) -> None:
+        with self.condition:
+            if self.connection is connection:
+                self.connection = None
+                self.connected.clear()
+        connection.close()
+
+    def _send_loop(self) -> None:
+        while True:
+            with self.condition:
+                while not (self.updates and self.connection):
+                    self.condition.wait()
+                batch = list(self.updates)
+                self.updates.clear()
+                connection = self.connection
+            try:
+                connection.send(batch)
+            except (OSError, EOFError, ValueError) as error:
+                # the updates go back to the queue until the worker connects again
+                my_log.log2(f'my_shard:send: shard {self.number}: {error}')
+                with self.condition:
+                    self.updates.extendleft(reversed(batch))
+                self._detach(connection)
+
+    def _receive_loop(self, connection) -> None:
+        """Requests of the worker, only /restart for now"""
+        try:
+            while True:
+                if connection.recv() == 'restart':
+                    self.dispatcher.stop()
+        except (OSError, EOFError, ValueError):
+            self._detach(connection)
+
+    def start(self, address: tuple) -> None:
+        env = dict(os.environ, BOT_SHARD=str(self.number), BOT_SHARDS=str(self.dispatcher.shards),
+                   BOT_DISPATCHER=f'{address[0]}:{address[1]}', BOT_DISPATCHER_PID=str(os.getpid()))
+        self.process = subprocess.Popen(WORKER_COMMAND, env=env)
+
+
+class Dispatcher:
+    def __init__(self, shards: int, address: tuple, spawn: bool = True):
+        self.shards = shards
+        self.address = address
+        self.spawn = spawn
+        self.listener = multiprocessing.connection.Listener(address, authkey=authkey())
+        self.workers = [Shard(i, self) for i in range(shards)]
+        self.stopping = threading.Event()
+        self.offset = None
+
+    def _accept_loop(self) -> None:
+        while not self.stopping.is_set():
+            try:
+                connection = self.listener.accept()
+                number = connection.recv()
+                self.workers[number].attach(connection)
+                print(f'shard {number} connected')
+            except Exception as error:
+                if not self.stopping.is_set():
+                    my_log.log2(f'my_shard:accept: {error}')
+
+    def _watch_loop(self) -> None:
+        """Starts again the workers that exited"""
+        while not self.stopping.wait(1):
+            for worker in self.workers:
+                if worker.process is not None and worker.process.poll() is not None and not self.stopping.is_set():
+                    my_log.log2(f'my_shard:watch: shard {worker.number} exited with {worker.process.returncode}')
+                    my_metrics.SHARD_RESTARTS.inc(shard=worker.number)
+                    worker.start(self.address)
+
+    def stop(self) -> None:
+        """Like /restart of the usual mode: the updates received so far are confirmed,
+        telegram ends the pending long poll with 409 and run() returns"""
+        self.stopping.set()
+        if self.offset is not None:
+            try:
+                telebot.apihelper.get_updates(cfg.token, offset=self.offset, timeout=1, long_polling_timeout=1)
+            except Exception as error:
+                my_log.log2(f'my_shard:stop: {error}')
+
+    def run(self) -> None:
+        threading.Thread(target=self._accept_loop, name='accept', daemon=True).start()
+        if self.spawn:
+            for worker in self.workers:
+                worker.start(self.address)
+            threading.Thread(target=self._watch_loop, name='watch', daemon=True).start()
+        # updates wait in telegram until the workers are ready to take them
+        deadline = time.time() + 60
+        for worker in self.workers:
+            worker.connected.wait(max(0, deadline - time.time()))
+        print(f'Dispatching to {self.shards} shards')
+        while not self.stopping.is_set():
+            try:
+                updates = telebot.apihelper.get_updates(cfg.token, offset=self.offset, timeout=90,
+                                                        long_polling_timeout=90)
+            except Exception as error:
+                if not self.stopping.is_set():
+                    my_log.log2(f'my_shard:get_updates: {error}')
+                    time.sleep(3)
+                continue
+            if not updates:
+                continue
+            batches = collections.defaultdict(list)
+            for update in updates:
+                batches[shard_of(chat_id_of(update), self.shards)].append(update)
+            for number, batch in batches.items():
+                self.workers[number].put(batch)
+            self.offset = updates[-1]['update_id'] + 1
+        self.close()
+
+    def close(self) -> None:
+        """Tells the workers to stop, the ones started by the dispatcher exit"""
+        self.listener.close()
+        for worker in self.workers:
+            # let the queued updates go first
+            deadline = time.time() + 5
+            while worker.updates and worker.connection and time.time() < deadline:
+                time.sleep(0.05)
+            with worker.condition:
+                connection = worker.connection
+            if connection is not None:
+                try:
+                    connection.send(None)
+                except (OSError, ValueError) as error:
+                    my_log.log2(f'my_shard:close: shard {worker.number}: {error}')
+        for worker in self.workers:
+            if worker.process is not None:
+                try:
+                    worker.process.wait(30)
+                except subprocess.TimeoutExpired:
+                    worker.process.kill()
+
+
+def _address(text: str) -> tuple:
+    host, _, port = text.rpartition(':')
+    return host, int(port)
+
+
+def serve(bot) -> None:
+    """Worker: takes the updates from the dispatcher instead of polling telegram.
+    A worker started by the dispatcher exits with it, one started by hand connects again"""
+    global _connection
+    address = _address(os.environ['BOT_DISPATCHER'])
+    spawned = bool(os.environ.get('BOT_DISPATCHER_PID'))
+    while True:
+        try:
+            _connection = multiprocessing.connection.Client(address, authkey=authkey())
+            _connection.send(SHARD)
+        except (OSError, EOFError, multiprocessing.AuthenticationError) as error:
+            if spawned:
+                my_log.log2(f'my_shard:serve: {error}')
+                return
+            time.sleep(3)
+            continue
+        try:
+            while True:
+                updates = _connection.recv()
+                # the dispatcher is stopping
+                if updates is None:
+                    break
+                bot.process_new_updates([telebot.types.Update.de_json(x) for x in updates])
+        except (OSError, EOFError) as error:
+            my_log.log2(f'my_shard:serve: {error}')
+        _connection.close()
+        _connection = None
+        if spawned:
+            return
+        time.sleep(3)
+
+
+def restart() -> None:
+    """/restart in a worker stops the dispatcher and all the workers"""
+    try:
+        _connection.send('restart')
+    except (AttributeError, OSError) as error:
+        my_log.log2(f'my_shard:restart: {error}')
+
+
+def main():
+    os.chdir(os.path.abspath(os.path.dirname(__file__)))
+    shards = getattr(cfg, 'shards', 2)
+    split(shards)
+    address = (getattr(cfg, 'shard_host', '127.0.0.1'), getattr(cfg, 'shard_port', 8452))
+    if getattr(cfg, 'metrics_port', None):
+        my_metrics.start(cfg.metrics_port, getattr(cfg, 'metrics_host', '127.0.0.1'))
+    Dispatcher(shards, address, getattr(cfg, 'shard_spawn', True)).run()
+
+
+if __name__ == '__main__':
+    main()
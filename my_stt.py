@@ -1,79 +1,258 @@
 #!/usr/bin/env python3
 
 
-import os
+import bisect
+import concurrent.futures
+import functools
+import json
+import queue
+import re
 import subprocess
-import tempfile
-import speech_recognition as sr
+import sys
+import threading
 
+import cfg
 import my_log
 
 
-def convert_to_wave_with_ffmpeg(audio_file: str) -> str:
+# audio is decoded to raw PCM: signed 16 bit, mono, 16 kHz
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+
+# free google recognition accepts up to ~1 minute, longer audio is cut into segments
+# at pauses, the segments are recognized in parallel
+MAX_SEGMENT = 50
+# a pause is at least 0.3 seconds quieter than -30 dB
+SILENCE_FILTER = 'silencedetect=noise=-30dB:d=0.3'
+# all voice messages share this pool, so one long message cannot flood google
+# or take all cpu with a local engine
+STT_WORKERS = getattr(cfg, 'stt_workers', 4)
+POOL = concurrent.futures.ThreadPoolExecutor(max_workers=STT_WORKERS, thread_name_prefix='stt')
+
+_SILENCE_RE = re.compile(r'silence_(start|end): (-?[\d.]+)')
+
+
+def decode_audio(data: bytes) -> tuple:
     """
-    Converts an audio file to a wave format using FFmpeg.
+    Decodes audio of any format to raw PCM with one FFmpeg process, the data goes
+    through stdin and stdout, no temporary files. The same process finds pauses in the speech.
 
     Args:
-        audio_file (str): The path to the audio file to be converted.
+        data (bytes): The audio file (ogg, mp3, ...) as bytes.
 
     Returns:
-        str: The path to the converted wave file.
+        tuple: (PCM signed 16 bit little endian, mono, SAMPLE_RATE;
+                list of pauses [(start, end), ...] in seconds)
     """
-    with tempfile.NamedTemporaryFile() as temp_file:
-        tmp_wav_file = temp_file.name + '.wav'
-    subprocess.run(['ffmpeg', '-i', audio_file, tmp_wav_file], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    return tmp_wav_file
+    result = subprocess.run(['ffmpeg', '-hide_banner', '-nostats', '-i', 'pipe:0', '-af', SILENCE_FILTER,
+                             '-f', 's16le', '-ac', '1', '-ar', str(SAMPLE_RATE), 'pipe:1'],
+                            input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    log = result.stderr.decode('utf-8', errors='replace')
+    if result.returncode != 0:
+        raise RuntimeError(f'ffmpeg: {log.strip()[-500:]}')
+
+    pcm = result.stdout
+    silences = []
+    start = None
+    for kind, seconds in _SILENCE_RE.findall(log):
+        if kind == 'start':
+            start = max(float(seconds), 0.0)
+        elif start is not None:
+            silences.append((start, float(seconds)))
+            start = None
+    if start is not None:
+        silences.append((start, audio_duration(pcm)))
+    return pcm, silences
 
 
-def audio_duration(audio_file: str) -> int:
+def audio_duration(pcm: bytes) -> float:
     """
-    Get the duration of an audio file.
+    Get the duration of decoded audio.
 
     Args:
-        audio_file (str): The path to the audio file.
+        pcm (bytes): Audio from decode_audio.
 
     Returns:
-        int: The duration of the audio file in seconds.
+        float: The duration of the audio in seconds.
     """
-    result = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', audio_file], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    return float(result.stdout)
+    return len(pcm) / (SAMPLE_RATE * SAMPLE_WIDTH)
 
 
-def stt_google(audio_file: str, language: str) -> str:
+def stt_google(pcm: bytes, language: str) -> str:
     """
     Speech-to-text using Google's speech recognition API.
     
     Args:
-        audio_file (str): The path to the audio file to be transcribed.
+        pcm (bytes): Audio from decode_audio.
         language (str, optional): The language of the audio file. Defaults to 'ru'.
     
     Returns:
         str: The transcribed text from the audio file.
     """
-    assert audio_duration(audio_file) < 55, 'Too big for free speech recognition'
-    audio_file2 = convert_to_wave_with_ffmpeg(audio_file)
+    assert audio_duration(pcm) < 55, 'Too big for free speech recognition'
+    import speech_recognition as sr
     google_recognizer = sr.Recognizer()
-
-    with sr.AudioFile(audio_file2) as source:
-        audio = google_recognizer.record(source)  # read the entire audio file
+    audio = sr.AudioData(pcm, SAMPLE_RATE, SAMPLE_WIDTH)
 
     text = google_recognizer.recognize_google(audio, language=language)
 
-    os.remove(audio_file2)
-
     return text
 
 
-def stt(input_file: str, lang: str) -> str:
+class GoogleEngine:
+    """Free google speech recognition, needs network, segments up to a minute"""
+
+    name = 'google'
+
+    def supports(self, lang: str) -> bool:
+        return True
+
+    def warmup(self) -> None:
+        pass
+
+    def recognize(self, pcm: bytes, lang: str) -> str:
+        """Recognizes PCM from decode_audio, returns text, empty if nothing was said"""
+        import speech_recognition as sr
+        try:
+            return stt_google(pcm, lang)
+        except sr.UnknownValueError:
+            return ''
+
+
+class VoskEngine:
+    """Local offline recognition with vosk (kaldi) models, works on cpu.
+
+    A model is loaded once per language and stays in memory, the recognizers for it
+    are kept in a pool so parallel voice messages don't create them again.
+    models - {lang: path to the unpacked vosk model}"""
+
+    name = 'vosk'
+
+    def __init__(self, models: dict, pool_size: int = STT_WORKERS):
+        import vosk
+        vosk.SetLogLevel(-1)
+        self.vosk = vosk
+        self.paths = models
+        self.pool_size = pool_size
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def supports(self, lang: str) -> bool:
+        return lang in self.paths
+
+    def _pool(self, lang: str) -> queue.Queue:
+        with self.lock:
+            if lang not in self.pools:
+                model = self.vosk.Model(self.paths[lang])
+                pool = queue.Queue()
+                for _ in range(self.pool_size):
+                    pool.put(self.vosk.KaldiRecognizer(model, SAMPLE_RATE))
+                self.pools[lang] = pool
+            return self.pools[lang]
+
+    def warmup(self) -> None:
+        for lang in self.paths:
+            self._pool(lang)
+
+    def recognize(self, pcm: bytes, lang: str) -> str:
+        pool = self._pool(lang)
+        recognizer = pool.get()
+        try:
+            recognizer.AcceptWaveform(pcm)
+            # FinalResult also resets the recognizer for the next user
+            return json.loads(recognizer.FinalResult()).get('text', '')
+        finally:
+            pool.put(recognizer)
+
+
+ENGINES = {'google': GoogleEngine, 'vosk': VoskEngine}
+
+_ENGINE = None
+_FALLBACK = GoogleEngine()
+_ENGINE_LOCK = threading.Lock()
+
+
+def get_engine():
+    """The engine from cfg.stt_engine, created once. 'google' by default,
+    'vosk' needs cfg.vosk_models = {lang: path}"""
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            name = getattr(cfg, 'stt_engine', 'google')
+            try:
+                if name == 'vosk':
+                    _ENGINE = VoskEngine(getattr(cfg, 'vosk_models', {}))
+                else:
+                    _ENGINE = ENGINES[name]()
+            except Exception as error:
+                my_log.log2(f'my_stt:get_engine: {name}: {error}')
+                _ENGINE = _FALLBACK
+        return _ENGINE
+
+
+def warmup() -> None:
+    """Loads the models of the local engine, so the first voice message doesn't wait for it"""
+    try:
+        get_engine().warmup()
+    except Exception as error:
+        my_log.log2(f'my_stt:warmup: {error}')
+
+
+def split_audio(pcm: bytes, silences: list, max_seconds: float = MAX_SEGMENT) -> list:
+    """
+    Cuts long audio into segments not longer than max_seconds, in the middle of pauses
+    if possible.
+
+    Args:
+        pcm (bytes): Audio from decode_audio.
+        silences (list): Pauses from decode_audio.
+        max_seconds (float): The longest segment.
+
+    Returns:
+        list: PCM segments in order.
+    """
+    duration = audio_duration(pcm)
+    if duration <= max_seconds:
+        return [pcm,]
+
+    cuts = sorted((start + end) / 2 for start, end in silences)
+    bounds = [0.0]
+    while duration - bounds[-1] > max_seconds:
+        start = bounds[-1]
+        # the last pause before the limit, but not at the very start of the segment
+        i = bisect.bisect_right(cuts, start + max_seconds)
+        if i and cuts[i - 1] > start + 1:
+            bounds.append(cuts[i - 1])
+        else:
+            bounds.append(start + max_seconds)
+    bounds.append(duration)
+
+    frame = SAMPLE_RATE * SAMPLE_WIDTH
+    offsets = [int(x * SAMPLE_RATE) * SAMPLE_WIDTH for x in bounds]
+    offsets[-1] = len(pcm)
+    return [pcm[a:b] for a, b in zip(offsets, offsets[1:]) if b - a >= frame // 10]
+
+
+def recognize_segment(engine, pcm: bytes, language: str) -> str:
+    """engine.recognize for one segment of long audio, an error in one segment does not spoil others"""
+    try:
+        return engine.recognize(pcm, language)
+    except Exception as error:
+        print(error)
+        my_log.log2(f'my_stt:recognize_segment: {engine.name}: {error}')
+        return ''
+
+
+def stt(data: bytes, lang: str) -> str:
     """
-    Generate the function comment for the given function body in a markdown code block with the correct language syntax.
+    Recognizes speech in an audio file.
 
     Args:
-        input_file (str): The input file to be processed.
-        lang (str): The language of the input file.
+        data (bytes): The audio file as bytes, as downloaded from telegram.
+        lang (str): The language of the speech.
 
     Returns:
-        str: The text generated from the input file.
+        str: The recognized text or empty string.
 
     Raises:
         AssertionError: If an assertion error occurs during the execution.
@@ -81,10 +260,21 @@ def stt(input_file: str, lang: str) -> str:
         sr.RequestError: If a request error occurs during the execution.
         Exception: If any other unknown error occurs during the execution.
     """
+    # imported here and not at the start of the bot, it is needed only for voice messages
+    import speech_recognition as sr
     text = ''
 
     try:
-       text = stt_google(input_file, lang)
+        engine = get_engine()
+        if not engine.supports(lang):
+            engine = _FALLBACK
+        pcm, silences = decode_audio(data)
+        segments = split_audio(pcm, silences)
+        if len(segments) == 1:
+            text = engine.recognize(segments[0], lang)
+        else:
+            results = POOL.map(functools.partial(recognize_segment, engine, language=lang), segments)
+            text = ' '.join(x for x in results if x)
     except AssertionError:
         pass
     except sr.UnknownValueError as unknown_value_error:
@@ -101,4 +291,6 @@ def stt(input_file: str, lang: str) -> str:
 
 
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    # offline check of the configured engine: ./my_stt.py voice.ogg ru
+    with open(sys.argv[1], 'rb') as f:
+        print(stt(f.read(), sys.argv[2] if len(sys.argv) > 2 else 'ru'))
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""Lightweight tracing of the message pipeline, how long every stage takes.
+
+A handler opens a trace for the update, code inside marks its stages with spans:
+
+with my_trace.trace() as stages:
+    with my_trace.span('upstream'):
+        ...
+    # stages = {'upstream': 1.234, ...} seconds
+
+The trace lives in a context variable, so parallel handlers (every one in its own thread)
+don't mix their stages. Spans outside of a trace are still counted in the histograms.
+Spans can be nested, compression calls upstream for example, then both get the time.
+"""
+
+
+import atexit
+import bisect
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+
+
+# the stages of a text message in the order they happen
+STAGES = ('lock', 'translate', 'history', 'upstream', 'compress', 'render', 'split', 'send', 'total')
+
+# where /latency and exit save the histograms, a worker of the sharded mode (my_shard.py) has its own
+DUMP_PATH = f'logs/latency-shard-{os.environ["BOT_SHARD"]}.json' if os.environ.get('BOT_SHARD') else 'logs/latency.json'
+
+
+class Histogram:
+    """Thread safe histogram of durations with logarithmic buckets, 1 ms ... ~10 min, 25% wide.
+
+    Keeps no samples, so the memory doesn't grow, percentiles are estimated
+    within a bucket (error < 25%)."""
+
+    BOUNDS = tuple(0.001 * 1.25 ** i for i in range(60))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value: float) -> None:
+        i = bisect.bisect_left(self.BOUNDS, value)
+        with self.lock:
+            self.buckets[i] += 1
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def percentile(self, p: float) -> float:
+        """p - 0...100, the value below which p% of the records are"""
+        with self.lock:
+            if not self.count:
+                return 0.0
+            rank = self.count * p / 100
+            total = 0
+            for i, n in enumerate(self.buckets):
+                total += n
+                if n and total >= rank:
+                    low = self.BOUNDS[i - 1] if i else 0.0
+                    high = self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+                    # linear inside the bucket, but never out of the seen range
+                    value = low + (high - low) * (rank - (total - n)) / n
+                    return min(max(value, self.min), self.max)
+            return self.max
+
+    def cumulative(self) -> tuple:
+        """([(upper bound, records <= bound), ...], count, sum) as prometheus wants"""
+        with self.lock:
+            result = []
+            total = 0
+            for bound, n in zip(self.BOUNDS, self.buckets):
+                total += n
+                result.append((bound, total))
+            return result, self.count, self.sum
+
+    def snapshot(self) -> dict:
+        return {'count': self.count,
+                'avg': self.sum / self.count if self.count else 0.0,
+                'min': self.min or 0.0,
+                'max': self.max or 0.0,
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99)}
+
+
+# {stage: Histogram}
+HISTOGRAMS = {}
+_HISTOGRAMS_LOCK = threading.Lock()
+
+# stages of the current update {stage: seconds}, None outside of a trace
+_CURRENT = contextvars.ContextVar('my_trace', default=None)
+
+
+def histogram(name: str) -> Histogram:
+    """The histogram of the stage, created on the first use"""
+    result = HISTOGRAMS.get(name)
+    if result is None:
+        with _HISTOGRAMS_LOCK:
+            result = HISTOGRAMS.setdefault(name, Histogram())
+    return result
+
+
+def record(name: str, seconds: float) -> None:
+    """Adds the duration of the stage to its histogram and to the current trace"""
+    histogram(name).record(seconds)
+    stages = _CURRENT.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def span(name: str):
+    """Measures the block as the stage name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def trace(name: str = 'total'):
+    """Collects the stages of one update, yields the dict {stage: seconds},
+    the whole block is recorded as the stage name"""
+    stages = {}
+    token = _CURRENT.set(stages)
+    start = time.perf_counter()
+    try:
+        yield stages
+    finally:
+        _CURRENT.reset(token)
+        seconds = time.perf_counter() - start
+        histogram(name).record(seconds)
+        stages[name] = seconds
+
+
+@contextlib.contextmanager
+def locked(lock, name: str = 'lock'):
+    """with lock: that measures the waiting for the lock as the stage name"""
+    with span(name):
+        lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def stats() -> dict:
+    """{stage: {count, avg, min, max, p50, p95, p99}}, the known stages go first"""
+    names = [x for x in STAGES if x in HISTOGRAMS] + sorted(x for x in HISTOGRAMS if x not in STAGES)
+    return {x: HISTOGRAMS[x].snapshot() for x in names}
+
+
+def report() -> str:
+    """A text table of the stages for /latency, milliseconds"""
+    lines = [f'{"stage":<10} {"count":>7} {"p50":>7} {"p95":>7} {"p99":>7} {"max":>7}']
+    for name, x in stats().items():
+        lines.append(f'{name:<10} {x["count"]:>7} {x["p50"] * 1000:>7.0f} {x["p95"] * 1000:>7.0f} '
+                     f'{x["p99"] * 1000:>7.0f} {x["max"] * 1000:>7.0f}')
+    return '\n'.join(lines)
+
+
+def dump(path: str = DUMP_PATH) -> None:
+    """Saves stats() as json, seconds"""
+    if not HISTOGRAMS:
+        return
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'time': time.time(), 'stages': stats()}, f, indent=1)
+        os.replace(path + '.tmp', path)
+    except OSError as error:
+        print(f'my_trace:dump: {error}')
+
+
+atexit.register(dump)
+
+
+if __name__ == '__main__':
+    pass
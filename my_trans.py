@@ -3,8 +3,7 @@
 
 import subprocess
 
-from py_trans import PyTranslator
-
+import my_metrics
 import utils
 
 
@@ -23,6 +22,8 @@ def translate_text(text, lang):
     Returns:
         str or None: The translated text if the translation was successful, otherwise same text.
     """
+    # py_trans is slow to import and is needed only on windows
+    from py_trans import PyTranslator
     x = PyTranslator()
     r = x.translate(text, lang)
     if r['status'] == 'success':
@@ -63,8 +64,10 @@ def translate(text, lang):
         str: The translated text.
     """
     if (text, lang) in cached:
+        my_metrics.TRANSLATION_CACHE.inc(result='hit')
         return cached[(text, lang)]
-    
+    my_metrics.TRANSLATION_CACHE.inc(result='miss')
+
     if 'windows' in utils.platform().lower():
         translated = translate_text(text, lang)
     else:
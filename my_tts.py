@@ -1,21 +1,152 @@
 #!/usr/bin/env python3
 
 
+import collections
+import concurrent.futures
+import functools
+import hashlib
 import io
 import glob
 import os
+import re
+import subprocess
+import sys
+import threading
+import wave
 
-import gtts
-
+import cfg
+import my_dic
 import my_log
+import my_shard
+
+
+# synthesized audio is cached on disk by the hash of the text and language,
+# in the sharded mode every worker has its own folder and its part of the size
+CACHE_DIR = my_shard.path('db/tts_cache')
+CACHE_SIZE = getattr(cfg, 'tts_cache_size', 200 * 1024 * 1024) // my_shard.SHARDS
+
+# telegram file_id of already sent voice messages {cache key: file_id},
+# a repeated phrase is sent again without uploading. Only for the texts whose audio is in
+# CACHE, an id is forgotten with its audio, so there are no more of them than files.
+# sqlite - a new id doesn't rewrite all the others
+FILE_IDS = my_dic.SqliteDict(my_shard.path('db/tts_file_ids.db'), legacy_path=my_shard.path('db/tts_file_ids.pkl'))
+
+# longer texts are spoken by sentences in parallel and glued into one voice message
+PARALLEL_MIN = 300
+# sentences are grouped into pieces of about this size for one request
+PIECE_SIZE = 200
+POOL = concurrent.futures.ThreadPoolExecutor(max_workers=getattr(cfg, 'tts_workers', 4),
+                                             thread_name_prefix='tts')
+
+_SENTENCE_RE = re.compile(r'[^.!?…\n]*(?:[.!?…]+|\n|$)')
+
+
+class AudioCache:
+    """Content addressed files in a folder with LRU eviction when the folder becomes bigger
+    than max_size bytes. The order of use is kept in the file modification time."""
+
+    def __init__(self, path: str, max_size: int, on_evict=None):
+        self.path = path
+        self.max_size = max_size
+        # on_evict(key) is called for every evicted file
+        self.on_evict = on_evict
+        self.lock = threading.Lock()
+        # {key: size}, the oldest first, read from the folder on first use
+        self.index = None
+        self.size = 0
 
+    def _load(self) -> None:
+        if self.index is not None:
+            return
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        files.sort()
+        self.index = collections.OrderedDict((name, size) for _, name, size in files)
+        self.size = sum(self.index.values())
 
-# cleanup
-for filePath in [x for x in glob.glob('*.wav') + glob.glob('*.ogg') if 'temp_tts_file' in x]:
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            self._load()
+            return key in self.index
+
+    def get(self, key: str):
+        """Returns the cached bytes or None"""
+        with self.lock:
+            self._load()
+            if key not in self.index:
+                return None
+            self.index.move_to_end(key)
+        file_path = os.path.join(self.path, key)
+        try:
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            os.utime(file_path)
+            return data
+        except OSError as error:
+            my_log.log2(f'my_tts:AudioCache:get: {error}')
+            with self.lock:
+                self.size -= self.index.pop(key, 0)
+            return None
+
+    def put(self, key: str, data: bytes) -> None:
+        with self.lock:
+            self._load()
+            file_path = os.path.join(self.path, key)
+            try:
+                with open(file_path + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(file_path + '.tmp', file_path)
+            except OSError as error:
+                my_log.log2(f'my_tts:AudioCache:put: {error}')
+                return
+            self.size += len(data) - self.index.pop(key, 0)
+            self.index[key] = len(data)
+            while self.size > self.max_size and len(self.index) > 1:
+                old_key, old_size = self.index.popitem(last=False)
+                self.size -= old_size
+                try:
+                    os.remove(os.path.join(self.path, old_key))
+                except OSError as error:
+                    my_log.log2(f'my_tts:AudioCache:evict: {error}')
+                if self.on_evict:
+                    self.on_evict(old_key)
+
+
+def _forget_file_id(key: str) -> None:
     try:
-        os.remove(filePath)
-    except Exception as error:
-        my_log.log2(f"Error while deleting file : {filePath}\n\n{error}")
+        del FILE_IDS[key]
+    except KeyError:
+        pass
+
+
+CACHE = AudioCache(CACHE_DIR, CACHE_SIZE, on_evict=_forget_file_id)
+
+
+def cache_key(text: str, lang: str) -> str:
+    """The same text with different spaces and line breaks gives the same key,
+    different engines give different keys"""
+    normalized = ' '.join(text.split())
+    engine = engine_for(lang).name
+    return hashlib.sha256(f'{engine}\0{lang}\0{normalized}'.encode('utf-8')).hexdigest()
+
+
+def get_file_id(text: str, lang: str):
+    """telegram file_id of this text already sent as voice or None"""
+    return FILE_IDS.get(cache_key(text, lang))
+
+
+def set_file_id(text: str, lang: str, file_id: str = None) -> None:
+    """Remembers the file_id of the sent voice if its audio is cached, None forgets it"""
+    key = cache_key(text, lang)
+    if file_id and key in CACHE:
+        FILE_IDS[key] = file_id
+    elif not file_id:
+        _forget_file_id(key)
 
 
 def tts_google(text: str, lang: str) -> bytes:
@@ -30,18 +161,204 @@ def tts_google(text: str, lang: str) -> bytes:
         bytes: The audio file in the form of bytes.
     """
     mp3_fp = io.BytesIO()
+    import gtts
     result = gtts.gTTS(text, lang=lang)
     result.write_to_fp(mp3_fp)
     mp3_fp.seek(0)
     return mp3_fp.read()
 
 
+def split_sentences(text: str, size: int = PIECE_SIZE) -> list:
+    """Splits the text by sentences and groups them into pieces of about size characters"""
+    pieces = []
+    piece = ''
+    for sentence in _SENTENCE_RE.findall(text):
+        if piece and len(piece) + len(sentence) > size:
+            pieces.append(piece)
+            piece = ''
+        piece += sentence
+    if piece.strip():
+        pieces.append(piece)
+    return [x.strip() for x in pieces if x.strip()]
+
+
+def to_ogg(audio: bytes, input_format: str = 'mp3') -> bytes:
+    """Encodes audio to ogg/opus for telegram voice messages with one FFmpeg process over pipes"""
+    result = subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', input_format, '-i', 'pipe:0',
+                             '-c:a', 'libopus', '-b:a', '32k', '-f', 'ogg', 'pipe:1'],
+                            input=audio, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0 or not result.stdout:
+        raise RuntimeError(f'ffmpeg: {result.stderr.decode("utf-8", errors="replace").strip()}')
+    return result.stdout
+
+
+def tts_google_parallel(text: str, lang: str) -> bytes:
+    """
+    Speaks a long text with gTTS sentence by sentence in parallel, the time is about the time
+    of the longest piece instead of the sum.
+
+    Returns:
+        bytes: ogg/opus voice, or glued mp3 if ffmpeg failed.
+    """
+    pieces = split_sentences(text)
+    mp3 = b''.join(POOL.map(functools.partial(tts_google, lang=lang), pieces))
+    try:
+        return to_ogg(mp3)
+    except Exception as error:
+        my_log.log2(f'my_tts:tts_google_parallel: {error}')
+        # mp3 frames can be simply glued together
+        return mp3
+
+
+class GoogleEngine:
+    """gTTS, needs network, gives mp3 for short texts and ogg for long ones"""
+
+    name = 'google'
+
+    def supports(self, lang: str) -> bool:
+        return True
+
+    def warmup(self) -> None:
+        pass
+
+    def synthesize(self, text: str, lang: str) -> bytes:
+        if len(text) > PARALLEL_MIN:
+            return tts_google_parallel(text, lang)
+        return tts_google(text, lang)
+
+
+class EspeakEngine:
+    """Local espeak-ng, a small program without models, the voice is robotic but fast.
+    voices - {lang: espeak voice}, by default the voice is the language code"""
+
+    name = 'espeak'
+
+    def __init__(self, voices: dict = None):
+        self.voices = voices or {}
+
+    def supports(self, lang: str) -> bool:
+        return True
+
+    def warmup(self) -> None:
+        pass
+
+    def synthesize(self, text: str, lang: str) -> bytes:
+        result = subprocess.run(['espeak-ng', '--stdout', '--stdin', '-v', self.voices.get(lang, lang)],
+                                input=text.encode('utf-8'), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0 or not result.stdout:
+            raise RuntimeError(f'espeak-ng: {result.stderr.decode("utf-8", errors="replace").strip()}')
+        return to_ogg(result.stdout, 'wav')
+
+
+class PiperEngine:
+    """Local neural voices of piper (onnx), work on cpu.
+    A voice is loaded once per language and stays in memory.
+    models - {lang: path to the .onnx voice}"""
+
+    name = 'piper'
+
+    def __init__(self, models: dict):
+        from piper.voice import PiperVoice
+        self.loader = PiperVoice
+        self.paths = models
+        self.voices = {}
+        self.lock = threading.Lock()
+
+    def supports(self, lang: str) -> bool:
+        return lang in self.paths
+
+    def _voice(self, lang: str):
+        with self.lock:
+            if lang not in self.voices:
+                self.voices[lang] = self.loader.load(self.paths[lang])
+            return self.voices[lang]
+
+    def warmup(self) -> None:
+        for lang in self.paths:
+            self._voice(lang)
+
+    def synthesize(self, text: str, lang: str) -> bytes:
+        voice = self._voice(lang)
+        wav_fp = io.BytesIO()
+        with wave.open(wav_fp, 'wb') as wav_file:
+            if hasattr(voice, 'synthesize_wav'):
+                voice.synthesize_wav(text, wav_file)
+            else:
+                voice.synthesize(text, wav_file)
+        return to_ogg(wav_fp.getvalue(), 'wav')
+
+
+_ENGINE = None
+_FALLBACK = GoogleEngine()
+_ENGINE_LOCK = threading.Lock()
+
+
+def get_engine():
+    """The engine from cfg.tts_engine, created once. 'google' by default,
+    'espeak' can use cfg.espeak_voices, 'piper' needs cfg.piper_models = {lang: path}"""
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            name = getattr(cfg, 'tts_engine', 'google')
+            try:
+                if name == 'espeak':
+                    _ENGINE = EspeakEngine(getattr(cfg, 'espeak_voices', {}))
+                elif name == 'piper':
+                    _ENGINE = PiperEngine(getattr(cfg, 'piper_models', {}))
+                else:
+                    _ENGINE = _FALLBACK
+            except Exception as error:
+                my_log.log2(f'my_tts:get_engine: {name}: {error}')
+                _ENGINE = _FALLBACK
+        return _ENGINE
+
+
+def engine_for(lang: str):
+    """The configured engine or google if it has no voice for this language"""
+    engine = get_engine()
+    return engine if engine.supports(lang) else _FALLBACK
+
+
+def cleanup() -> None:
+    """Removes the temp files left in the bot folder by the old versions that synthesized through files"""
+    for filePath in [x for x in glob.glob('*.wav') + glob.glob('*.ogg') if 'temp_tts_file' in x]:
+        try:
+            os.remove(filePath)
+        except Exception as error:
+            my_log.log2(f"Error while deleting file : {filePath}\n\n{error}")
+
+
+def warmup() -> None:
+    """Loads the voices of the local engine, so the first /tts doesn't wait for it.
+    Runs in background after the start, the cleanup of the folder is done here too"""
+    cleanup()
+    try:
+        get_engine().warmup()
+    except Exception as error:
+        my_log.log2(f'my_tts:warmup: {error}')
+
+
 def tts(text: str, lang: str) -> bytes:
     text = text.replace('\r','') 
     text = text.replace('\n\n','\n')  
 
-    return tts_google(text, lang)
+    engine = engine_for(lang)
+    key = cache_key(text, lang)
+    audio = CACHE.get(key)
+    if audio is None:
+        try:
+            audio = engine.synthesize(text, lang)
+        except Exception as error:
+            if engine is _FALLBACK:
+                raise
+            my_log.log2(f'my_tts:tts: {engine.name}: {error}')
+            # not cached, the key belongs to the local engine
+            return _FALLBACK.synthesize(text, lang)
+        if audio:
+            CACHE.put(key, audio)
+    return audio
 
 
 if __name__ == "__main__":
-    pass
\ No newline at end of file
+    # offline check of the configured engine: ./my_tts.py ru "text" > voice.ogg
+    sys.stdout.buffer.write(tts(sys.argv[2], sys.argv[1]))
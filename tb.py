@@ -7,26 +7,44 @@ import os
 import re
 import time
 import threading
-import tempfile
+
+# startup time report, see main()
+START_TIME = time.perf_counter()
 
 import telebot
 
 import cfg
 import gpt_basic
+import my_context
 import my_dic
+import my_history
 import my_log
+import my_metrics
+import my_render
+import my_sender
+import my_shard
 import my_trans
 import my_tts
 import my_stt
+import my_trace
 import utils
 
 
+# processes for big answers are forked now, while the bot has no threads
+my_render.start()
+
+
 # set the working folder = the folder where the script is located
 os.chdir(os.path.abspath(os.path.dirname(__file__)))
 
 
-bot = telebot.TeleBot(cfg.token, skip_pending=True)
-BOT_ID = bot.get_me().id
+# all outgoing messages go through the my_sender queue that respects telegram limits.
+# updates that came while the bot was restarting are processed, not skipped.
+# the workers of the sharded mode share the limit of the bot, a chat is always in one worker
+bot = my_sender.TeleBot(cfg.token, skip_pending=getattr(cfg, 'skip_pending', False),
+                        scheduler=my_sender.SendScheduler(global_rate=my_sender.GLOBAL_RATE / my_shard.SHARDS))
+# id of the bot, known after bot.get_me() in main()
+BOT_ID = None
 
 
 # folder for permanent dictionaries, bot memory
@@ -39,8 +57,15 @@ GPT_MAX = 4000
 # saved pairs of {{id:(url, token, lang)}}
 DB = gpt_basic.TOKENS
 
-# хранилище для переводов сообщений сделанных гугл переводчиком
-AUTO_TRANSLATIONS = my_dic.PersistentDict('db/auto_translations.pkl')
+# хранилище для переводов сообщений сделанных гугл переводчиком, общее для всех процессов шардированного режима
+AUTO_TRANSLATIONS = my_shard.shared('db/auto_translations.pkl', ttl=getattr(cfg, 'shared_cache_ttl', 5))
+
+# /image draws this many pictures of this size
+IMAGE_AMOUNT = 4
+IMAGE_SIZE = '1024x1024'
+# telegram file_ids of drawn pictures {(prompt, size): [file_id]}, a repeated prompt is answered at once
+IMAGE_FILE_IDS = my_dic.PersistentDict(my_shard.path('db/image_file_ids.pkl'))
+IMAGE_CACHE_SIZE = 1000
 
 
 supported_langs_trans = [
@@ -143,8 +168,11 @@ def tr(text: str, lang: str) -> str:
     """
     key = str((text, lang))
     if key in AUTO_TRANSLATIONS:
+        my_metrics.TRANSLATION_CACHE.inc(result='hit')
         return AUTO_TRANSLATIONS[key]
-    translated = my_trans.translate_text2(text, lang)
+    my_metrics.TRANSLATION_CACHE.inc(result='miss')
+    with my_trace.span('translate'):
+        translated = my_trans.translate_text2(text, lang)
     if translated:
         AUTO_TRANSLATIONS[key] = translated
     else:
@@ -156,7 +184,27 @@ def tr(text: str, lang: str) -> str:
 def restart(message: telebot.types.Message):
     """bot stop. after stopping it will have to restart the systemd script"""
     if message.from_user.id in cfg.admins:
+        if my_shard.SHARD is not None:
+            # the dispatcher stops all the workers
+            my_shard.restart()
+            return
         bot.stop_polling()
+        # confirm the updates received so far so the new process doesn't get this /restart again,
+        # telegram also ends the pending long poll with 409 and the bot exits at once
+        try:
+            bot.get_updates(offset=bot.last_update_id + 1, timeout=1, long_polling_timeout=0)
+        except Exception as error:
+            my_log.log2(f'tb:restart: {error}')
+    else:
+        bot.reply_to(message, 'For admins only.')
+
+
+@bot.message_handler(commands=['latency'])
+def latency(message: telebot.types.Message):
+    """time of the stages of text messages, p50/p95/p99 in ms, also saved to logs/latency.json"""
+    if message.from_user.id in cfg.admins:
+        my_trace.dump()
+        bot.reply_to(message, f'<code>{html.escape(my_trace.report())}</code>', parse_mode='HTML')
     else:
         bot.reply_to(message, 'For admins only.')
 
@@ -369,9 +417,8 @@ def set_default_commands_thread(message: telebot.types.Message):
 
 @bot.message_handler(commands=['test'])
 def test(message: telebot.types.Message) -> None:
-    user_id = message.from_user.id
-    lang = DB[user_id][2] if user_id in DB else message.from_user.language_code or 'en'
-    
+    lang = my_context.of(message).lang
+
     name = bot.get_my_name(lang)
     bot.reply_to(message, name)
 
@@ -434,8 +481,9 @@ def send_debug_history(message: telebot.types.Message):
     """
     my_log.log_echo(message)
 
-    chat_id = message.chat.id
-    lang = DB[chat_id][2] if chat_id in DB else message.from_user.language_code or 'en'
+    context = my_context.of(message)
+    chat_id = context.id
+    lang = context.lang
 
     # создаем новую историю диалогов с юзером из старой если есть
     messages = []
@@ -456,8 +504,9 @@ def image_thread(message: telebot.types.Message):
 
     my_log.log_echo(message)
 
-    chat_id = message.chat.id
-    lang = DB[chat_id][2] if chat_id in DB else message.from_user.language_code or 'en'
+    context = my_context.of(message)
+    chat_id = context.id
+    lang = context.lang
 
     help = f"/image <{tr('text description of the picture, what to draw', lang)}>"
 
@@ -470,28 +519,90 @@ def image_thread(message: telebot.types.Message):
 
     if len(prompt) > 1:
         with ShowAction(message, 'upload_photo'):
-            images = gpt_basic.image_gen(prompt, chat_id, amount=4, size='1024x1024')
-            medias = [telebot.types.InputMediaPhoto(i) for i in images]
-            if len(medias) > 0:
-                bot.send_media_group(message.chat.id, medias, reply_to_message_id=message.message_id)
-
+            start_time = time.perf_counter()
+            key = (prompt, IMAGE_SIZE)
+            file_ids = IMAGE_FILE_IDS.get(key)
+            cached = False
+            if file_ids:
+                try:
+                    _send_photos(message, file_ids)
+                    cached = True
+                except Exception as error:
+                    # телеграм забыл картинки, рисуются заново
+                    my_log.log2(f'tb:image: cached {key}: {error}')
+                    IMAGE_FILE_IDS.pop(key, None)
+            if cached:
+                latencies = []
+            else:
+                file_ids, latencies = send_images(message, prompt, context)
+                if file_ids:
+                    IMAGE_FILE_IDS[key] = file_ids
+                    # самые старые забываются
+                    while len(IMAGE_FILE_IDS) > IMAGE_CACHE_SIZE:
+                        del IMAGE_FILE_IDS[next(iter(IMAGE_FILE_IDS))]
+            my_log.log_event('image', chat_id=chat_id, user_id=message.from_user.id, cached=cached,
+                             images=len(file_ids), latencies=latencies,
+                             latency=round(time.perf_counter() - start_time, 3))
+            if file_ids:
                 my_log.log_echo(message, '[image gen] ')
 
                 n = [{'role':'system', 'content':f'user {tr("asked me to draw", lang)}\n{prompt}'}, 
                         {'role':'system', 'content':f'assistant {tr("drawn using DALL-E", lang)}'}]
                 if chat_id in gpt_basic.CHATS:
-                    gpt_basic.CHATS[chat_id] += n
+                    gpt_basic.CHATS[chat_id] = my_history.History.of(gpt_basic.CHATS[chat_id]) + n
                 else:
-                    gpt_basic.CHATS[chat_id] = n
+                    gpt_basic.CHATS[chat_id] = my_history.History.of(n)
             else:
                 bot.reply_to(message, tr("I couldn’t draw anything. Maybe I’m not in the mood, or maybe you need to give a different description.", lang))
                 my_log.log_echo(message, '[image gen error] ')
                 n = [{'role':'system', 'content':f'user {tr("asked me to draw", lang)}\n{prompt}'}, 
                         {'role':'system', 'content':f'assistant {tr("didn’t want to or couldn’t draw it using DALL-E", lang)}'}]
                 if chat_id in gpt_basic.CHATS:
-                    gpt_basic.CHATS[chat_id] += n
+                    gpt_basic.CHATS[chat_id] = my_history.History.of(gpt_basic.CHATS[chat_id]) + n
                 else:
-                    gpt_basic.CHATS[chat_id] = n
+                    gpt_basic.CHATS[chat_id] = my_history.History.of(n)
+
+
+def send_images(message: telebot.types.Message, prompt: str, context: my_context.RequestContext) -> tuple:
+    """Draws IMAGE_AMOUNT pictures at the same time, the first one is sent as soon as it is
+    ready, the others when all are done (or the time is out).
+    Returns telegram file_ids of the pictures that reached the user and the seconds each one took."""
+    file_ids = []
+    latencies = []
+    rest = []
+    for url, data, seconds in gpt_basic.image_gen_iter(prompt, context.id, amount=IMAGE_AMOUNT, size=IMAGE_SIZE,
+                                                       context=context):
+        latencies.append(round(seconds, 3))
+        # телеграм скачает сам если у нас не получилось
+        photo = data or url
+        if file_ids:
+            rest.append(photo)
+            continue
+        # пока до юзера ничего не дошло готовая картинка отправляется сразу
+        try:
+            file_ids += _send_photos(message, [photo])
+        except Exception as error:
+            my_log.log2(f'tb:send_images: {error}')
+    if rest:
+        try:
+            file_ids += _send_photos(message, rest)
+        except Exception as error:
+            my_log.log2(f'tb:send_images: {error}')
+    return file_ids, latencies
+
+
+def _send_photos(message: telebot.types.Message, photos: list) -> list:
+    """Sends pictures (bytes, urls or file_ids) in reply to the message, one as a photo, more
+    as an album (a media group takes 2-10 items). Returns file_ids of the sent pictures."""
+    if len(photos) == 1:
+        return _photo_ids([bot.send_photo(message.chat.id, photos[0], reply_to_message_id=message.message_id)])
+    return _photo_ids(bot.send_media_group(message.chat.id, [telebot.types.InputMediaPhoto(x) for x in photos],
+                                           reply_to_message_id=message.message_id))
+
+
+def _photo_ids(messages: list) -> list:
+    """file_id of the biggest size of the photos in the sent messages"""
+    return [x.photo[-1].file_id for x in messages if x and x.photo]
 
 
 @bot.message_handler(commands=['model'])
@@ -502,17 +613,14 @@ def set_new_model(message: telebot.types.Message):
 def set_new_model_thread(message: telebot.types.Message):
     """меняет модель для гпт, никаких проверок не делает"""
 
-    chat_id = message.chat.id
-    lang = DB[chat_id][2] if chat_id in DB else message.from_user.language_code or 'en'
-
-    if chat_id in gpt_basic.CUSTOM_MODELS:
-        current_model = gpt_basic.CUSTOM_MODELS[chat_id]
-    else:
-        current_model = cfg.model
+    context = my_context.of(message)
+    chat_id = context.id
+    lang = context.lang
+    current_model = context.model
 
     if len(message.text.split()) < 2:
         available_models = ''
-        for m in gpt_basic.get_list_of_models(chat_id):
+        for m in gpt_basic.get_list_of_models(chat_id, context=context):
             available_models += f'`/model {m}`\n'
         msg = f"""{tr('Change the model for chatGPT.', lang)}
 
@@ -569,8 +677,9 @@ def set_new_temperature(message: telebot.types.Message):
     и желания давать ответ
     """
 
-    chat_id = message.chat.id
-    lang = DB[chat_id][2] if chat_id in DB else message.from_user.language_code or 'en'
+    context = my_context.of(message)
+    chat_id = context.id
+    lang = context.lang
 
     if len(message.text.split()) == 2:
         try:
@@ -615,40 +724,46 @@ def handle_voice_thread(message: telebot.types.Message):
     """voice handler"""
 
     my_log.log_media(message)
-    
-    user_id = message.from_user.id
-    chat_id = message.chat.id
-    is_private = message.chat.type == 'private'
-    if not is_private:
-        user_id = chat_id
 
-    lang = DB[user_id][2] if user_id in DB else message.from_user.language_code or 'en'
+    context = my_context.of(message)
+    chat_id = context.chat_id
+    lang = context.lang
 
-    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-        file_path = temp_file.name
     try:
         file_info = bot.get_file(message.voice.file_id)
     except AttributeError:
         file_info = bot.get_file(message.audio.file_id)
     downloaded_file = bot.download_file(file_info.file_path)
-    with open(file_path, 'wb') as new_file:
-        new_file.write(downloaded_file)
 
     with ShowAction(message, 'typing'):
-        text = my_stt.stt(file_path, lang)
-        os.remove(file_path)
+        start_time = time.perf_counter()
+        text = my_stt.stt(downloaded_file, lang)
         text = text.strip()
-        if text:
-            reply_to_long_message(message, text)
-            my_log.log_echo(message, f'[ASR] {text}')
-        else:
+        my_log.log_event('voice', chat_id=chat_id, user_id=message.from_user.id, lang=lang,
+                         latency=round(time.perf_counter() - start_time, 3), size=len(downloaded_file),
+                         duration=(message.voice or message.audio).duration, answer_size=len(text))
+        if not text:
             msg = tr('Did not recognize any text.', lang)
             bot.reply_to(message, msg)
             my_log.log_echo(message, '[ASR] no results')
+            return
+
+        # the transcript is sent while the chat is thinking, my_sender keeps it before the answer
+        for chunk in utils.split_text(text, 4000):
+            bot.send_message_async(chat_id, chunk, reply_to_message_id=message.message_id)
+        my_log.log_echo(message, f'[ASR] {text}')
 
-        if text:
-            message.text = text
-            echo_all(message)
+        # the same checks as for a text message, the transcript goes straight to the chat
+        is_reply = message.reply_to_message and message.reply_to_message.from_user.id == BOT_ID
+        if not has_key(message, context):
+            return
+        if not (context.is_private or is_reply or text.lower().startswith(cfg.BOT_CALL_WORD)):
+            return
+        if len(text) > GPT_MAX:
+            bot.reply_to(message, f'{tr("Message too long:", lang)} {len(text)} {tr("of", lang)} {GPT_MAX}')
+            return
+        # the 'message' event counts from here like for a text, stt is in the 'voice' one
+        chat_turn(message, text, context, time.perf_counter())
 
 
 @bot.message_handler(commands=['tts']) 
@@ -661,13 +776,8 @@ def tts_thread(message: telebot.types.Message):
 
     my_log.log_echo(message)
 
-    user_id = message.from_user.id
     chat_id = message.chat.id
-    is_private = message.chat.type == 'private'
-    if not is_private:
-        user_id = chat_id
-
-    lang = DB[user_id][2] if user_id in DB else message.from_user.language_code or 'en'
+    lang = my_context.of(message).lang
 
     text = ''
     try:
@@ -681,11 +791,32 @@ def tts_thread(message: telebot.types.Message):
         bot.reply_to(message, msg)
         return
 
+    start_time = time.perf_counter()
+
+    # the same text was already sent, telegram has it
+    file_id = my_tts.get_file_id(text, lang)
+    if file_id:
+        try:
+            bot.send_voice(message.chat.id, file_id, reply_to_message_id = message.message_id)
+            my_log.log_echo(message, '[Send voice message] [cached]')
+            my_log.log_event('tts', chat_id=chat_id, user_id=message.from_user.id, lang=lang, cached=True,
+                             latency=round(time.perf_counter() - start_time, 3), query_size=len(text))
+            return
+        except Exception as error:
+            my_log.log2(f'tb:tts: {error}')
+            my_tts.set_file_id(text, lang, None)
+
     with ShowAction(message, 'record_audio'):
         audio = my_tts.tts(text, lang)
         if audio:
-            bot.send_voice(message.chat.id, audio, reply_to_message_id = message.message_id)
+            sent = bot.send_voice(message.chat.id, audio, reply_to_message_id = message.message_id)
+            media = sent.voice or sent.audio or sent.document
+            if media:
+                my_tts.set_file_id(text, lang, media.file_id)
             my_log.log_echo(message, '[Send voice message]')
+            my_log.log_event('tts', chat_id=chat_id, user_id=message.from_user.id, lang=lang, cached=False,
+                             latency=round(time.perf_counter() - start_time, 3), query_size=len(text),
+                             size=len(audio))
         else:
             msg = tr('TTS failed.', lang)
             bot.reply_to(message, msg)
@@ -699,16 +830,8 @@ def trans(message: telebot.types.Message):
 def trans_thread(message: telebot.types.Message):
 
     my_log.log_echo(message)
-    
-    user_id = message.from_user.id
-    chat_id = message.chat.id
-    is_private = message.chat.type == 'private'
-    if not is_private:
-        user_id = chat_id
-    if user_id in DB:
-        user_lang = DB[user_id][2]
-    else:
-        user_lang = message.from_user.language_code or 'en'
+
+    user_lang = my_context.of(message).lang
 
     help = """@trans [en|ru|uk|..] text to be translated into the specified language
 
@@ -760,32 +883,33 @@ def reply_to_long_message(message: telebot.types.Message, resp: str, parse_mode:
     """send the message; if it is too long, it splits it into 2 parts or sends it as a text file"""
 
     if len(resp) < 20000:
-        if parse_mode == 'HTML':
-            chunks = utils.split_html(resp, 4000)
-        else:
-            chunks = utils.split_text(resp, 4000)
+        with my_trace.span('split'):
+            if parse_mode == 'HTML':
+                chunks = my_render.split_html(resp, 4000)
+            else:
+                chunks = utils.split_text(resp, 4000)
         counter = len(chunks)
         for chunk in chunks:
-            try:
-                if send_message:
-                    bot.send_message(message.chat.id, chunk, message_thread_id=message.message_thread_id, parse_mode=parse_mode,
-                                        disable_web_page_preview=disable_web_page_preview, reply_markup=reply_markup)
-                else:
-                    bot.reply_to(message, chunk, parse_mode=parse_mode,
-                            disable_web_page_preview=disable_web_page_preview, reply_markup=reply_markup)
-            except Exception as error:
-                print(error)
-                my_log.log2(f'tb:reply_to_long_message: {error}')
-                if send_message:
-                    bot.send_message(message.chat.id, chunk, message_thread_id=message.message_thread_id, parse_mode='',
-                                        disable_web_page_preview=disable_web_page_preview, reply_markup=reply_markup)
-                else:
-                    bot.reply_to(message, chunk, parse_mode='', disable_web_page_preview=disable_web_page_preview, reply_markup=reply_markup)
+            with my_trace.span('send'):
+                try:
+                    if send_message:
+                        bot.send_message(message.chat.id, chunk, message_thread_id=message.message_thread_id, parse_mode=parse_mode,
+                                            disable_web_page_preview=disable_web_page_preview, reply_markup=reply_markup)
+                    else:
+                        bot.reply_to(message, chunk, parse_mode=parse_mode,
+                                disable_web_page_preview=disable_web_page_preview, reply_markup=reply_markup)
+                except Exception as error:
+                    print(error)
+                    my_log.log2(f'tb:reply_to_long_message: {error}')
+                    if send_message:
+                        bot.send_message(message.chat.id, chunk, message_thread_id=message.message_thread_id, parse_mode='',
+                                            disable_web_page_preview=disable_web_page_preview, reply_markup=reply_markup)
+                    else:
+                        bot.reply_to(message, chunk, parse_mode='', disable_web_page_preview=disable_web_page_preview, reply_markup=reply_markup)
 
             counter -= 1
             if counter < 0:
                 break
-            time.sleep(2)
     else:
         buf = io.BytesIO()
         buf.write(resp.encode())
@@ -800,15 +924,11 @@ def clear(message: telebot.types.Message) -> None:
     thread.start()
 def clear_thread(message):
     """start new dialog"""
-    user_id = message.from_user.id
-    chat_id = message.chat.id
-    is_private = message.chat.type == 'private'
-    if not is_private:
-        user_id = chat_id
     my_log.log_echo(message)
-    lang = DB[user_id][2] if user_id in DB else message.from_user.language_code or 'en'
-    if user_id in DB:
-        gpt_basic.chat_reset(user_id)
+    context = my_context.of(message)
+    lang = context.lang
+    if context.registered:
+        gpt_basic.chat_reset(context.id)
         translated = tr('New dialog started.', lang)
         bot.reply_to(message, translated)
         my_log.log_echo(message, translated)
@@ -825,28 +945,16 @@ def echo_all(message: telebot.types.Message) -> None:
     thread.start()
 def do_task(message):
     """Text message handler threaded"""
-    user_id = message.from_user.id
-    chat_id = message.chat.id
-
-    is_private = message.chat.type == 'private'
+    start_time = time.perf_counter()
+    context = my_context.of(message)
+    lang = context.lang
     is_reply = message.reply_to_message and message.reply_to_message.from_user.id == BOT_ID
-    lang = DB[user_id][2] if user_id in DB else message.from_user.language_code or 'en'
-    
-    if not is_private:
-        user_id = chat_id
 
-    if user_id not in DB or DB[user_id][1] == '':
-        if is_private:
-            msg = tr('You have to provide a key. Use [/key] command.', lang)
-        else:
-            msg = tr('You have to provide a key. Use [/key copy] command to copy your private token.', lang)
-        bot.reply_to(message, msg, parse_mode='HTML')
-        my_log.log_echo(message)
-        my_log.log_echo(message, msg)
+    if not has_key(message, context):
         return
 
     # bot can answer it chats if it is reply to his answer or code word was used
-    if not (is_private or is_reply or message.text.lower().startswith(cfg.BOT_CALL_WORD)):
+    if not (context.is_private or is_reply or message.text.lower().startswith(cfg.BOT_CALL_WORD)):
         return
 
     my_log.log_echo(message)
@@ -857,6 +965,31 @@ def do_task(message):
         my_log.log_echo(message, msg)
         return
     with ShowAction(message, 'typing'):
+        chat_turn(message, message.text, context, start_time)
+
+
+def has_key(message: telebot.types.Message, context: my_context.RequestContext) -> bool:
+    """True if there is a key for the chat, otherwise tells the user how to set it"""
+    if context.has_key:
+        return True
+    if context.is_private:
+        msg = tr('You have to provide a key. Use [/key] command.', context.lang)
+    else:
+        msg = tr('You have to provide a key. Use [/key copy] command to copy your private token.', context.lang)
+    bot.reply_to(message, msg, parse_mode='HTML')
+    my_log.log_echo(message)
+    my_log.log_echo(message, msg)
+    return False
+
+
+def chat_turn(message: telebot.types.Message, text: str, context: my_context.RequestContext,
+              start_time: float) -> None:
+    """One turn of the dialog: text goes to the chat, the answer is rendered and sent as a reply
+    to message. The caller has checked the key and the call word and shows the typing action.
+    Text messages come here from do_task, recognized voice from handle_voice_thread."""
+    lang = context.lang
+    is_private = context.is_private
+    with my_trace.trace() as stages:
         try:
             if is_private:
                 user_name = (message.from_user.first_name or '') + ' ' + (message.from_user.last_name or '')
@@ -867,10 +1000,11 @@ def do_task(message):
             if chat_name:
                 user_name = chat_name
 
-            answer = gpt_basic.chat(user_id, message.text, user_name, lang, is_private,
-                                    chat_name)
+            answer = gpt_basic.chat(context.id, text, user_name, lang, is_private,
+                                    chat_name, context=context)
 
-            answer = utils.bot_markdown_to_html(answer)
+            with my_trace.span('render'):
+                answer = my_render.bot_markdown_to_html(answer)
             my_log.log_echo(message, answer)
             if answer:
                 try:
@@ -881,13 +1015,17 @@ def do_task(message):
                     my_log.log2(f'tb:do_task: {error}')
                     reply_to_long_message(message, answer, parse_mode='',
                                           disable_web_page_preview = True)
+                my_log.log_event('message', chat_id=message.chat.id, user_id=message.from_user.id,
+                                 private=is_private, model=context.model,
+                                 latency=round(time.perf_counter() - start_time, 3),
+                                 query_size=len(text), answer_size=len(answer),
+                                 stages={x: round(y, 3) for x, y in stages.items()})
             else:
                 translated = tr('chatGPT did not answer.', lang)
                 bot.reply_to(message, translated)
         except Exception as error3:
             print(error3)
             my_log.log2(str(error3))
-        return
 
 
 def main():
@@ -895,7 +1033,31 @@ def main():
     Runs the main function, which sets default commands and starts polling the bot.
     """
     # set_default_commands()
-    bot.polling(timeout=90, long_polling_timeout=90)
+    global BOT_ID
+    imported = time.perf_counter()
+    BOT_ID = bot.get_me().id
+    ready = time.perf_counter()
+    print(f'Started in {ready - START_TIME:.2f}s: imports {imported - START_TIME:.2f}s, '
+          f'get_me {ready - imported:.2f}s')
+    my_log.log_event('startup', imports=round(imported - START_TIME, 3), get_me=round(ready - imported, 3),
+                     total=round(ready - START_TIME, 3))
+    # load local speech recognition and synthesis models in background
+    threading.Thread(target=my_stt.warmup, daemon=True).start()
+    threading.Thread(target=my_tts.warmup, daemon=True).start()
+    # optional local endpoint for prometheus
+    if getattr(cfg, 'metrics_port', None):
+        my_metrics.Gauge('bot_handler_queue_depth', 'Updates waiting for a handler thread',
+                         function=lambda: bot.worker_pool.tasks.qsize() if bot.worker_pool else 0)
+        my_metrics.Gauge('bot_send_queue_depth', 'Telegram requests waiting in the send queue',
+                         function=lambda: len(bot.scheduler.queue))
+        my_metrics.Gauge('bot_threads', 'Active threads', function=threading.active_count)
+        # the dispatcher of the sharded mode has metrics_port, the workers the next ones
+        port = cfg.metrics_port + (my_shard.SHARD + 1 if my_shard.SHARD is not None else 0)
+        my_metrics.start(port, getattr(cfg, 'metrics_host', '127.0.0.1'))
+    if my_shard.SHARD is not None:
+        my_shard.serve(bot)
+    else:
+        bot.polling(timeout=90, long_polling_timeout=90)
 
 
 if __name__ == '__main__':
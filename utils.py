@@ -1,16 +1,13 @@
 #!/usr/bin/env python3
 
 
+import functools
 import html
-import random
 import re
-import string
 import platform as platform_module
+import unicodedata
 
-import prettytable
 import telebot
-from bs4 import BeautifulSoup
-from pylatexenc.latex2text import LatexNodes2Text
 
 
 gpt_start_message1 = 'You are an artificial intelligence that responds to user requests in the Telegram messenger'
@@ -34,80 +31,250 @@ def split_text(text: str, chunk_limit: int = 1500):
     return telebot.util.smart_split(text, chunk_limit)
 
 
+# html for splitting: tags and entities are never cut, text between them can be cut
+_HTML_ATOM_RE = re.compile(r'<[^<>]*>|&#?\w+;|[^<&]+|[<&]')
+_HTML_TAG_NAME_RE = re.compile(r'<(/?)([a-zA-Z][\w-]*)')
+_HTML_TAG_RE = re.compile(r'<[^<>]*>')
+
+
+def _close_tags(stack) -> str:
+    return ''.join(f'</{name}>' for name, _ in reversed(stack))
+
+
+def _open_tags(stack) -> str:
+    return ''.join(tag for _, tag in stack)
+
+
 def split_html(text: str, max_length: int = 1500) -> list:
     """
     Split the given HTML text into chunks of maximum length, while preserving the integrity
-    of HTML tags. The function takes two arguments:
-    
+    of HTML tags. The text is walked once with a stack of open tags, chunks are cut after
+    a newline, then after '. ', then after a space, tags and entities are never cut.
+    Tags open at the cut are closed at the end of the chunk and opened again in the next one.
+
     Parameters:
         - text (str): The HTML text to be split.
         - max_length (int): The maximum length of each chunk. Default is 1500.
-        
+
     Returns:
         - list: A list of chunks, where each chunk is a part of the original text.
-        
-    Raises:
-        - AssertionError: If the length of the text is less than or equal to 299.
     """
-
-    if len(text) < 300:
+    if len(text) <= max_length:
         return [text,]
 
-    #find and replace all links (<a> tag) with random words with the same length
-    links = []
-    soup = BeautifulSoup(text, 'html.parser')
-    a_tags = soup.find_all('a')
-    for tag in a_tags:
-        tag = str(tag)
-        random_string = ''.join(random.choice(string.ascii_uppercase+string.ascii_lowercase) for _ in range(len(tag)))
-        links.append((random_string, tag))
-        text = text.replace(tag, random_string)
-
-    # split text into chunks
-    chunks = telebot.util.smart_split(text, max_length)
-    chunks2 = []
-    next_chunk_is_b = False
-    next_chunk_is_code = False
-    # in each piece, check if the number of opening and closing parts matches
-    # <b> <code> tags and replace random words back with links
-    for chunk in chunks:
-        for random_string, tag in links:
-            chunk = chunk.replace(random_string, tag)
-
-        b_tags = chunk.count('<b>')
-        b_close_tags = chunk.count('</b>')
-        code_tags = chunk.count('<code>')
-        code_close_tags = chunk.count('</code>')
-
-        if b_tags > b_close_tags:
-            chunk += '</b>'
-            next_chunk_is_b = True
-        elif b_tags < b_close_tags:
-            chunk = '<b>' + chunk
-            next_chunk_is_b = False
-
-        if code_tags > code_close_tags:
-            chunk += '</code>'
-            next_chunk_is_code = True
-        elif code_tags < code_close_tags:
-            chunk = '<code>' + chunk
-            next_chunk_is_code = False
-
-        # if there are no opening and closing <code> tags in the previous chunk
-        # a closing tag was added, so this chunk is entirely - code
-        if code_close_tags == 0 and code_tags == 0 and next_chunk_is_code:
-            chunk = '<code>' + chunk
-            chunk += '</code>'
-
-        # if there are no opening and closing <b> tags in the previous chunk
-        # a closing tag has been added, which means this entire chunk is <b>
-        if b_close_tags == 0 and b_tags == 0 and next_chunk_is_b:
-            chunk = '<b>' + chunk
-            chunk += '</b>'
-
-        chunks2.append(chunk)
-
-    return chunks2
+    atoms = _HTML_ATOM_RE.findall(text)
+    chunks = []
+
+    def add_chunk(body: str) -> None:
+        # a chunk without text is rejected by telegram
+        if _HTML_TAG_RE.sub('', body).strip():
+            chunks.append(body)
+
+    stack = []        # open tags [(name, opening tag)]
+    close_len = 0     # length of the closing tags for the stack
+    start = 0         # first atom of the current chunk
+    prefix = ''       # tags reopened at the start of the current chunk
+    length = 0        # length of the current chunk with the prefix
+    # the best places to cut the current chunk: (atom index, offset in the atom, stack there)
+    cut_newline = cut_dot = cut_space = None
+
+    i = 0
+    while i < len(atoms):
+        atom = atoms[i]
+        tag = _HTML_TAG_NAME_RE.match(atom) if atom[0] == '<' else None
+        need = len(atom)
+        if tag and not tag.group(1):
+            need += len(tag.group(2)) + 3
+
+        if length + need + close_len > max_length:
+            room = max_length - length - close_len
+            if room > 0 and not tag and atom[0] != '&':
+                # the beginning of the text fits into the chunk, the rest goes further
+                atoms[i:i + 1] = [atom[:room], atom[room:]]
+                atom = atoms[i]
+            elif i > start:
+                index, offset, cut_stack = cut_newline or cut_dot or cut_space or (i, 0, tuple(stack))
+                if offset:
+                    if offset < len(atoms[index]):
+                        atoms[index:index + 1] = [atoms[index][:offset], atoms[index][offset:]]
+                    index += 1
+                add_chunk(prefix + ''.join(atoms[start:index]) + _close_tags(cut_stack))
+                # the rest after the cut goes to the next chunk and is walked again
+                stack = list(cut_stack)
+                close_len = len(_close_tags(stack))
+                prefix = _open_tags(stack)
+                length = len(prefix)
+                start = i = index
+                cut_newline = cut_dot = cut_space = None
+                continue
+
+        length += len(atom)
+        if tag:
+            if not tag.group(1):
+                stack.append((tag.group(2).lower(), atom))
+                close_len += len(tag.group(2)) + 3
+            elif stack and stack[-1][0] == tag.group(2).lower():
+                stack.pop()
+                close_len -= len(tag.group(2)) + 3
+        elif atom[0] != '&':
+            newline = atom.rfind('\n')
+            dot = atom.rfind('. ')
+            space = max(atom.rfind(' '), newline)
+            if space != -1:
+                snapshot = tuple(stack)
+                if newline != -1:
+                    cut_newline = (i, newline + 1, snapshot)
+                if dot != -1:
+                    cut_dot = (i, dot + 2, snapshot)
+                cut_space = (i, space + 1, snapshot)
+        i += 1
+
+    if start < len(atoms):
+        add_chunk(prefix + ''.join(atoms[start:]) + _close_tags(stack))
+
+    return chunks
+
+
+# markdown tokens, bot_markdown_to_html scans the text once and builds a flat list of
+# nodes (kind, value), bold and link nodes have their own children
+_TEXT, _CODE, _PRE, _BOLD, _MATH, _LINK, _URL, _TABLE = range(8)
+
+_FENCE_RE = re.compile(r'```(.*?)```', flags=re.DOTALL)
+
+# the leftmost match wins, so the code hides everything inside it from other tokens
+_INLINE_RE = re.compile(r'''
+      (?P<bullet>^[ \t]*[*-][ ])
+    | `(?P<code>[^`]*)`
+    | \*\*(?P<bold>[^\n]+?)\*\*
+    | \$\$(?P<math2>.*?)\$\$
+    | \$(?P<math>.*?)\$
+    | \[(?P<label>[^\]]*)\]\((?P<href>[^\)]*)\)
+    | (?P<url>https?://\S+)
+    ''', flags=re.DOTALL | re.MULTILINE | re.VERBOSE)
+
+
+def _parse_inline(text: str, start: int, end: int, nodes: list) -> None:
+    """Adds nodes for text[start:end], everything except code blocks and tables"""
+    pos = start
+    for match in _INLINE_RE.finditer(text, start, end):
+        if match.start() > pos:
+            nodes.append((_TEXT, text[pos:match.start()]))
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == 'bullet':
+            nodes.append((_TEXT, match.group('bullet')[:-2] + '• '))
+        elif kind == 'code':
+            nodes.append((_CODE, match.group('code')))
+        elif kind == 'bold':
+            children = []
+            _parse_inline(text, match.start('bold'), match.end('bold'), children)
+            nodes.append((_BOLD, children))
+        elif kind in ('math', 'math2'):
+            nodes.append((_MATH, match.group(kind)))
+        elif kind == 'href':
+            children = []
+            _parse_inline(text, match.start('label'), match.end('label'), children)
+            nodes.append((_LINK, (children, match.group('href'))))
+        elif kind == 'url':
+            nodes.append((_URL, match.group('url')))
+    if pos < end:
+        nodes.append((_TEXT, text[pos:end]))
+
+
+def _parse_blocks(text: str, start: int, end: int, nodes: list) -> None:
+    """Adds nodes for text[start:end] without code blocks, finds tables line by line"""
+    if text.find('|', start, end) == -1:
+        _parse_inline(text, start, end, nodes)
+        return
+
+    span_start = start
+    table = []
+    line_start = start
+    while line_start <= end:
+        line_end = text.find('\n', line_start, end)
+        if line_end == -1:
+            line_end = end
+        line = text[line_start:line_end]
+        if line.count('|') > 2 and len(line) > 4:
+            if not table:
+                _parse_inline(text, span_start, line_start, nodes)
+            table.append(line)
+        elif table:
+            nodes.append((_TABLE, table))
+            table = []
+            # the newline after the table belongs to the text after it
+            span_start = line_start - 1
+        line_start = line_end + 1
+
+    if table:
+        nodes.append((_TABLE, table))
+    else:
+        _parse_inline(text, span_start, end, nodes)
+
+
+def _parse_markdown(text: str) -> list:
+    nodes = []
+    pos = 0
+    for match in _FENCE_RE.finditer(text):
+        _parse_blocks(text, pos, match.start(), nodes)
+        nodes.append((_PRE, match.group(1)))
+        pos = match.end()
+    _parse_blocks(text, pos, len(text), nodes)
+    return nodes
+
+
+# one converter for all answers, its creation costs more than a typical conversion
+_LATEX_CONVERTER = None
+
+
+@functools.lru_cache(maxsize=4096)
+def _latex_to_text(latex: str) -> str:
+    """latex code from $ and $$ tags to unicode text, works with escaped html"""
+    global _LATEX_CONVERTER
+    if _LATEX_CONVERTER is None:
+        from pylatexenc.latex2text import LatexNodes2Text
+        _LATEX_CONVERTER = LatexNodes2Text()
+    latex = html.unescape(latex).replace('\\\\', '\\')
+    return html.escape(_LATEX_CONVERTER.latex_to_text(latex))
+
+
+def _collect_math(nodes: list, found: set) -> set:
+    for kind, value in nodes:
+        if kind == _MATH:
+            found.add(value)
+        elif kind == _BOLD:
+            _collect_math(value, found)
+        elif kind == _LINK:
+            _collect_math(value[0], found)
+    return found
+
+
+def _convert_math(nodes: list) -> dict:
+    """Converts all latex fragments of the answer at once, each unique fragment only once"""
+    return {latex: _latex_to_text(latex) for latex in _collect_math(nodes, set())}
+
+
+def _render_nodes(nodes: list, out: list, math: dict) -> None:
+    for kind, value in nodes:
+        if kind == _TEXT:
+            out.append(value)
+        elif kind == _CODE or kind == _PRE:
+            out.append(f'<code>{value}</code>')
+        elif kind == _BOLD:
+            out.append('<b>')
+            _render_nodes(value, out, math)
+            out.append('</b>')
+        elif kind == _MATH:
+            out.append(math[value])
+        elif kind == _LINK:
+            children, href = value
+            out.append(f'<a href="{href}">')
+            _render_nodes(children, out, math)
+            out.append('</a>')
+        elif kind == _URL:
+            out.append(f'<a href="{value}">{value}</a>')
+        elif kind == _TABLE:
+            out.append(_table_to_html(value))
 
 
 def bot_markdown_to_html(text: str) -> str:
@@ -122,67 +289,17 @@ def bot_markdown_to_html(text: str) -> str:
     """
     # reworks markdown from chatbots in HTML for telegram
     # do full escaping first
-    # then the markdown tags and design are changed to the same in HTML
-    # this does not affect the code inside the tags, there is only escaping
+    # then the text is parsed in one pass into tokens: code blocks, inline code, lists,
+    # bold, latex, links, tables; the code inside tags is only escaped
     # latex code in $ and $$ tags changes to Unicode text
 
     # escape all text for html
     text = html.escape(text)
-    
-    # find all pieces of code between ``` and replace with hashes
-    # hide the code during transformations
-    matches = re.findall('```(.*?)```', text, flags=re.DOTALL)
-    list_of_code_blocks = []
-    for match in matches:
-        random_string = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(16))
-        list_of_code_blocks.append([match, random_string])
-        text = text.replace(f'```{match}```', random_string)
-    matches = re.findall('`(.*?)`', text, flags=re.DOTALL)
-    list_of_code_blocks2 = []
-    for match in matches:
-        random_string = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(16))
-        list_of_code_blocks2.append([match, random_string])
-        text = text.replace(f'`{match}`', random_string)
-
-    # we remake the lists into more beautiful ones
-    new_text = ''
-    for i in text.split('\n'):
-        ii = i.strip()
-        if ii.startswith('* '):
-            i = i.replace('* ', '• ', 1)
-        if ii.startswith('- '):
-            i = i.replace('- ', '• ', 1)
-        new_text += i + '\n'
-    text = new_text.strip()
-
-    # 1 or 2 * to 3 stars
-    # *bum* -> ***bum***
-    text = re.sub('\*\*(.+?)\*\*', '<b>\\1</b>', text)
-
-    # tex to unicode
-    matches = re.findall("\$\$?(.*?)\$\$?", text, flags=re.DOTALL)
-    for match in matches:
-        new_match = LatexNodes2Text().latex_to_text(match.replace('\\\\', '\\'))
-        text = text.replace(f'$${match}$$', new_match)
-        text = text.replace(f'${match}$', new_match)
-
-    # markdown to html
-    text = re.sub(r'\[([^\]]*)\]\(([^\)]*)\)', r'<a href="\2">\1</a>', text)
-    # we change all links to links in the HTML tag except those that are already designed like that
-    text = re.sub(r'(?<!<a href=")(https?://\S+)(?!">[^<]*</a>)', r'<a href="\1">\1</a>', text)
-
-    # hash to codes
-    for match, random_string in list_of_code_blocks2:
-        new_match = match
-        text = text.replace(random_string, f'<code>{new_match}</code>')
-
-    # hash to code blocks
-    for match, random_string in list_of_code_blocks:
-        new_match = match
-        text = text.replace(random_string, f'<code>{new_match}</code>')
-
-    text = replace_tables(text)
-    return text
+
+    nodes = _parse_markdown(text)
+    out = []
+    _render_nodes(nodes, out, _convert_math(nodes))
+    return ''.join(out).strip()
 
 
 def platform() -> str:
@@ -225,48 +342,118 @@ def split_long_string(long_string: str, header = False, MAX_LENGTH = 24) -> str:
     return result
 
 
+# the longest line in a table cell, longer text is wrapped
+TABLE_CELL_WIDTH = 24
+
+_TABLE_SEPARATOR_RE = re.compile(r'^[\s|:\-]+$')
+
+
+def _text_width(text: str) -> int:
+    """Width of the text in monospace font, wide asian characters take 2 places"""
+    if text.isascii():
+        return len(text)
+    return sum(2 if unicodedata.east_asian_width(c) in 'WF' else 1 for c in text)
+
+
+def _prefix_length(text: str, width: int) -> int:
+    """How many characters from the start of the text fit into the width"""
+    if text.isascii():
+        return width
+    total = 0
+    for i, c in enumerate(text):
+        total += 2 if unicodedata.east_asian_width(c) in 'WF' else 1
+        if total > width:
+            return max(i, 1)
+    return len(text)
+
+
+def _wrap_cell(text: str, width: int = TABLE_CELL_WIDTH) -> list:
+    """Splits the text of a cell into lines no wider than width, by spaces if possible"""
+    lines = []
+    while _text_width(text) > width:
+        cut = _prefix_length(text, width)
+        space = text.rfind(' ', 0, cut + 1)
+        if space > 0:
+            lines.append(text[:space])
+            text = text[space + 1:]
+        else:
+            lines.append(text[:cut])
+            text = text[cut:]
+    lines.append(text)
+    return lines
+
+
+def _table_cells(line: str) -> list:
+    cells = line.strip().strip('|').split('|')
+    return [html.unescape(x.strip().replace('<b>', '').replace('</b>', '').replace('**', '')) for x in cells]
+
+
+def format_table(lines: list):
+    """
+    Draws a markdown table with monospace text.
+
+    Args:
+        lines (list): Lines of the table with escaped html, the first is the header,
+                      the second may be the separator.
+
+    Returns:
+        str: The table as escaped html text or None if it is not a table after all.
+    """
+    rows = [_table_cells(line) for i, line in enumerate(lines)
+            if i != 1 or not _TABLE_SEPARATOR_RE.match(line)]
+    header = rows[0]
+    columns = len(header)
+    if not any(header):
+        return None
+
+    header = [[x if _text_width(x) <= TABLE_CELL_WIDTH else
+               x[:_prefix_length(x, TABLE_CELL_WIDTH - 2)] + '..'] for x in header]
+    body = []
+    for row in rows[1:]:
+        row = row[:columns] + [''] * (columns - len(row))
+        body.append([_wrap_cell(x) for x in row])
+
+    widths = [max(_text_width(line) for row in [header] + body for line in row[column])
+              for column in range(columns)]
+
+    result = []
+    for n, row in enumerate([header] + body):
+        height = max(len(cell) for cell in row)
+        for i in range(height):
+            line = []
+            for cell, width in zip(row, widths):
+                text = cell[i] if i < len(cell) else ''
+                line.append(text + ' ' * (width - _text_width(text)))
+            result.append('| ' + ' | '.join(line) + ' |')
+        if n == 0:
+            result.append('|' + '|'.join('-' * (width + 2) for width in widths) + '|')
+
+    return html.escape('\n'.join(result))
+
+
+def _table_to_html(lines: list) -> str:
+    table = format_table(lines)
+    if table is None:
+        return '\n'.join(lines)
+    return f'<code>{table}</code>'
+
+
 def replace_tables(text: str) -> str:
-    text += '\n'
-    state = 0
-    table = ''
-    results = []
+    """Replaces markdown tables in the html text with monospace tables, in one pass"""
+    result = []
+    table = []
     for line in text.split('\n'):
         if line.count('|') > 2 and len(line) > 4:
-            if state == 0:
-                state = 1
-            table += line + '\n'
-        else:
-            if state == 1:
-                results.append(table[:-1])
-                table = ''
-                state = 0
-
-    for table in results:
-        x = prettytable.PrettyTable(align = "l",
-                                    set_style = prettytable.MSWORD_FRIENDLY,
-                                    hrules = prettytable.HEADER,
-                                    junction_char = '|')
-        
-        lines = table.split('\n')
-        header = [x.strip().replace('<b>', '').replace('</b>', '') for x in lines[0].split('|') if x]
-        header = [split_long_string(x, header = True) for x in header]
-        try:
-            x.field_names = header
-        except Exception as error:
-            my_log.log2(f'tb:replace_tables: {error}')
+            table.append(line)
             continue
-        for line in lines[2:]:
-            row = [x.strip().replace('<b>', '').replace('</b>', '') for x in line.split('|') if x]
-            row = [split_long_string(x) for x in row]
-            try:
-                x.add_row(row)
-            except Exception as error2:
-                my_log.log2(f'tb:replace_tables: {error2}')
-                continue
-        new_table = x.get_string()
-        text = text.replace(table, f'<code>{new_table}</code>')
-
-    return text
+        if table:
+            result.append(_table_to_html(table))
+            table = []
+        result.append(line)
+    if table:
+        result.append(_table_to_html(table))
+
+    return '\n'.join(result)
 
 
 if __name__ == '__main__':